@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# Нагрузочный тест опроса: N эмулируемых стиков (deye.SolarmanV5Emulator, в отдельном
+# процессе что бы не влиять на измерения) опрашиваются так же как это делает экспортер -
+# инверторы создаются create_inverters() из deye_exporter.py, каждый опрос это то же что
+# poll_inverter() в collect_data(): read_registers() + decode_changed_registers() +
+# update_inverter_snapshot(). Получатели снимка работают как в экспортере: send_data_to_mqtt()
+# с заглушкой вместо брокера MQTT (считает сообщения) и ExpositionCache с CustomCollector
+# (--no-sinks - только путь чтения и декодирования, --min-render-interval - пауза между
+# рендерингами экспозиции). Расписание опроса collect_data() не используется: стики
+# опрашиваются подряд или с периодом --interval.
+# В конце печатается отчет: перцентили длительности опроса, пропускная способность, ошибки,
+# работа получателей, CPU и RSS процесса экспортера.
+#
+# Пример:
+#   ./benchmark.py --sticks 20 --duration 60 --latency 0.05 --jitter 0.02 --loss 0.001
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import resource
+import threading
+import time
+# custom module
+import deye
+import deye_exporter
+
+
+def make_register_image(arguments):
+    # Образ регистров стика: из файла --image ({"адрес": значение}) или по-умолчанию
+    # значение = адрес, а регистры со специальным декодером (состояния, ошибки) - 0,
+    # что бы все регистры успешно декодировались
+    if arguments.image:
+        with open(arguments.image) as image_file:
+            return {int(address): int(value) for address, value in json.load(image_file).items()}
+    register_image = {}
+    deye_inverter = deye.DeyeInverter(arguments.host, arguments.serial)
+    for register_details in deye_inverter.well_known_registers.values():
+        if 'decode_method' in register_details:
+            for offset in range(register_details.get('quantity', 1)):
+                register_image[register_details['id'] + offset] = 0
+    return register_image
+
+
+def run_emulators(arguments, ready_event, stop_event):
+    register_image = make_register_image(arguments)
+    emulators = []
+    for stick_number in range(arguments.sticks):
+        emulators.append(deye.SolarmanV5Emulator(
+            arguments.serial + stick_number, host=arguments.host, port=arguments.base_port + stick_number,
+            register_image=register_image,
+            latency_seconds=arguments.latency, latency_jitter_seconds=arguments.jitter,
+            loss_probability=arguments.loss, drop_probability=arguments.drop,
+            max_sockets=arguments.max_sockets, seed=stick_number
+        ).start())
+    ready_event.set()
+    stop_event.wait()
+    for emulator in emulators:
+        emulator.stop()
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return float('nan')
+    index = min(len(sorted_values) - 1, max(0, int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def rss_bytes():
+    # Текущий RSS из /proc (Linux), иначе - максимальный RSS за время работы
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class CountingMqttPublisher(object):
+    # Заглушка deye.MqttPublisher для send_data_to_mqtt(): сообщения только считаются
+    def __init__(self):
+        self.messages = 0
+        self.payload_bytes = 0
+        self._lock = threading.Lock()
+
+    def publish(self, topic, payload, qos=1, retain=False, on_ack=None):
+        with self._lock:
+            self.messages = self.messages + 1
+            self.payload_bytes = self.payload_bytes + len(payload)
+
+
+def start_sinks(deye_inverters, snapshot_store, arguments):
+    mqtt_publisher = CountingMqttPublisher()
+    delta_filters = {
+        inverter_name: deye.DeltaFilter(deye_inverter.well_known_registers)
+        for inverter_name, deye_inverter in deye_inverters.items()
+    }
+    threading.Thread(target=deye_exporter.send_data_to_mqtt, args=(
+            snapshot_store, 0, 'deye/{inverter}/state', mqtt_publisher,
+            arguments.mqtt_mode, 'deye/{inverter}/{field}', delta_filters,
+        ),
+        name='send_data_therad', daemon=True).start()
+    exposition_cache = deye.ExpositionCache(
+        snapshot_store, deye_exporter.CustomCollector(600), min_render_interval_seconds=arguments.min_render_interval
+    )
+    exposition_cache.start()
+    return mqtt_publisher, exposition_cache
+
+
+def poll_loop(inverter_name, deye_inverter, arguments, deadline, results, results_lock,
+              snapshot_store=None, register_freshness=None):
+    next_poll_at = time.monotonic()
+    register_names = list(deye_inverter.well_known_registers)
+    while time.monotonic() < deadline:
+        started_at = time.monotonic()
+        failed = False
+        try:
+            failed_windows = deye_inverter.read_registers()
+            failed_register_names = set(deye_inverter.registers_in_windows(failed_windows))
+            collected_data, changed_register_names = deye_inverter.decode_changed_registers(
+                [register_name for register_name in register_names if register_name not in failed_register_names]
+            )
+            if snapshot_store is not None:
+                failed_register_names.update(set(register_names) - set(collected_data))
+                fault_codes = deye_inverter.fault_codes() if deye_inverter.profile.fault_register_name in collected_data else None
+                deye_exporter.update_inverter_snapshot(
+                    snapshot_store, register_freshness, inverter_name,
+                    collected_data, failed_register_names, changed_register_names,
+                    fault_decoder=deye_inverter.fault_decoder, fault_codes=fault_codes
+                )
+            failed = bool(failed_windows)
+        except Exception:
+            failed = True
+            # Стик признан неисправным - не крутить цикл впустую
+            time.sleep(min(1, max(0, deye_inverter.circuit_breaker.seconds_until_retry())))
+        finished_at = time.monotonic()
+        with results_lock:
+            results['latencies'].append(finished_at - started_at)
+            results['polls'] = results['polls'] + 1
+            results['failed_polls'] = results['failed_polls'] + int(failed)
+        if arguments.interval:
+            next_poll_at = next_poll_at + arguments.interval
+            time.sleep(max(0, next_poll_at - time.monotonic()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Poll N emulated Solarman V5 sticks and report latency, throughput, CPU and RSS')
+    parser.add_argument('--sticks', type=int, default=10, help='number of emulated sticks')
+    parser.add_argument('--duration', type=float, default=30, help='test duration, seconds')
+    parser.add_argument('--interval', type=float, default=0, help='poll period of every stick, seconds (0 - back to back)')
+    parser.add_argument('--workers', type=int, default=None, help='poll threads (default: one per stick, at most 64)')
+    parser.add_argument('--max-in-flight', type=int, default=4, help='pipelined requests per stick')
+    parser.add_argument('--bus-rate', type=float, default=0, help='bus arbiter requests per second per stick (0 - unlimited)')
+    parser.add_argument('--bus-gap-ms', type=float, default=0, help='bus arbiter minimum gap between exchanges, ms')
+    parser.add_argument('--socket-timeout', type=float, default=2, help='reply timeout, seconds')
+    parser.add_argument('--latency', type=float, default=0.02, help='emulated reply latency, seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra latency up to this value, seconds')
+    parser.add_argument('--loss', type=float, default=0.0, help='probability that a request is not answered')
+    parser.add_argument('--drop', type=float, default=0.0, help='probability that the stick closes the connection')
+    parser.add_argument('--max-sockets', type=int, default=None, help='connections accepted by one stick')
+    parser.add_argument('--image', default=None, help='JSON file with the register image {"address": value}')
+    parser.add_argument('--no-sinks', action='store_true', help='only read and decode, without snapshots, MQTT and exposition')
+    parser.add_argument('--mqtt-mode', default='delta', choices=('json', 'delta'), help='publish mode of the MQTT sink')
+    parser.add_argument('--min-render-interval', type=float, default=1,
+                        help='minimum interval between exposition renders, seconds')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--base-port', type=int, default=18899)
+    parser.add_argument('--serial', type=int, default=2700000000)
+    parser.add_argument('--log-level', default='WARNING')
+    arguments = parser.parse_args()
+
+    ready_event = multiprocessing.Event()
+    stop_event = multiprocessing.Event()
+    emulators_process = multiprocessing.Process(target=run_emulators, args=(arguments, ready_event, stop_event), daemon=True)
+    emulators_process.start()
+    if not ready_event.wait(30):
+        raise RuntimeError("Emulators did not start")
+
+    inverters_configuration = [
+        {
+            'name': 'stick{}'.format(stick_number), 'ip': arguments.host, 'serial': arguments.serial + stick_number,
+            'port': arguments.base_port + stick_number, 'mb_slave_id': 1,
+        }
+        for stick_number in range(arguments.sticks)
+    ]
+    deye_inverters = deye_exporter.create_inverters(inverters_configuration)
+    for deye_inverter in deye_inverters.values():
+        deye_inverter.logger.setLevel(arguments.log_level)
+        deye_inverter.connection.socket_timeout = arguments.socket_timeout
+        deye_inverter.connection.max_in_flight = arguments.max_in_flight
+        deye_inverter.bus.requests_per_second = arguments.bus_rate
+        deye_inverter.bus.min_frame_gap_seconds = arguments.bus_gap_ms / 1000
+    read_plan = next(iter(deye_inverters.values())).read_plan
+
+    snapshot_store = None
+    register_freshness = {}
+    if not arguments.no_sinks:
+        snapshot_store = deye.SnapshotStore()
+        register_freshness = {
+            inverter_name: deye.RegisterFreshness(deye_inverter.well_known_registers, arguments.interval or 10)
+            for inverter_name, deye_inverter in deye_inverters.items()
+        }
+        mqtt_publisher, exposition_cache = start_sinks(deye_inverters, snapshot_store, arguments)
+
+    results = {'latencies': [], 'polls': 0, 'failed_polls': 0}
+    results_lock = threading.Lock()
+    workers = arguments.workers or min(64, arguments.sticks)
+    rss_before = rss_bytes()
+    cpu_started_at = time.process_time()
+    started_at = time.monotonic()
+    deadline = started_at + arguments.duration
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(poll_loop, inverter_name, deye_inverter, arguments, deadline, results, results_lock,
+                            snapshot_store, register_freshness.get(inverter_name))
+            for inverter_name, deye_inverter in deye_inverters.items()
+        ]
+        concurrent.futures.wait(futures)
+    wall_seconds = time.monotonic() - started_at
+    cpu_seconds = time.process_time() - cpu_started_at
+    rss_after = rss_bytes()
+
+    for deye_inverter in deye_inverters.values():
+        deye_inverter.close()
+    stop_event.set()
+    emulators_process.join(10)
+
+    latencies = sorted(results['latencies'])
+    print("Sticks: {}, workers: {}, duration: {:.1f} s, read plan: {} windows / {} registers".format(
+        arguments.sticks, workers, wall_seconds, read_plan.round_trips, read_plan.total_registers)
+    )
+    print("Polls: {} ({} failed), {:.1f} polls/s, {:.0f} registers/s".format(
+        results['polls'], results['failed_polls'], results['polls'] / wall_seconds,
+        (results['polls'] - results['failed_polls']) * read_plan.total_registers / wall_seconds)
+    )
+    print("Poll latency, ms: p50 {:.1f}, p90 {:.1f}, p99 {:.1f}, max {:.1f}".format(
+        *[percentile(latencies, percent) * 1000 for percent in (50, 90, 99, 100)])
+    )
+    if snapshot_store is not None:
+        print("Sinks: {} snapshot versions, exposition rendered up to version {} ({} bytes), MQTT ({}): {} messages, {} bytes".format(
+            snapshot_store.latest().version, exposition_cache.version, len(exposition_cache.get().body),
+            arguments.mqtt_mode, mqtt_publisher.messages, mqtt_publisher.payload_bytes)
+        )
+        print("Exposition: {} renders ({:.1f}/s), {:.2f} s rendering ({:.1f}% of one core)".format(
+            exposition_cache.renders_count, exposition_cache.renders_count / wall_seconds,
+            exposition_cache.render_seconds, exposition_cache.render_seconds / wall_seconds * 100)
+        )
+    print("CPU: {:.2f} s ({:.1f}% of one core), RSS: {:.1f} MiB (before polling {:.1f} MiB)".format(
+        cpu_seconds, cpu_seconds / wall_seconds * 100, rss_after / 1048576.0, rss_before / 1048576.0)
+    )
+
+
+if __name__ == '__main__':
+    main()
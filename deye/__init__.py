@@ -1 +1,25 @@
 from .deye_inverter import DeyeInverter
+from .read_planner import ReadPlanner, ReadPlan, ReadWindow
+from .connection import SolarmanConnection, PySolarmanV5Client, TRANSPORTS
+from .solarman_v5 import AsyncSolarmanV5Client, SolarmanV5Client
+from .columnar_decoder import ColumnarDecoder
+from .poll_scheduler import PollScheduler
+from .mqtt_publisher import MqttPublisher
+from .delta_filter import DeltaFilter
+from .ha_discovery import HomeAssistantDiscovery
+from .snapshot_store import Snapshot, SnapshotStore
+from .exposition_cache import ExpositionCache, RenderedExposition
+from .http_server import ExporterHTTPServer
+from .self_metrics import SelfMetrics, InverterMetrics
+from .retry import RetryPolicy, CircuitBreaker, CircuitOpenError
+from .register_freshness import RegisterFreshness, register_quality, QUALITY_FRESH, QUALITY_STALE, QUALITY_FAILED
+from .raw_ring_buffer import RawRingBuffer
+from .emulator import SolarmanV5Emulator, ModbusRtuEmulator
+from .logger import make_queue_handler, RateLimitFilter
+from .fault_decoder import FaultDecoder
+from .register_profile import RegisterProfile, ProfileLoader, ProfileError, load_profile
+from .register_writer import RegisterWriter
+from .bus_arbiter import BusArbiter, PRIORITY_WRITE, PRIORITY_FAST_POLL, PRIORITY_SLOW_POLL, PRIORITY_SCAN
+from .modbus_rtu_serial import SerialModbusClient
+from .modbus_tcp_server import ModbusTcpServer
+from .solarman_v5_proxy import SolarmanV5Proxy
@@ -0,0 +1,141 @@
+import contextlib
+import heapq
+import itertools
+import threading
+import time
+from .logger import getLogger
+
+
+# Приоритеты запросов к стику: меньше - важнее. Запись (команда пользователя) не ждет
+# опросов, регулярный опрос не ждет редко опрашиваемых регистров и разовых чтений
+PRIORITY_WRITE = 0
+PRIORITY_FAST_POLL = 1
+PRIORITY_SLOW_POLL = 2
+PRIORITY_SCAN = 3
+PRIORITY_NAMES = {
+    PRIORITY_WRITE: 'write',
+    PRIORITY_FAST_POLL: 'fast_poll',
+    PRIORITY_SLOW_POLL: 'slow_poll',
+    PRIORITY_SCAN: 'scan',
+}
+
+
+class BusArbiter(object):
+    """Single owner of the link to a logger stick.
+
+    Every exchange with the stick (a frame or a pipelined batch of frames)
+    is granted by the arbiter: waiting exchanges are granted strictly by
+    priority (PRIORITY_*), in arrival order within a priority, and only one
+    exchange uses the link at a time. Grants are limited by a token bucket
+    (requests_per_second, up to burst frames at once) and by a minimum gap
+    between the end of one exchange and the start of the next one.
+
+    read_windows() is split into batches of at most max_batch_frames windows
+    (one pipeline of the connection), so a write waits for at most one batch
+    of a long poll. The time every exchange waited for its grant is recorded
+    in metrics (InverterMetrics.observe_bus_queue_wait), if set.
+    """
+
+    def __init__(self, connection, requests_per_second=None, burst=None, min_frame_gap_seconds=0,
+                 max_batch_frames=None, metrics=None, logger=None, clock=time.monotonic):
+        self.connection = connection
+        # None или 0 - частота запросов не ограничивается
+        self.requests_per_second = requests_per_second
+        self.burst = max(1, burst or max_batch_frames or connection.max_in_flight)
+        self.min_frame_gap_seconds = min_frame_gap_seconds
+        self.max_batch_frames = max_batch_frames
+        self.metrics = metrics
+        self.clock = clock
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = getLogger("BusArbiter")
+
+        self._condition = threading.Condition()
+        # Очередь ожидающих: (приоритет, номер по порядку поступления)
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._busy = False
+        self._tokens = self.burst
+        self._refilled_at = self.clock()
+        self._released_at = None
+
+    @contextlib.contextmanager
+    def acquire(self, priority, frames=1):
+        """Own the link for one exchange of frames request frames."""
+        self._grant(priority, frames)
+        try:
+            yield self.connection
+        finally:
+            with self._condition:
+                self._busy = False
+                self._released_at = self.clock()
+                self._condition.notify_all()
+
+    def read_windows(self, windows, return_exceptions=False, priority=PRIORITY_SCAN):
+        batch_frames = self.max_batch_frames or max(1, self.connection.max_in_flight)
+        results = []
+        for batch_start in range(0, len(windows), batch_frames):
+            batch = windows[batch_start:batch_start + batch_frames]
+            try:
+                with self.acquire(priority, len(batch)) as connection:
+                    results.extend(connection.read_windows(batch, return_exceptions))
+            except Exception as E:
+                # Например сессия потеряна на предыдущей пачке - уже прочитанные пачки не теряются
+                if not return_exceptions:
+                    raise
+                results.extend([E] * len(batch))
+        return results
+
+    def read_holding_registers(self, register_addr, quantity, priority=PRIORITY_SCAN):
+        with self.acquire(priority) as connection:
+            return connection.read_holding_registers(register_addr, quantity)
+
+    def write_multiple_holding_registers(self, register_addr, values, priority=PRIORITY_WRITE):
+        with self.acquire(priority) as connection:
+            return connection.write_multiple_holding_registers(register_addr, values)
+
+    def queue_length(self):
+        with self._condition:
+            return len(self._waiting)
+
+    def _grant(self, priority, frames):
+        requested_at = self.clock()
+        # Пачка больше емкости корзины все равно должна когда-то пройти
+        tokens = min(frames, self.burst)
+        with self._condition:
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(self._waiting, ticket)
+            # Новый запрос может быть важнее того, кто сейчас ждет своей очереди
+            self._condition.notify_all()
+            try:
+                while True:
+                    wait_seconds = None
+                    if (self._waiting[0] == ticket) and not self._busy:
+                        wait_seconds = self._wait_seconds(tokens)
+                        if wait_seconds <= 0:
+                            break
+                    self._condition.wait(wait_seconds)
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            self._busy = True
+            if self.requests_per_second:
+                self._tokens = self._tokens - tokens
+        if self.metrics:
+            self.metrics.observe_bus_queue_wait(PRIORITY_NAMES.get(priority, str(priority)), self.clock() - requested_at)
+
+    def _wait_seconds(self, tokens):
+        now = self.clock()
+        wait_seconds = 0
+        if self.min_frame_gap_seconds and (self._released_at is not None):
+            wait_seconds = self._released_at + self.min_frame_gap_seconds - now
+        if self.requests_per_second:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.requests_per_second)
+            self._refilled_at = now
+            if self._tokens < tokens:
+                wait_seconds = max(wait_seconds, (tokens - self._tokens) / self.requests_per_second)
+        return wait_seconds
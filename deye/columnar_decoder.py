@@ -0,0 +1,116 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Единицы измерения числовых величин: для них применяются scale/offset/do_rounding,
+# все остальные величины декодируются своими decode_method
+NUMERIC_UNITS = ('C', 'V', '%', 'A', 'Hz', 'W')
+
+
+class ColumnarDecoder(object):
+    """Vectorized decoder for batches of raw register images.
+
+    Decodes an (N_snapshots x N_registers) uint16 array, where column i holds
+    register number i, in one pass: index, scale, offset, signedness and
+    rounding of every numeric register are precomputed into arrays once.
+    Registers with a decode_method (or quantity > 1) can not be vectorized and
+    are decoded row by row with decode_value(register_details, raw words)
+    (DeyeInverter.decode_value: decode_method, then signedness and
+    scale/offset/rounding of numeric units), or only with their decode_method
+    if decode_value is not set.
+    """
+
+    def __init__(self, registers, default_decoder=None, decode_value=None):
+        if numpy is None:
+            raise ImportError("numpy is required for ColumnarDecoder")
+
+        self.numeric_names = []
+        self.units = {}
+        self.methods = {}
+        self.decode_value = decode_value
+        index, scale, offset, signed, do_rounding = [], [], [], [], []
+        for register_name, register_details in registers.items():
+            self.units[register_name] = register_details['units']
+            quantity = register_details.get('quantity', 1)
+            if ('decode_method' in register_details) or (quantity != 1):
+                decode_method = register_details.get('decode_method', default_decoder)
+                self.methods[register_name] = (register_details['id'], quantity, decode_method, register_details)
+                continue
+
+            self.numeric_names.append(register_name)
+            index.append(register_details['id'])
+            if register_details['units'] in NUMERIC_UNITS:
+                scale.append(register_details.get('scale', 1))
+                offset.append(register_details.get('offset', 0))
+                do_rounding.append(register_details.get('do_rounding', False))
+            else:
+                scale.append(1)
+                offset.append(0)
+                do_rounding.append(False)
+            signed.append(register_details.get('signed', False))
+
+        self.index = numpy.array(index, dtype=numpy.intp)
+        self.scale = numpy.array(scale, dtype=numpy.float64)
+        self.offset = numpy.array(offset, dtype=numpy.float64)
+        self.signed = numpy.array(signed, dtype=bool)
+        self.do_rounding = numpy.array(do_rounding, dtype=bool)
+        self.any_signed = bool(self.signed.any())
+        self.any_rounding = bool(self.do_rounding.any())
+        # Минимальная ширина образа регистров, нужная для декодирования
+        self.min_width = max(
+            [int(self.index.max()) + 1 if len(self.index) else 0] +
+            [register_id + quantity for register_id, quantity, _, _ in self.methods.values()]
+        )
+
+    def decode(self, images, valid=None):
+        """Decode register images.
+
+        images: (N_snapshots x N_registers) array-like of uint16, column is the register number.
+        valid: optional boolean array of the same shape, False marks registers which were not read;
+               numeric values decoded from them are NaN, method decoded values are None.
+
+        Returns dict register name -> numpy array of N_snapshots values (float64 for numeric
+        registers, object for registers with a decode_method).
+        """
+        images = numpy.asarray(images, dtype=numpy.uint16)
+        if images.ndim == 1:
+            images = images[numpy.newaxis, :]
+        if images.shape[1] < self.min_width:
+            raise ValueError("Register images are too narrow: {} registers, at least {} expected".format(
+                images.shape[1], self.min_width)
+            )
+
+        # Одна выборка всех нужных колонок, дальше все операции над матрицей N x M
+        raw = images[:, self.index]
+        values = raw.astype(numpy.float64)
+        if self.any_signed:
+            values[:, self.signed] = raw[:, self.signed].view(numpy.int16)
+        values = values * self.scale + self.offset
+        if self.any_rounding:
+            values[:, self.do_rounding] = numpy.rint(values[:, self.do_rounding])
+        if valid is not None:
+            valid = numpy.asarray(valid, dtype=bool)
+            values[~valid[:, self.index]] = numpy.nan
+
+        output = {}
+        for column, register_name in enumerate(self.numeric_names):
+            output[register_name] = values[:, column]
+
+        for register_name, (register_id, quantity, decode_method, register_details) in self.methods.items():
+            column = numpy.empty(len(images), dtype=object)
+            for row in range(len(images)):
+                if (valid is not None) and (not valid[row, register_id:register_id + quantity].all()):
+                    column[row] = None
+                    continue
+                words = images[row, register_id:register_id + quantity].tolist()
+                try:
+                    if self.decode_value is not None:
+                        column[row] = self.decode_value(register_details, words)
+                    else:
+                        column[row] = decode_method(words)
+                except Exception:
+                    column[row] = None
+            output[register_name] = column
+        return output
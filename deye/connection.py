@@ -0,0 +1,262 @@
+import queue
+import socket
+import threading
+import time
+import pysolarmanv5
+from .logger import getLogger
+from .modbus_rtu import ModbusFrameError
+from .solarman_v5 import SolarmanV5Client
+from .modbus_rtu_serial import SerialModbusClient
+
+
+# Ошибки после которых сессию со стиком нельзя использовать дальше:
+# соединение закрывается и будет заново открыто при следующем запросе
+CONNECTION_ERRORS = (
+    pysolarmanv5.NoSocketAvailableError,
+    pysolarmanv5.V5FrameError,
+    TimeoutError,
+    queue.Empty,
+    OSError,
+    ModbusFrameError,
+)
+
+
+class ReconnectPendingError(pysolarmanv5.NoSocketAvailableError):
+    """The session to the stick is down and the reconnect backoff has not passed yet.
+
+    Raised instead of waiting for the backoff: the connection lock (and the
+    bus grant of the caller) is not held while nothing can be sent, the caller
+    retries after seconds.
+    """
+
+    def __init__(self, message, seconds):
+        super().__init__(message)
+        self.seconds = seconds
+
+
+class PySolarmanV5Client(pysolarmanv5.PySolarmanV5):
+    """pysolarmanv5 client with the interface of SolarmanV5Client (strictly serial requests)."""
+
+    # Опоздавший ответ на запрос с ошибкой может быть принят за ответ на следующий запрос
+    discards_late_replies = False
+
+    def is_connected(self):
+        # Поток-читатель pysolarmanv5 завершается и обнуляет сокет когда соединение закрыто
+        # удаленной стороной - такое соединение уже не годится
+        return (self.sock is not None) and self._reader_thr.is_alive()
+
+    def __init__(self, address, serial, on_request_latency=None, **kwargs):
+        # on_request_latency(seconds) вызывается после каждого успешного запроса
+        self.on_request_latency = on_request_latency
+        super(PySolarmanV5Client, self).__init__(address, serial, **kwargs)
+
+    def read_windows(self, windows, return_exceptions=False):
+        results = []
+        for start, quantity in windows:
+            started_at = time.monotonic()
+            try:
+                results.append(self.read_holding_registers(register_addr=start, quantity=quantity))
+            except Exception as E:
+                if not return_exceptions:
+                    raise
+                # После ошибки ответ на этот запрос может прийти позже и быть принят за ответ
+                # на следующий - остальные окна в этой сессии не читаем
+                results.extend([E] * (len(windows) - len(results)))
+                return results
+            if self.on_request_latency is not None:
+                self.on_request_latency(time.monotonic() - started_at)
+        return results
+
+
+# Транспорты (классы клиентов) по имени: V5 через стик (по-умолчанию), то же через pysolarmanv5,
+# Modbus RTU напрямую через RS485
+TRANSPORTS = {
+    'solarman': SolarmanV5Client,
+    'pysolarmanv5': PySolarmanV5Client,
+    'rtu': SerialModbusClient,
+}
+DEFAULT_TRANSPORT = 'solarman'
+
+
+class SolarmanConnection(object):
+    """Long-lived Solarman V5 session to a logger stick.
+
+    The TCP session is opened on the first request and reused for all later
+    requests. When a request fails the session is dropped and re-established
+    on the next request, waiting out an exponential backoff between failed
+    connection attempts. Half-open sockets are detected with TCP keepalive and
+    by the liveness of the client's receiver.
+
+    client_class is SolarmanV5Client (native asyncio client which pipelines
+    window reads) by default, PySolarmanV5Client or SerialModbusClient
+    (Modbus RTU over RS485, stick_logger_ip is the serial device then) may
+    be used instead, see TRANSPORTS; client_options are passed to it.
+    When metrics (InverterMetrics) is set, connect time, window read latency
+    and errors are recorded there.
+    """
+
+    def __init__(self, stick_logger_ip, stick_logger_serial, port=8899, mb_slave_id=1,
+                 logger=None, verbose=False, socket_timeout=15,
+                 reconnect_backoff_initial_seconds=1, reconnect_backoff_max_seconds=60,
+                 client_class=SolarmanV5Client, max_in_flight=4, metrics=None, client_options=None):
+        self.stick_logger_ip = stick_logger_ip
+        self.stick_logger_serial = stick_logger_serial
+        self.port = port
+        self.mb_slave_id = mb_slave_id
+        self.verbose = verbose
+        self.socket_timeout = socket_timeout
+        self.reconnect_backoff_initial_seconds = reconnect_backoff_initial_seconds
+        self.reconnect_backoff_max_seconds = reconnect_backoff_max_seconds
+        self.client_class = client_class
+        self.client_options = dict(client_options or {})
+        # Сколько запросов можно отправить стику не дожидаясь ответов (только для SolarmanV5Client)
+        self.max_in_flight = max_in_flight
+        self.metrics = metrics
+
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = getLogger("SolarmanConnection")
+
+        # Счетчики для мониторинга: успешные подключения, переподключения
+        # (все подключения кроме первого) и неудачные попытки подключения
+        self.connect_count = 0
+        self.reconnect_count = 0
+        self.connect_failures_count = 0
+
+        self._modbus = None
+        # Запросы к стику из разных потоков выполняются строго по одному
+        self._lock = threading.RLock()
+        self._reconnect_backoff_seconds = 0
+        self._next_connect_at = 0
+
+    def is_connected(self):
+        modbus = self._modbus
+        if modbus is None:
+            return False
+        return modbus.is_connected()
+
+    def seconds_until_reconnect(self):
+        """Seconds left of the backoff before the next connection attempt, 0 if connected or not waiting."""
+        if self.is_connected():
+            return 0
+        return max(0, self._next_connect_at - time.monotonic())
+
+    def connect(self):
+        with self._lock:
+            if self.is_connected():
+                return self._modbus
+            if self._modbus is not None:
+                self.logger.debug("[SolarmanConnection] Session to %s:%s is dead, reconnecting", self.stick_logger_ip, self.port)
+                self._close_modbus()
+
+            # Не долбить стик попытками подключения - до окончания backoff после предыдущей ошибки
+            # запросы сразу завершаются ошибкой (ждать под блокировкой и захваченной шиной нельзя)
+            wait_seconds = self._next_connect_at - time.monotonic()
+            if wait_seconds > 0:
+                raise ReconnectPendingError("Reconnect to {}:{} is allowed in {:.1f} second(s)".format(
+                    self.stick_logger_ip, self.port, wait_seconds), wait_seconds
+                )
+
+            connect_started_at = time.monotonic()
+            try:
+                modbus = self.client_class(
+                    self.stick_logger_ip, self.stick_logger_serial,
+                    port=self.port, mb_slave_id=self.mb_slave_id,
+                    socket_timeout=self.socket_timeout, max_in_flight=self.max_in_flight,
+                    verbose=self.verbose, logger=self.logger,
+                    on_request_latency=self.metrics.window_read_seconds.observe if self.metrics else None,
+                    **self.client_options
+                )
+            except CONNECTION_ERRORS as E:
+                self.connect_failures_count = self.connect_failures_count + 1
+                if self.metrics:
+                    self.metrics.count_error(E)
+                self._schedule_reconnect()
+                raise
+            if self.metrics:
+                self.metrics.connect_seconds.observe(time.monotonic() - connect_started_at)
+
+            self._enable_keepalive(modbus.sock)
+            if self.connect_count:
+                self.reconnect_count = self.reconnect_count + 1
+            self.connect_count = self.connect_count + 1
+            self._reconnect_backoff_seconds = 0
+            self._next_connect_at = 0
+            self._modbus = modbus
+            self.logger.debug("[SolarmanConnection] Connected to %s:%s (connects: %s, reconnects: %s)",
+                              self.stick_logger_ip, self.port, self.connect_count, self.reconnect_count)
+            return modbus
+
+    def read_holding_registers(self, register_addr, quantity):
+        return self._request('read_holding_registers', register_addr, quantity)
+
+    def write_multiple_holding_registers(self, register_addr, values):
+        return self._request('write_multiple_holding_registers', register_addr, values)
+
+    def read_windows(self, windows, return_exceptions=False):
+        """Read a list of (start, quantity) windows, returns register values per window.
+
+        With return_exceptions the exception of a failed window is returned in
+        place of its values; the session is dropped only if it is no longer usable.
+        """
+        if not return_exceptions:
+            return self._request('read_windows', windows)
+        with self._lock:
+            results = self._request('read_windows', windows, True)
+            errors = [result for result in results if isinstance(result, Exception)]
+            if errors and self.metrics:
+                for error in errors:
+                    self.metrics.count_error(error)
+            if errors and not (self.is_connected() and self._modbus.discards_late_replies):
+                self.logger.debug("[SolarmanConnection] Session to %s:%s is lost: %r, dropping session",
+                                  self.stick_logger_ip, self.port, errors[0])
+                self._close_modbus()
+                self._schedule_reconnect()
+            return results
+
+    def close(self):
+        with self._lock:
+            self._close_modbus()
+
+    def _request(self, method_name, *args):
+        with self._lock:
+            modbus = self.connect()
+            try:
+                return getattr(modbus, method_name)(*args)
+            except CONNECTION_ERRORS as E:
+                # После ошибки состояние сессии не известно (например ответ может прийти позже
+                # и быть принят за ответ на следующий запрос) - закрываем ее
+                self.logger.debug("[SolarmanConnection] Request %s%s failed: %r, dropping session", method_name, args, E)
+                if self.metrics:
+                    self.metrics.count_error(E)
+                self._close_modbus()
+                self._schedule_reconnect()
+                raise
+
+    def _schedule_reconnect(self):
+        if self._reconnect_backoff_seconds:
+            self._reconnect_backoff_seconds = min(self._reconnect_backoff_seconds * 2, self.reconnect_backoff_max_seconds)
+        else:
+            self._reconnect_backoff_seconds = self.reconnect_backoff_initial_seconds
+        self._next_connect_at = time.monotonic() + self._reconnect_backoff_seconds
+
+    def _close_modbus(self):
+        if self._modbus is None:
+            return
+        try:
+            self._modbus.disconnect()
+        except Exception as E:
+            self.logger.debug("[SolarmanConnection] Error on disconnect: %r", E)
+        self._modbus = None
+
+    @staticmethod
+    def _enable_keepalive(sock):
+        # TCP keepalive позволяет обнаружить "полуоткрытое" соединение (например стик
+        # перезагрузился и не прислал FIN) без отправки запросов
+        if sock is None:
+            return
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option_name, value in (('TCP_KEEPIDLE', 30), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3)):
+            if hasattr(socket, option_name):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option_name), value)
@@ -0,0 +1,52 @@
+import time
+
+
+class DeltaFilter(object):
+    """Selects the fields which have to be (re)published.
+
+    A field is published when it was never published before, when its value
+    moved away from the last published value by more than the register's
+    deadband ('deadband' - absolute, 'deadband_percent' - percent of the last
+    published value), or when it was not published for heartbeat_seconds.
+    Non numeric fields are published on any change.
+    """
+
+    def __init__(self, registers, heartbeat_seconds=300, clock=time.monotonic):
+        self.heartbeat_seconds = heartbeat_seconds
+        self.clock = clock
+        self.deadbands = {}
+        for register_name, register_details in registers.items():
+            self.deadbands[register_name] = (
+                register_details.get('deadband', 0),
+                register_details.get('deadband_percent', 0)
+            )
+        # (ключ, имя поля) -> (опубликованное значение, время публикации)
+        self.published = {}
+
+    def changed(self, key, values, now=None):
+        """Returns {field: value} from values which have to be published for key (e.g. inverter name)."""
+        if now is None:
+            now = self.clock()
+        to_publish = {}
+        for field, value in values.items():
+            published = self.published.get((key, field))
+            if (published is None) or (now - published[1] >= self.heartbeat_seconds) or \
+                    self._exceeds_deadband(field, published[0], value):
+                to_publish[field] = value
+        return to_publish
+
+    def mark_published(self, key, values, now=None):
+        if now is None:
+            now = self.clock()
+        for field, value in values.items():
+            self.published[(key, field)] = (value, now)
+
+    def _exceeds_deadband(self, field, published_value, value):
+        numeric_types = (int, float)
+        if not (isinstance(value, numeric_types) and isinstance(published_value, numeric_types)):
+            return value != published_value
+        deadband, deadband_percent = self.deadbands.get(field, (0, 0))
+        deadband = max(deadband, abs(published_value) * deadband_percent / 100.0)
+        if deadband:
+            return abs(value - published_value) > deadband
+        return value != published_value
@@ -1,10 +1,20 @@
 from ._base import *
+import contextlib
+import logging
+from array import array
 from .logger import getLogger
+from .register_profile import RegisterProfile, load_profile, DEFAULT_PROFILE
+from .connection import SolarmanConnection, ReconnectPendingError, CONNECTION_ERRORS, TRANSPORTS, DEFAULT_TRANSPORT
+from .columnar_decoder import ColumnarDecoder
+from .retry import RetryPolicy, CircuitBreaker, CircuitOpenError
+from .bus_arbiter import BusArbiter, PRIORITY_WRITE, PRIORITY_FAST_POLL, PRIORITY_SCAN
 
 
 class DeyeInverter(object):
 
-    def __init__(self, stick_logger_ip, stick_logger_serial, port=8899, mb_slave_id=1, logger=None, log_level=None ):
+    def __init__(self, stick_logger_ip, stick_logger_serial, port=8899, mb_slave_id=1, logger=None, log_level=None, gap_merge_threshold=None, max_in_flight=4, metrics=None, profile=None,
+                 bus_requests_per_second=None, bus_burst=None, bus_min_frame_gap_seconds=0,
+                 transport=DEFAULT_TRANSPORT, transport_options=None, socket_timeout=15 ):
         self.stick_logger_ip = stick_logger_ip
         self.stick_logger_serial = stick_logger_serial
         self.port = port
@@ -30,8 +40,47 @@ class DeyeInverter(object):
         self.logger.debug("DeyeInverter __init__")
 
         self.sleep_on_inverter_read_error = 60
-        self.max_read_attempts = 10
-        self.inverter_read_raw_result_all_registers = []
+        # Повтор неудачных окон чтения и защита от опроса неисправного стика:
+        # после failure_threshold неудачных попыток подряд стик не опрашивается sleep_on_inverter_read_error секунд
+        self.retry_policy = RetryPolicy(max_attempts=4, backoff_initial_seconds=0.25, backoff_max_seconds=5)
+        self.circuit_breaker = CircuitBreaker(failure_threshold=5, reset_timeout_seconds=self.sleep_on_inverter_read_error)
+        # Метрики самого экспортера для этого инвертора (SelfMetrics.for_inverter), могут быть не заданы
+        self.metrics = metrics
+
+        # Транспорт: 'solarman' - Solarman V5 через стик (по-умолчанию), 'rtu' - Modbus RTU напрямую
+        # через RS485, тогда stick_logger_ip - последовательный порт ('/dev/ttyUSB0'), а transport_options -
+        # его параметры (baudrate, parity, stopbits, bytesize, inter_frame_seconds)
+        if transport not in TRANSPORTS:
+            raise ValueError("Unknown transport {}, expected one of {}".format(transport, sorted(TRANSPORTS)))
+        self.transport = transport
+        if transport == 'rtu':
+            # Линия полудуплексная - запросы только по одному
+            max_in_flight = 1
+
+        # Одно долгоживущее соединение со стиком на все циклы опроса. Стик принимает
+        # всего несколько сокетов, поэтому соединение не пересоздается на каждый цикл,
+        # а после ошибки переподключается с увеличивающейся паузой (не более sleep_on_inverter_read_error)
+        self.connection = SolarmanConnection(
+            self.stick_logger_ip, self.stick_logger_serial,
+            port=self.port, mb_slave_id=self.mb_slave_id,
+            logger=self.logger, verbose=self.verbose, socket_timeout=socket_timeout,
+            reconnect_backoff_max_seconds=self.sleep_on_inverter_read_error,
+            client_class=TRANSPORTS[transport], client_options=transport_options,
+            max_in_flight=max_in_flight,
+            metrics=metrics
+        )
+        # Все обмены со стиком (опросы разной частоты, запись, разовые чтения) идут через
+        # арбитр: по приоритету, с ограничением частоты запросов и паузой между ними
+        self.bus = BusArbiter(
+            self.connection,
+            requests_per_second=bus_requests_per_second, burst=bus_burst,
+            min_frame_gap_seconds=bus_min_frame_gap_seconds,
+            metrics=metrics, logger=self.logger
+        )
+        # Векторный декодер создается при первом использовании (нужен numpy)
+        self._columnar_decoder = None
+        # Описание регистров берется из профиля модели (deye/profiles/*.json), профиль
+        # проверяется и компилируется один раз и используется всеми инверторами этой модели.
         # https://github.com/kellerza/sunsynk/blob/main/src/sunsynk/definitions/single_phase.py
         #
         # id: номер регистра
@@ -39,87 +88,55 @@ class DeyeInverter(object):
         # scale: множитель, если не указан принимается равным 1
         # offset: смещение, если не указан принимается равным 0
         # do_rounding: требуется ли делать округление, если не указан принимается False
-        # decode_method: Если определен, то для значения требуется специальный метод декодирования
+        # decoder: u16 (по-умолчанию), enum (строка из таблицы enum профиля) или faults (битовая
+        #   карта ошибок), для enum и faults в well_known_registers есть decode_method
         # quantity: число регистров, в которых содержится искомая величина, по умолчанию это 1 регистр
-        self.well_known_registers = {
-            'battery_temperature':    {'id': 182, 'units': 'C',  'scale': 0.1,     'offset': -100 },
-            'battery_voltage':        {'id': 183, 'units': 'V',  'scale': 0.01  },
-            'battery_soc':            {'id': 184, 'units': '%' },
-            'battery_charge_limit':   {'id': 314, 'units': 'A' },
-            'battery_dischage_limit': {'id': 315, 'units': 'A' },
-            'grid_frequency':         {'id': 79,  'units': 'Hz', 'scale': 0.01 },
-            'grid_power':             {'id': 169, 'units': 'W',  'scale': -1   },
-            'grid_ld_power':          {'id': 167, 'units': 'W',  'scale': -1   },
-            'grid_l2_power':          {'id': 168, 'units': 'W',  'scale': -1   },
-            'grid_voltage':           {'id': 150, 'units': 'V',  'scale': 0.1,     'do_rounding': True },
-            'grid_current':           {'id': 160, 'units': 'A',  'scale': 0.01,    'do_rounding': True },
-            'grid_ct_power':          {'id': 172, 'units': 'W',  'scale': -1    },
-            'load_power':             {'id': 178, 'units': 'W'},
-            'load_l1_power':          {'id': 176, 'units': 'W'},
-            'load_l2_power':          {'id': 177, 'units': 'W'},
-            'load_frequency':         {'id': 192, 'units': 'Hz', 'scale': 0.01 },
-            'overall_state':          {'id': 59,  'units': ''  , 'decode_method': self.decode_overall_state },
-            'fault_state':            {'id': 103, 'units': ''  , 'decode_method': self.decode_fault_state, 'quantity': 4 },
-            'grid_connection':        {'id': 194, 'units': ''  , 'decode_method': self.decode_grid_connection }
-        }
-
-        self.grid_connection_status = {
-            0: 'OFF',
-            1: 'ON'
-        }
-
-        self.inverter_state = {
-            0: "standby",
-            1: "selfcheck",
-            2: "ok",
-            3: "alarm",
-            4: "fault",
-            5: "activating"
-        }
-
-        self.faults = {
-            13: "Working mode change",
-            18: "AC over current",
-            20: "DC over current",
-            23: "AC leak current or transient over current",
-            24: "DC insulation impedance",
-            26: "DC busbar imbalanced",
-            29: "Parallel comms cable",
-            35: "No AC grid",
-            42: "AC line low voltage",
-            47: "AC freq high/low",
-            56: "DC busbar voltage low",
-            63: "ARC fault",
-            64: "Heat sink tempfailure",
-        }
-
-        # найти максимальное значение известного регистра что бы определить сколько операций чтения
-        # (читая по max_number_of_registers_to_read_in_request за одну операцию) потребуется
-        # что бы прочитать все регситры которые хочется прочитать. (или точнее что бы в прочитанных регистрах
-        # точно оказались те, значения которых известно как декодировать)
-        # Когечно тут можно было хахардкодить и черт с ним - но хочется в будущем минимально смотреть в кода,
-        # изменяя только список регистров, если получится узнать что значит еще какой-то из них
-        self.max_register_number = 0
-        # Определить максимальное значение известного регистра
-        for k, v in self.well_known_registers.items():
-            if v['id'] > self.max_register_number:
-                self.max_register_number =  v['id']
-        # Целое число чтений (деление целочисленное) но почти всегда это значение будет на 1 меньше чем нужно
-        # например число чтений за раз = 125 (прочитать регистры от 0 до 124 включительно) и предположим что
-        # максимальный известный регистр имеет номер 130 -  тогда при делении 130 // 126 = 1
-        self.inverter_registers_reads_number  = self.max_register_number // self.max_number_of_registers_to_read_in_request
-
-        # Проверить что бы максимальный регистр точно попадал в диапазон читаемых, и если нет то расширить диапазон
-        # -1  в выражении означает что последний прочитанный регистр имеет на 1 меньший адрес так как счет начитается с 0
-        if (self.max_register_number > (self.max_number_of_registers_to_read_in_request * self.inverter_registers_reads_number - 1 ) ):
-            self.inverter_registers_reads_number = self.inverter_registers_reads_number + 1
-
-        self.logger.debug("max_register_number: {} Reads to be done: {} ({} registers on each read)".format(
-            self.max_register_number, self.inverter_registers_reads_number, self.max_number_of_registers_to_read_in_request)
-        )
-        self.logger.debug("Will read the following registers. First register number: 0, last register number: {}".format(
-            self.max_number_of_registers_to_read_in_request * self.inverter_registers_reads_number - 1
+        # signed: значение регистра - знаковое 16-битное число (дополнительный код), по умолчанию False
+        # poll_interval: как часто (в секундах) опрашивать регистр, если не указан - с общим периодом опроса
+        # deadband: при публикации изменений (MQTT) значение считается изменившимся только если отличается
+        #   от опубликованного больше чем на deadband (или на deadband_percent процентов)
+        # writable: в регистр можно записать значение (команды MQTT), min/max - допустимые значения
+        # max_age: сколько секунд после чтения значение регистра можно отдавать из образа клиентам
+        #   Modbus TCP сервера (ModbusTcpServer), если не указан - 3 интервала опроса регистра
+        if not isinstance(profile, RegisterProfile):
+            profile = load_profile(
+                profile or DEFAULT_PROFILE,
+                max_registers_per_request=self.max_number_of_registers_to_read_in_request,
+                gap_merge_threshold=gap_merge_threshold
             )
+        self.profile = profile
+        self.well_known_registers = profile.registers
+        self.inverter_state = profile.enums.get('inverter_state', {})
+        self.grid_connection_status = profile.enums.get('grid_connection_status', {})
+        self.faults = profile.faults
+        self.fault_decoder = profile.fault_decoder
+
+        # Планировщик чтения (из профиля): группирует известные регистры в минимальный набор
+        # непрерывных окон, вместо того что бы читать все подряд от 0 до максимального известного регистра.
+        # gap_merge_threshold - максимальный "разрыв" (в регистрах) между известными регистрами,
+        # который выгоднее прочитать лишними байтами, чем делать еще один запрос к инвертору.
+        # Если не задан - вычисляется из оценки стоимости запроса и регистра
+        self.read_planner = profile.read_planner
+        self.read_plan = profile.read_plan
+        self.max_register_number = self.read_plan.last_register
+        # Образ регистров индексируется номером регистра: значения - компактный array('H'),
+        # register_valid - 1 для регистров которые уже были прочитаны хотя бы раз
+        self.register_values = array('H', bytes(2 * (self.max_register_number + 1)))
+        self.register_valid = bytearray(self.max_register_number + 1)
+        # Время (time.monotonic()) последнего чтения каждого регистра образа
+        self.register_read_at = array('d', bytes(8 * (self.max_register_number + 1)))
+        # номер регистра -> имена известных регистров, которые его используют
+        self.register_names_by_address = profile.registers_by_address
+        # Регистры, слова которых изменились с момента их последнего декодирования
+        self.changed_registers = set()
+        # Последние декодированные значения: имя регистра -> {'value': ..., 'units': ...}
+        self.decoded_registers = {}
+
+        self.logger.debug("Read plan: %s (%s reads, %s registers, estimated cost %s ms)",
+            self.read_plan.windows,
+            self.read_plan.round_trips,
+            self.read_plan.total_registers,
+            self.read_plan.estimated_cost_ms
         )
 
 
@@ -129,53 +146,24 @@ class DeyeInverter(object):
         return data[0]
 
 
-    def decode_overall_state(self, overall_state):
-        # Декодер для статуса - возвращает человекочитаемый статус
-        #  в виде строки а не числа/кода состояния
-        if len(overall_state) != 1:
-            raise ValueError("Expected size of list is 1")
-        else:
-            return self.inverter_state[overall_state[0]]
+    def fault_codes(self):
+        """Set of active fault codes from the raw image, None if the profile has no faults register or it was not read."""
+        if self.profile.fault_register_name is None:
+            return None
+        register_details = self.well_known_registers[self.profile.fault_register_name]
+        register_id = register_details['id']
+        quantity = register_details['quantity']
+        if 0 in self.register_valid[register_id:register_id + quantity]:
+            return None
+        return self.fault_decoder.codes(self.register_values[register_id:register_id + quantity])
 
 
-    def decode_grid_connection(self, grid_connection):
-        if len(grid_connection) != 1:
-            raise ValueError("Expected size of list is 1")
-        else:
-            return self.grid_connection_status[grid_connection[0]]
-
-    def decode_fault_state(self, fault_state):
-        """Decode Inverter faults."""
-        self.logger.debug("[decode_fault_state] Decoding fault state raw data: {}".format(fault_state))
-        err = []
-        off = 0
-        register_number = 0
-        for register_value in fault_state:
-            for bit_number in range(16):
-                mask = 1 << bit_number
-                masked = mask & register_value
-
-                if masked:
-                    self.logger.debug("[decode_fault_state] bit number:{bit_number}".format(bit_number=bit_number))
-                    self.logger.debug("[decode_fault_state] register  :{register:016b}".format(register=register_value))
-                    self.logger.debug("[decode_fault_state] mask      :{mask:016b}".format(mask=mask))
-                    self.logger.debug("[decode_fault_state] masked    :{masked:016b}".format(masked=masked))
-                    self.logger.debug("Bit {bit_number} is SET in the regiater {register_number}, " )
-                    msg = f"F{bit_number+off+1:02} " + self.faults.get(off + mask, "")
-                    print("MSG={}".format(msg))
-                    err.append(msg.strip())
-                off = off +  16
-            register_number = register_number + 1
-        if err:
-            return ", ".join(err)
-        else:
-            return "No Errors Detected"
+    def get_read_plan(self, register_names=None):
+        """Read plan for the given register names (all well known registers by default)."""
+        return self.profile.get_read_plan(register_names)
 
-
-    def read_registers(self):
-        self.logger.debug("Starting data collecting from inverter: {}:{}".format(
-            self.stick_logger_ip,  self.port)
-        )
+    def read_registers(self, register_names=None, priority=PRIORITY_FAST_POLL):
+        self.logger.debug("Starting data collecting from inverter: %s:%s", self.stick_logger_ip, self.port)
 
 
         all_raw_registers = []
@@ -195,103 +183,395 @@ class DeyeInverter(object):
         # получив [10, 200]
         #
         # Максимальное число регистров читаемых за 1 раз - 125
-
-        self.inverter_read_raw_result_all_registers = []
-        read_start_register = 0
-        read_attempts = self.max_read_attempts
-        while read_attempts:
+        # Какие именно окна читать - определяет план чтения (см. ReadPlanner). Если переданы
+        # register_names - читаются только окна, нужные для этих регистров, остальные
+        # регистры в образе сохраняют значения прочитанные ранее
+        read_plan = self.get_read_plan(register_names)
+
+        # Повторяются только окна чтение которых не удалось, с паузой по RetryPolicy
+        # (экспоненциальный рост со случайной составляющей). Потерянный пакет стоит одного
+        # повторного запроса, а не всего цикла. После серии ошибок CircuitBreaker считает
+        # стик неисправным и запросы не отправляются до окончания его таймаута
+        #
+        # Если часть окон так и не удалось прочитать, прочитанные окна не отбрасываются:
+        # возвращается список неудачных окон, исключение - только если не прочитано ни одно окно
+        pending_windows = list(read_plan.windows)
+        # окно -> последняя ошибка его чтения, для окон которые уже не будут повторяться
+        given_up_windows = {}
+        read_windows_count = 0
+        attempt = 0
+        while pending_windows:
+            if not self.circuit_breaker.allow():
+                error = CircuitOpenError("Stick {}:{} is marked unhealthy after {} consecutive failures, retry in {:.1f} second(s)".format(
+                    self.stick_logger_ip, self.port, self.circuit_breaker.consecutive_failures,
+                    self.circuit_breaker.seconds_until_retry())
+                )
+                if not read_windows_count:
+                    raise error
+                given_up_windows.update({window: error for window in pending_windows})
+                break
+            self.logger.debug("Reading windows: %s", pending_windows)
             try:
-                modbus = pysolarmanv5.PySolarmanV5(
-                    self.stick_logger_ip, self.stick_logger_serial,
-                    port=self.port, mb_slave_id=self.mb_slave_id,
-                    verbose=self.verbose, logger=self.logger
-                    )
-                for read_number in range(1, self.inverter_registers_reads_number+1):
-                    self.logger.debug("Read number: {}. Rading registers from {} to {}".format(
-                            read_number,
-                            read_start_register,
-                            read_start_register + self.max_number_of_registers_to_read_in_request -  1
-                        )
-                    )
-                    inverter_read_raw_result = modbus.read_holding_registers(
-                        register_addr=read_start_register,
-                        quantity=self.max_number_of_registers_to_read_in_request
-                    )
-                    self.logger.debug("Read result (raw): {}".format(inverter_read_raw_result))
-                    self.inverter_read_raw_result_all_registers = self.inverter_read_raw_result_all_registers + inverter_read_raw_result
-                    read_start_register = read_start_register + self.max_number_of_registers_to_read_in_request
+                # Все окна отправляются стику сразу (не дожидаясь ответа на предыдущее окно),
+                # ответы сопоставляются с запросами по номеру последовательности V5
+                # Очередь к стику - по priority (см. BusArbiter): регулярный опрос пропускает вперед
+                # только запись, редкие опросы ждут регулярных
+                inverter_read_raw_results = self.bus.read_windows(pending_windows, return_exceptions=True, priority=priority)
+            except CONNECTION_ERRORS as E:
+                # Не удалось даже подключиться - все окна завершились этой ошибкой
+                inverter_read_raw_results = [E] * len(pending_windows)
+
+            failed_windows = []
+            for window, inverter_read_raw_result in zip(pending_windows, inverter_read_raw_results):
+                if isinstance(inverter_read_raw_result, Exception):
+                    if self.retry_policy.is_retryable(inverter_read_raw_result):
+                        failed_windows.append((window, inverter_read_raw_result))
+                    else:
+                        # Например адрес не поддерживается инвертором - повтор не поможет
+                        given_up_windows[window] = inverter_read_raw_result
+                    continue
+                self.logger.debug("Read result (raw) for registers from %s to %s: %s",
+                                  window.start, window.start + window.quantity - 1, inverter_read_raw_result)
+                self._store_window(window, inverter_read_raw_result)
+                read_windows_count = read_windows_count + 1
+
+            # Стик ответил хотя бы на одно окно - он жив, даже если часть окон не прочитана.
+            # Окна не отправленные из-за паузы перед переподключением стик не видел - это не его неудача
+            if len(failed_windows) < len(pending_windows):
+                self.circuit_breaker.record_success()
+            elif not all(isinstance(window_error, ReconnectPendingError) for window, window_error in failed_windows):
+                self.circuit_breaker.record_failure()
+            else:
+                self.circuit_breaker.release()
+            if not failed_windows:
                 break
-            except pysolarmanv5.pysolarmanv5.NoSocketAvailableError:
-                self.logger.error("pysolarmanv5.pysolarmanv5.NoSocketAvailableError: Sleeping for {sleep_on_inverter_read_error} seconds".format(
-                        sleep_on_inverter_read_error=self.sleep_on_inverter_read_error
-                    )
-                )
-                # just sleep and retry
-                time.sleep(self.sleep_on_inverter_read_error)
-                modbus = None
-                read_attempts = read_attempts -1
-            except Exception as E:
-                raise(E)
 
-        self.logger.debug("All registers are: {}".format(self.inverter_read_raw_result_all_registers))
+            attempt = attempt + 1
+            error = failed_windows[0][1]
+            if attempt >= self.retry_policy.max_attempts:
+                # Шаблон сообщения постоянный - повторяющиеся ошибки ограничиваются по частоте (RateLimitFilter)
+                self.logger.error("Error reading windows %s: %r, giving up after %s attempt(s) (connects: %s, reconnects: %s)",
+                                  [window for window, window_error in failed_windows], error, attempt,
+                                  self.connection.connect_count, self.connection.reconnect_count)
+                if not read_windows_count:
+                    raise error
+                given_up_windows.update(failed_windows)
+                break
+
+            # Пауза перед переподключением ждется здесь, без блокировки соединения и без захвата шины;
+            # если она дольше максимальной паузы повтора - окна повторятся при следующем опросе
+            reconnect_seconds = self.connection.seconds_until_reconnect()
+            if reconnect_seconds > self.retry_policy.backoff_max_seconds:
+                self.logger.error("Error reading windows %s: %r, giving up until reconnect in %.1f second(s)",
+                                  [window for window, window_error in failed_windows], error, reconnect_seconds)
+                if not read_windows_count:
+                    raise error
+                given_up_windows.update(failed_windows)
+                break
+            retry_delay = max(self.retry_policy.backoff(attempt), reconnect_seconds)
+            self.logger.error("Error reading windows %s: %r, retry %s in %.2f second(s)",
+                              [window for window, window_error in failed_windows], error, attempt, retry_delay)
+            if self.metrics:
+                self.metrics.retries.inc(len(failed_windows))
+            time.sleep(retry_delay)
+            pending_windows = [window for window, window_error in failed_windows]
+
+        if given_up_windows and not read_windows_count:
+            raise next(iter(given_up_windows.values()))
+        if given_up_windows:
+            self.logger.error("Windows %s were not read, keeping the other %s window(s)",
+                              list(given_up_windows), read_windows_count)
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("All registers are: %s", self.inverter_read_raw_result_all_registers)
+        return list(given_up_windows)
+
+    @property
+    def inverter_read_raw_result_all_registers(self):
+        """Raw image as a list, None for registers which were never read."""
+        return [value if valid else None for value, valid in zip(self.register_values, self.register_valid)]
+
+    def load_image(self, image):
+        """Replace the raw image with image (list, None for registers which were not read)."""
+        for address in range(min(len(image), len(self.register_values))):
+            value = image[address]
+            if value is None:
+                if self.register_valid[address]:
+                    self.register_valid[address] = 0
+                    self.changed_registers.update(self.register_names_by_address.get(address, ()))
+            elif (not self.register_valid[address]) or (self.register_values[address] != value):
+                self.register_values[address] = value
+                self.register_valid[address] = 1
+                self.changed_registers.update(self.register_names_by_address.get(address, ()))
+
+    def _store_window(self, window, values):
+        start = window.start
+        end = window.start + window.quantity
+        new_values = array('H', values)
+        read_at = time.monotonic()
+        # Сравнение окна целиком (на уровне буфера) - обычно большинство окон не меняется
+        # между опросами и нужно обновить только время чтения
+        if (self.register_values[start:end] != new_values) or (0 in self.register_valid[start:end]):
+            for offset in range(window.quantity):
+                address = start + offset
+                if (not self.register_valid[address]) or (self.register_values[address] != new_values[offset]):
+                    register_names = self.register_names_by_address.get(address)
+                    if register_names:
+                        self.changed_registers.update(register_names)
+            self.register_values[start:end] = new_values
+            self.register_valid[start:end] = b'\x01' * window.quantity
+        # Время чтения записывается последним: читатель образа без блокировки (ModbusTcpServer)
+        # не примет старое значение за свежее
+        self.register_read_at[start:end] = array('d', (read_at,)) * window.quantity
+
+    def registers_read_since(self, since):
+        """Flags of the raw image (bytes, 1 per register) of registers read not earlier than since (time.monotonic())."""
+        return bytes(read_at >= since for read_at in self.register_read_at)
+
+    def registers_read(self, register_names=None):
+        """Names of registers (of register_names, all by default) which have values in the raw image."""
+        if register_names is None:
+            register_names = self.well_known_registers
+        result = []
+        for register_name in register_names:
+            register_details = self.well_known_registers[register_name]
+            register_id = register_details['id']
+            register_valid = self.register_valid[register_id:register_id + register_details.get('quantity', 1)]
+            if register_valid and (0 not in register_valid):
+                result.append(register_name)
+        return result
+
+    def registers_in_windows(self, windows, register_names=None):
+        """Names of registers (of register_names, all by default) which overlap any of windows."""
+        if register_names is None:
+            register_names = self.well_known_registers
+        result = []
+        for register_name in register_names:
+            register_details = self.well_known_registers[register_name]
+            first = register_details['id']
+            last = first + register_details.get('quantity', 1) - 1
+            for window in windows:
+                if (first < window.start + window.quantity) and (last >= window.start):
+                    result.append(register_name)
+                    break
+        return result
+
+    def close(self):
+        self.connection.close()
+
+    def decode_register_images(self, images, valid=None):
+        """Vectorized decode of many raw register images at once, see ColumnarDecoder.decode()."""
+        if self._columnar_decoder is None:
+            self._columnar_decoder = ColumnarDecoder(
+                self.well_known_registers, default_decoder=self.default_simple_decoder, decode_value=self.decode_value
+            )
+        return self._columnar_decoder.decode(images, valid)
+
+    def decode_value(self, register_details, register_value):
+        """Human readable value of a register from its raw words."""
+        # Если определен метод декодирования то использовать его для декодирования результата,
+        # если нет то использовать метод by default.
+        decode_method = register_details.get('decode_method', self.default_simple_decoder)
+        decoded_result = decode_method(register_value)
+        if register_details.get('signed', False) and decoded_result >= 0x8000:
+            decoded_result = decoded_result - 0x10000
+
+        # В зависимости от типа данных нужно или посчитать смещение/масштаб/округление
+        # или не делать ничего если результат - безразмерный, это значит что это текстовая строка
+        if ( register_details['units'] in ['C', 'V', '%', 'A', 'Hz', 'W'] ):
+            # Если есть множитель - домножить на него, если не определен то домножить на 1
+            scale = register_details.get('scale', 1)
+            # Если точка отсчета не 0 - то сместить на соответвующее число
+            offset = register_details.get('offset', 0)
+            # получить человекочитаемый результат масштабированием и смещением
+            human_readable_result = decoded_result * scale + offset
+
+            # Округлить, если требуется
+            do_rounding = register_details.get('do_rounding', False)
+            if do_rounding:
+                human_readable_result = round(human_readable_result)
+        else:
+            human_readable_result = decoded_result
+        return human_readable_result
+
+    def encode_value(self, register_name, value):
+        """Raw word to write into a writable register for a human readable value.
+
+        Raises ValueError if the register is not writable, the value is not a
+        number, is outside of the register min/max or does not fit a register.
+        """
+        register_details = self.well_known_registers.get(register_name)
+        if (register_details is None) or (not register_details.get('writable', False)):
+            raise ValueError("Register {} is not writable".format(register_name))
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError("Value of {} must be a number, got {!r}".format(register_name, value))
+        if ('min' in register_details and value < register_details['min']) or \
+                ('max' in register_details and value > register_details['max']):
+            raise ValueError("Value of {} must be in {}..{}, got {}".format(
+                register_name, register_details.get('min'), register_details.get('max'), value)
+            )
+        raw_value = int(round((value - register_details.get('offset', 0)) / register_details.get('scale', 1)))
+        if register_details.get('signed', False) and -0x8000 <= raw_value < 0:
+            raw_value = raw_value + 0x10000
+        if not 0 <= raw_value <= 0xFFFF:
+            raise ValueError("Value {} of {} does not fit the register".format(value, register_name))
+        return raw_value
+
+    def writable_values(self, register_addr, raw_values):
+        """[(register name, human readable value)] of a raw write of raw_values from register_addr.
+
+        Raises ValueError unless every address is a writable register of the
+        profile and every value is allowed for it (see encode_value).
+        """
+        register_names_by_id = {
+            register_details['id']: register_name for register_name, register_details in self.well_known_registers.items()
+            if register_details.get('writable', False) and register_details.get('quantity', 1) == 1
+        }
+        values = []
+        for offset, raw_value in enumerate(raw_values):
+            register_name = register_names_by_id.get(register_addr + offset)
+            if register_name is None:
+                raise ValueError("Register {} is not writable".format(register_addr + offset))
+            register_details = self.well_known_registers[register_name]
+            if register_details.get('signed', False) and raw_value >= 0x8000:
+                raw_value = raw_value - 0x10000
+            value = raw_value * register_details.get('scale', 1) + register_details.get('offset', 0)
+            if isinstance(value, float) and value.is_integer():
+                value = int(value)
+            # Проверка min/max и того, что значение записывается тем же словом
+            if self.encode_value(register_name, value) != raw_values[offset]:
+                raise ValueError("Value {} of {} can not be written exactly".format(raw_values[offset], register_name))
+            values.append((register_name, value))
+        return values
+
+    def read_holding_registers(self, register_addr, quantity, priority=PRIORITY_SCAN):
+        """Ad-hoc read of raw registers (not stored into the image), with scan priority on the bus."""
+        self._check_stick_available()
+        with self._circuit_breaker_outcome():
+            return self.bus.read_holding_registers(register_addr, quantity, priority=priority)
+
+    def write_holding_registers(self, register_addr, values):
+        """Ad-hoc write of raw registers (not checked against the profile), with write priority on the bus."""
+        self._check_stick_available()
+        with self._circuit_breaker_outcome():
+            return self.bus.write_multiple_holding_registers(register_addr, values, priority=PRIORITY_WRITE)
+
+    def _check_stick_available(self):
+        if not self.circuit_breaker.allow():
+            raise CircuitOpenError("Stick {}:{} is marked unhealthy, retry in {:.1f} second(s)".format(
+                self.stick_logger_ip, self.port, self.circuit_breaker.seconds_until_retry())
+            )
+        # Разовый запрос не ждет паузы перед переподключением к стику (и не занимает шину на это время)
+        reconnect_seconds = self.connection.seconds_until_reconnect()
+        if reconnect_seconds > 0:
+            self.circuit_breaker.release()
+            raise ReconnectPendingError("Stick {}:{} is not connected, reconnect in {:.1f} second(s)".format(
+                self.stick_logger_ip, self.port, reconnect_seconds), reconnect_seconds
+            )
 
-    def decode_registers(self):
+    @contextlib.contextmanager
+    def _circuit_breaker_outcome(self):
+        # Результат разового запроса к стику учитывается в CircuitBreaker так же как опрос
+        try:
+            yield
+        except ReconnectPendingError:
+            # Запрос не дошел до стика - это не его неудача
+            self.circuit_breaker.release()
+            raise
+        except CONNECTION_ERRORS:
+            self.circuit_breaker.record_failure()
+            raise
+        except Exception:
+            # Например исключение Modbus: инвертор ответил, значит стик жив
+            self.circuit_breaker.record_success()
+            raise
+        self.circuit_breaker.record_success()
+
+    def write_register(self, register_name, value):
+        """Write a human readable value into a writable register and read it back.
+
+        Uses the polling session, write and read back are one exchange with
+        the highest priority on the bus.
+        Returns (written raw word, raw word read back, read back human readable value).
+        """
+        raw_value = self.encode_value(register_name, value)
+        self._check_stick_available()
+        register_details = self.well_known_registers[register_name]
+        with self._circuit_breaker_outcome():
+            with self.bus.acquire(PRIORITY_WRITE, 2) as connection:
+                connection.write_multiple_holding_registers(register_details['id'], [raw_value])
+                read_back = connection.read_holding_registers(register_details['id'], 1)
+        return raw_value, read_back[0], self.decode_value(register_details, read_back)
+
+    def decode_registers(self, register_names=None):
+        decode_started_at = time.monotonic()
+        # Проверка уровня один раз на вызов, а не для каждого регистра
+        debug_enabled = self.logger.isEnabledFor(logging.DEBUG)
         output = {}
-        for register_name, register_details in self.well_known_registers.items():
+        if register_names is None:
+            register_names = self.well_known_registers
+        for register_name in register_names:
+            register_details = self.well_known_registers[register_name]
             register_id = register_details['id']
 
             try:
                 quantity = register_details.get('quantity', 1)
-                register_value = self.inverter_read_raw_result_all_registers[register_id:register_id+quantity]
-                self.logger.debug("Decoding register id {}, register name: {}, register value (raw): {}".format(
-                        register_id,
-                        register_name,
-                        register_value
-                    )
-                )
-                # Если определен метод декодирования то использовать его для декодирования результата,
-                # если нет то использовать метод by default.
-                decode_method = register_details.get('decode_method', self.default_simple_decoder)
-                decoded_result = decode_method(register_value)
-
-
-                # В зависимости от типа данных нужно или посчитать смещение/масштаб/округление
-                # или не делать ничего если результат - безразмерный, это значит что это текстовая строка
-                if ( register_details['units'] in ['C', 'V', '%', 'A', 'Hz', 'W'] ):
-                    # Если есть множитель - домножить на него, если не определен то домножить на 1
-                    scale = register_details.get('scale', 1)
-                    # Если точка отсчета не 0 - то сместить на соответвующее число
-                    offset = register_details.get('offset', 0)
-                    # получить человекочитаемый результат масштабированием и смещением
-                    human_readable_result = decoded_result * scale + offset
-
-                    # Округлить, если требуется
-                    do_rounding = register_details.get('do_rounding', False)
-                    if do_rounding:
-                        human_readable_result = round(human_readable_result)
-                else:
-                    human_readable_result = decoded_result
-
-                self.logger.info("Decoding register id {}, register name: {}, register value (decoded): {} {}".format(
-                        register_id,
-                        register_name,
-                        human_readable_result,
-                        register_details['units']
-                    )
-                )
+                register_value = self.register_values[register_id:register_id+quantity]
+                if (len(register_value) != quantity) or (0 in self.register_valid[register_id:register_id+quantity]):
+                    raise ValueError("Register {} was not read".format(register_id))
+                if debug_enabled:
+                    self.logger.debug("Decoding register id %s, register name: %s, register value (raw): %s",
+                                      register_id, register_name, register_value)
+                human_readable_result = self.decode_value(register_details, register_value)
+
+                if debug_enabled:
+                    self.logger.debug("Decoding register id %s, register name: %s, register value (decoded): %s %s",
+                                      register_id, register_name, human_readable_result, register_details['units'])
                 output[register_name] = {}
                 output[register_name]['value'] = human_readable_result
                 output[register_name]['units'] = register_details['units']
+                self.decoded_registers[register_name] = output[register_name]
             except Exception as E:
-                self.logger.error("Exception {} for register {}, skipping register".format(E, register_name))
+                self.decoded_registers.pop(register_name, None)
+                self.logger.error("Exception %s for register %s, skipping register", E, register_name)
                 pass
 
 
+        if self.metrics:
+            self.metrics.decode_seconds.observe(time.monotonic() - decode_started_at)
 
-        message = json.dumps(output, indent=4)
-        self.logger.info(message)
+        if debug_enabled:
+            self.logger.debug("Decoded registers: %s", json.dumps(output))
         return output
 
+    def decode_changed_registers(self, register_names=None):
+        """Decode only registers whose raw words changed since they were decoded last time.
+
+        Returns (data, changed): data has the decoded value of every register of
+        register_names (all by default) which could be decoded, taking unchanged
+        ones from the previous decode; changed - names whose decoded value changed.
+        """
+        if register_names is None:
+            register_names = self.well_known_registers
+        registers_to_decode = [
+            register_name for register_name in register_names
+            if (register_name in self.changed_registers) or (register_name not in self.decoded_registers)
+        ]
+        changed = []
+        if registers_to_decode:
+            previous_values = {register_name: self.decoded_registers.get(register_name) for register_name in registers_to_decode}
+            self.decode_registers(registers_to_decode)
+            self.changed_registers.difference_update(registers_to_decode)
+            changed = [
+                register_name for register_name in registers_to_decode
+                if (register_name in self.decoded_registers) and (self.decoded_registers[register_name] != previous_values[register_name])
+            ]
+        data = {
+            register_name: self.decoded_registers[register_name]
+            for register_name in register_names if register_name in self.decoded_registers
+        }
+        return data, changed
+
 #            except pysolarmanv5.pysolarmanv5.NoSocketAvailableError:
 #                self.logger.error("pysolarmanv5.pysolarmanv5.NoSocketAvailableError: Sleeping for {sleep_on_inverter_read_error} seconds".format(sleep_on_inverter_read_error=sleep_on_inverter_read_error))
 #                # just sleep and retry
@@ -0,0 +1,283 @@
+import asyncio
+import os
+import random
+import select
+import struct
+import threading
+import time
+import pysolarmanv5
+try:
+    import serial
+except ImportError:
+    serial = None
+from . import modbus_rtu
+from .logger import getLogger
+from .solarman_v5 import (
+    read_v5_frame, encode_v5_frame,
+    V5_HEADER_LENGTH, V5_TRAILER_LENGTH, V5_REQUEST_CONTROL_CODE, V5_RESPONSE_CONTROL_CODE,
+    V5_REQUEST_PAYLOAD_PREFIX, V5_RESPONSE_PAYLOAD_PREFIX,
+)
+
+
+# Коды исключений Modbus которые возвращает эмулятор
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_DATA_ADDRESS = 0x02
+
+
+def default_register_value(register_addr):
+    # По-умолчанию значение регистра равно его адресу - так в данных легко увидеть сдвиг окна
+    return register_addr & 0xFFFF
+
+
+class SolarmanV5Emulator(object):
+    """Solarman V5 logger stick emulator serving a register image over TCP.
+
+    Serves Modbus read holding registers (0x03) and write multiple registers
+    (0x10) from register_image ({address: value}, addresses which are not in
+    it return default_value(address)). Faults of real sticks can be injected
+    (and changed while the emulator runs):
+      latency_seconds, latency_jitter_seconds - delay of every reply;
+      loss_probability - the request is silently not answered;
+      drop_probability - the connection is closed instead of the reply;
+      max_sockets - connections above this number are closed at once (the
+                    client gets NoSocketAvailableError);
+      refuse_connections - every new connection is closed at once.
+    The emulator runs its own event loop thread: start() / stop().
+    """
+
+    def __init__(self, stick_logger_serial, host='127.0.0.1', port=8899, mb_slave_id=1,
+                 register_image=None, register_count=0x10000, default_value=default_register_value,
+                 latency_seconds=0.0, latency_jitter_seconds=0.0, loss_probability=0.0, drop_probability=0.0,
+                 max_sockets=None, refuse_connections=False, seed=None, logger=None):
+        self.stick_logger_serial = stick_logger_serial
+        self.host = host
+        self.port = port
+        self.mb_slave_id = mb_slave_id
+        self.register_image = dict(register_image or {})
+        self.register_count = register_count
+        self.default_value = default_value
+        self.latency_seconds = latency_seconds
+        self.latency_jitter_seconds = latency_jitter_seconds
+        self.loss_probability = loss_probability
+        self.drop_probability = drop_probability
+        self.max_sockets = max_sockets
+        self.refuse_connections = refuse_connections
+        self.random = random.Random(seed)
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = getLogger("SolarmanV5Emulator")
+
+        # Счетчики для проверки поведения клиента
+        self.requests_count = 0
+        self.replies_count = 0
+        self.lost_count = 0
+        self.dropped_count = 0
+        self.refused_count = 0
+        self.connections_count = 0
+        self.open_connections = 0
+
+        self.loop = None
+        self._server = None
+        self._loop_thread = None
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self.loop.run_forever, name='solarman_v5_emulator', daemon=True)
+        self._loop_thread.start()
+        asyncio.run_coroutine_threadsafe(self._start_server(), self.loop).result(10)
+        # Если был передан порт 0 - узнать выбранный системой порт
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def stop(self):
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._stop_server(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._loop_thread.join(5)
+        self.loop.close()
+        self.loop = None
+
+    async def _start_server(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+
+    async def _stop_server(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle_connection(self, reader, writer):
+        if self.refuse_connections or ((self.max_sockets is not None) and (self.open_connections >= self.max_sockets)):
+            self.refused_count = self.refused_count + 1
+            writer.close()
+            return
+        self.connections_count = self.connections_count + 1
+        self.open_connections = self.open_connections + 1
+        try:
+            while True:
+                frame, control_code, sequence_number, logger_serial = await read_v5_frame(reader)
+                if (control_code != V5_REQUEST_CONTROL_CODE) or (logger_serial != self.stick_logger_serial):
+                    continue
+                self.requests_count = self.requests_count + 1
+                modbus_request = bytes(frame[V5_HEADER_LENGTH + len(V5_REQUEST_PAYLOAD_PREFIX):-V5_TRAILER_LENGTH])
+
+                if self.loss_probability and (self.random.random() < self.loss_probability):
+                    self.lost_count = self.lost_count + 1
+                    continue
+                if self.drop_probability and (self.random.random() < self.drop_probability):
+                    self.dropped_count = self.dropped_count + 1
+                    break
+
+                modbus_response = self._modbus_response(modbus_request)
+                if modbus_response is None:
+                    continue
+                # Ответ отправляется отдельной задачей - запросы конвейера обрабатываются
+                # параллельно, как и задержки ответов
+                asyncio.get_running_loop().create_task(
+                    self._reply(writer, sequence_number, modbus_response, self._reply_delay())
+                )
+        except (asyncio.IncompleteReadError, ConnectionError, pysolarmanv5.V5FrameError):
+            pass
+        finally:
+            self.open_connections = self.open_connections - 1
+            writer.close()
+
+    def _reply_delay(self):
+        delay = self.latency_seconds
+        if self.latency_jitter_seconds:
+            delay = delay + self.random.uniform(0, self.latency_jitter_seconds)
+        return delay
+
+    async def _reply(self, writer, sequence_number, modbus_response, delay):
+        if delay:
+            await asyncio.sleep(delay)
+        if writer.is_closing():
+            return
+        writer.write(encode_v5_frame(
+            self.stick_logger_serial, sequence_number, modbus_response,
+            control_code=V5_RESPONSE_CONTROL_CODE, payload_prefix=V5_RESPONSE_PAYLOAD_PREFIX
+        ))
+        self.replies_count = self.replies_count + 1
+
+    def _modbus_response(self, modbus_request):
+        if (len(modbus_request) < 8) or (not modbus_rtu.check_crc(modbus_request)):
+            return None
+        slave_id, function_code, register_addr, quantity = struct.unpack_from('>BBHH', modbus_request, 0)
+        if slave_id != self.mb_slave_id:
+            return None
+
+        if function_code == modbus_rtu.READ_HOLDING_REGISTERS:
+            if (not 1 <= quantity <= 125) or (register_addr + quantity > self.register_count):
+                return self._modbus_exception(function_code, ILLEGAL_DATA_ADDRESS)
+            values = [
+                self.register_image.get(address, self.default_value(address)) & 0xFFFF
+                for address in range(register_addr, register_addr + quantity)
+            ]
+            return modbus_rtu.add_crc(struct.pack(
+                '>BBB{}H'.format(quantity), slave_id, function_code, quantity * 2, *values
+            ))
+
+        if function_code == modbus_rtu.WRITE_MULTIPLE_REGISTERS:
+            byte_count = modbus_request[6]
+            if (not 1 <= quantity <= 123) or (byte_count != quantity * 2) or \
+                    (register_addr + quantity > self.register_count):
+                return self._modbus_exception(function_code, ILLEGAL_DATA_ADDRESS)
+            values = struct.unpack_from('>{}H'.format(quantity), modbus_request, 7)
+            for offset, value in enumerate(values):
+                self.register_image[register_addr + offset] = value
+            return modbus_rtu.add_crc(modbus_request[:6])
+
+        return self._modbus_exception(function_code, ILLEGAL_FUNCTION)
+
+    def _modbus_exception(self, function_code, exception_code):
+        return modbus_rtu.add_crc(struct.pack('>BBB', self.mb_slave_id, function_code | 0x80, exception_code))
+
+
+class ModbusRtuEmulator(SolarmanV5Emulator):
+    """Modbus RTU slave emulator on a serial line, for the RS485 transport.
+
+    Serves the same register image (and injects the same latency and loss
+    faults) as SolarmanV5Emulator, but as plain Modbus RTU frames on a serial
+    device opened with pyserial, or on a file descriptor - e.g. the master
+    side of a pty pair (os.openpty()) whose slave side is opened by
+    SerialModbusClient. The emulator runs its own thread: start() / stop().
+    """
+
+    def __init__(self, device=None, fd=None, mb_slave_id=1, baudrate=9600, **kwargs):
+        super(ModbusRtuEmulator, self).__init__(None, mb_slave_id=mb_slave_id, **kwargs)
+        if (device is None) == (fd is None):
+            raise ValueError("Either device or fd must be set")
+        self.device = device
+        self.fd = fd
+        self.baudrate = baudrate
+        self._serial = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.device is not None:
+            if serial is None:
+                raise RuntimeError("pyserial is required to open {}".format(self.device))
+            self._serial = serial.Serial(self.device, baudrate=self.baudrate, timeout=0)
+            self.fd = self._serial.fileno()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._serve, name='modbus_rtu_emulator', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join(5)
+        self._thread = None
+        if self._serial is not None:
+            self._serial.close()
+            self._serial = None
+
+    def _serve(self):
+        buffer = bytearray()
+        while not self._stopped.is_set():
+            if not select.select([self.fd], [], [], 0.1)[0]:
+                # Тишина на линии - недочитанный кадр уже не будет дописан
+                buffer.clear()
+                continue
+            try:
+                data = os.read(self.fd, 512)
+            except OSError:
+                # pty: другая сторона еще не открыта или уже закрыта
+                time.sleep(0.1)
+                continue
+            buffer.extend(data)
+            while True:
+                length = self._request_length(buffer)
+                if (length is None) or (len(buffer) < length):
+                    break
+                modbus_request = bytes(buffer[:length])
+                del buffer[:length]
+                self.requests_count = self.requests_count + 1
+                if self.loss_probability and (self.random.random() < self.loss_probability):
+                    self.lost_count = self.lost_count + 1
+                    continue
+                modbus_response = self._modbus_response(modbus_request)
+                if modbus_response is None:
+                    continue
+                delay = self._reply_delay()
+                if delay:
+                    time.sleep(delay)
+                os.write(self.fd, modbus_response)
+                self.replies_count = self.replies_count + 1
+
+    @staticmethod
+    def _request_length(buffer):
+        # Длина запроса известна по коду функции, None - пока не известна
+        if len(buffer) < 2:
+            return None
+        if buffer[1] == modbus_rtu.READ_HOLDING_REGISTERS:
+            return 8
+        if buffer[1] == modbus_rtu.WRITE_MULTIPLE_REGISTERS:
+            if len(buffer) < 7:
+                return None
+            return 9 + buffer[6]
+        # Неподдерживаемая функция: длина кадра не известна, кадр отбросит тишина на линии
+        return None
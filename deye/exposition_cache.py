@@ -0,0 +1,124 @@
+import gzip
+import hashlib
+import threading
+import time
+from collections import namedtuple
+import prometheus_client
+import prometheus_client.openmetrics.exposition
+from .logger import getLogger
+
+
+PROMETHEUS_CONTENT_TYPE = prometheus_client.CONTENT_TYPE_LATEST
+OPENMETRICS_CONTENT_TYPE = prometheus_client.openmetrics.exposition.CONTENT_TYPE_LATEST
+
+# Готовое к отдаче представление метрик в одном формате
+RenderedExposition = namedtuple('RenderedExposition', ['body', 'gzip_body', 'etag', 'gzip_etag', 'content_type'])
+
+
+class _SnapshotCollector(object):
+    # Коллектор для одного конкретного снимка: collect_snapshot(snapshot) вызывается
+    # при рендеринге, а не при каждом обращении Prometheus
+    def __init__(self, collector, snapshot):
+        self.collector = collector
+        self.snapshot = snapshot
+
+    def collect(self):
+        return self.collector.collect_snapshot(self.snapshot)
+
+
+class _RegistryCollector(object):
+    # Все метрики другого реестра (например метрики самого экспортера)
+    def __init__(self, registry):
+        self.registry = registry
+
+    def collect(self):
+        return self.registry.collect()
+
+
+class ExpositionCache(object):
+    """Exposition text rendered once per snapshot version.
+
+    A background thread waits for new snapshot versions in snapshot_store and
+    renders the metrics of collector.collect_snapshot(snapshot) in Prometheus
+    text and OpenMetrics formats, plain and gzip'd. Scrapes are served from
+    the rendered bytes with get(), independently of collection work. The
+    exposition is also re-rendered every rerender_seconds without a new
+    version, because staleness checks depend on the current time. Renders
+    are at least min_render_interval_seconds apart: versions created in
+    between (every poll of every inverter creates one) are rendered once, as
+    the latest of them. Metrics of registry (if it is set) are rendered into
+    the same exposition.
+    """
+
+    def __init__(self, snapshot_store, collector, registry=None, rerender_seconds=15, min_render_interval_seconds=1,
+                 logger=None):
+        self.snapshot_store = snapshot_store
+        self.collector = collector
+        self.registry = registry
+        self.rerender_seconds = rerender_seconds
+        self.min_render_interval_seconds = min_render_interval_seconds
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = getLogger("ExpositionCache")
+        self.version = None
+        # Число рендерингов и затраченное на них время (для мониторинга и benchmark.py)
+        self.renders_count = 0
+        self.render_seconds = 0.0
+        self._expositions = {}
+        self.render(self.snapshot_store.latest())
+
+    def start(self):
+        thread = threading.Thread(target=self._render_loop, name='exposition_cache_thread', daemon=True)
+        thread.start()
+        return thread
+
+    def get(self, openmetrics=False):
+        # Словарь заменяется целиком при рендеринге, так что чтение не требует блокировок
+        expositions = self._expositions
+        if openmetrics:
+            return expositions['openmetrics']
+        return expositions['prometheus']
+
+    def render(self, snapshot):
+        started_at = time.monotonic()
+        registry = prometheus_client.CollectorRegistry(auto_describe=False)
+        registry.register(_SnapshotCollector(self.collector, snapshot))
+        if self.registry is not None:
+            registry.register(_RegistryCollector(self.registry))
+        self._expositions = {
+            'prometheus': self._make_exposition(
+                prometheus_client.generate_latest(registry), PROMETHEUS_CONTENT_TYPE
+            ),
+            'openmetrics': self._make_exposition(
+                prometheus_client.openmetrics.exposition.generate_latest(registry), OPENMETRICS_CONTENT_TYPE
+            ),
+        }
+        self.version = snapshot.version
+        self.renders_count = self.renders_count + 1
+        self.render_seconds = self.render_seconds + (time.monotonic() - started_at)
+
+    @staticmethod
+    def _make_exposition(body, content_type):
+        # ETag зависит только от содержимого: если после повторного рендеринга метрики
+        # не изменились, клиент с If-None-Match получит 304. У сжатого представления свой ETag
+        digest = hashlib.sha1(body).hexdigest()
+        return RenderedExposition(
+            body, gzip.compress(body, compresslevel=6),
+            '"{}"'.format(digest), '"{}-gzip"'.format(digest), content_type
+        )
+
+    def _render_loop(self):
+        rendered_at = time.monotonic()
+        while True:
+            try:
+                # Версии, появившиеся за паузу, рендерятся один раз - как последняя из них
+                wait_seconds = rendered_at + self.min_render_interval_seconds - time.monotonic()
+                if wait_seconds > 0:
+                    time.sleep(wait_seconds)
+                snapshot = self.snapshot_store.wait_for_newer(self.version, timeout=self.rerender_seconds)
+                rendered_at = time.monotonic()
+                self.render(snapshot)
+                self.logger.debug("[ExpositionCache] Rendered version %s", snapshot.version)
+            except Exception as E:
+                self.logger.error("[ExpositionCache] Render failed: %r", E)
@@ -0,0 +1,98 @@
+import time
+
+
+EVENT_SET = 'set'
+EVENT_CLEARED = 'cleared'
+NO_ERRORS = "No Errors Detected"
+
+
+class FaultDecoder(object):
+    """Decodes the inverter fault bitmap into fault codes.
+
+    Bit b of fault word w is fault F(16 * w + b + 1), descriptions are taken
+    from faults ({code number: description}). Every byte of the bitmap is
+    looked up in a precomputed table (byte position, byte value) -> codes,
+    so decoding does not depend on the number of set bits, and all-zero words
+    (no faults - the usual case) cost nothing.
+    """
+
+    def __init__(self, faults, words=4, event_log_length=100):
+        self.faults = dict(faults)
+        self.words = words
+        self.event_log_length = event_log_length
+        self._byte_tables = tuple(
+            tuple(
+                tuple(byte_number * 8 + bit_number + 1 for bit_number in range(8) if byte_value & (1 << bit_number))
+                for byte_value in range(256)
+            )
+            for byte_number in range(words * 2)
+        )
+        # Набор кодов -> строка описания, набор активных ошибок меняется редко
+        self._descriptions = {}
+
+    def codes(self, fault_words):
+        """Set of fault code numbers set in fault_words."""
+        codes = ()
+        byte_tables = self._byte_tables
+        for word_number, word in enumerate(fault_words):
+            if word:
+                codes = codes + byte_tables[2 * word_number][word & 0xFF] + byte_tables[2 * word_number + 1][word >> 8]
+        return frozenset(codes)
+
+    def code_name(self, code):
+        return "F{:02}".format(code)
+
+    def description(self, code):
+        return self.faults.get(code, "")
+
+    def describe(self, codes):
+        """'F13 Working mode change, F35 No AC grid' or 'No Errors Detected'."""
+        description = self._descriptions.get(codes)
+        if description is None:
+            description = ", ".join(
+                "{} {}".format(self.code_name(code), self.description(code)).strip() for code in sorted(codes)
+            ) or NO_ERRORS
+            if len(self._descriptions) < 1024:
+                self._descriptions[codes] = description
+        return description
+
+    def decode(self, fault_words):
+        if len(fault_words) != self.words:
+            raise ValueError("Expected size of list is {}".format(self.words))
+        return self.describe(self.codes(fault_words))
+
+    def merge(self, previous_faults, codes, now=None):
+        """New fault state of an inverter after fault codes were read.
+
+        previous_faults - previous result of merge (None at start, then every
+        active fault is reported as set). Returns {'codes': [code numbers],
+        'active': {'F13': description}, 'events': {'F13': {'set': N,
+        'cleared': M}} (counters since start), 'log': [last event_log_length
+        events], 'last_event_number': N}, an event is {'number', 'timestamp',
+        'code', 'description', 'event'}.
+        """
+        if now is None:
+            now = time.time()
+        previous_codes = frozenset(previous_faults['codes']) if previous_faults else frozenset()
+        if previous_faults and previous_codes == codes:
+            return previous_faults
+        events = {code_name: dict(counters) for code_name, counters in (previous_faults['events'] if previous_faults else {}).items()}
+        event_log = list(previous_faults['log']) if previous_faults else []
+        last_event_number = previous_faults['last_event_number'] if previous_faults else 0
+        for event, event_codes in ((EVENT_SET, codes - previous_codes), (EVENT_CLEARED, previous_codes - codes)):
+            for code in sorted(event_codes):
+                code_name = self.code_name(code)
+                counters = events.setdefault(code_name, {EVENT_SET: 0, EVENT_CLEARED: 0})
+                counters[event] = counters[event] + 1
+                last_event_number = last_event_number + 1
+                event_log.append({
+                    'number': last_event_number, 'timestamp': now, 'code': code_name,
+                    'description': self.description(code), 'event': event,
+                })
+        return {
+            'codes': sorted(codes),
+            'active': {self.code_name(code): self.description(code) for code in sorted(codes)},
+            'events': events,
+            'log': event_log[-self.event_log_length:],
+            'last_event_number': last_event_number,
+        }
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import threading
+from .logger import getLogger
+
+
+# Единицы измерения регистров -> (device_class, unit_of_measurement) Home Assistant
+UNIT_DEVICE_CLASSES = {
+    'C':  ('temperature', '°C'),
+    'V':  ('voltage',     'V'),
+    'A':  ('current',     'A'),
+    'Hz': ('frequency',   'Hz'),
+    'W':  ('power',       'W'),
+    '%':  ('battery',     '%'),
+}
+
+
+class HomeAssistantDiscovery(object):
+    """Home Assistant MQTT discovery configs generated from the register table.
+
+    Configs are published retained when the MQTT session connects. A sha256
+    of every config acknowledged by the broker (PUBACK) is kept and saved to
+    state_file when it is set, so unchanged configs are not republished on
+    reconnect and restart; state_file must be on persistent storage (not
+    /tmp) for the latter. All configs are re-announced when Home Assistant
+    sends its birth message to status_topic.
+    """
+
+    def __init__(self, mqtt_publisher, discovery_prefix='homeassistant', status_topic='homeassistant/status',
+                 state_file=None, logger=None):
+        self.mqtt_publisher = mqtt_publisher
+        self.discovery_prefix = discovery_prefix
+        self.status_topic = status_topic
+        self.state_file = state_file
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = getLogger("HomeAssistantDiscovery")
+
+        # топик конфигурации -> payload (все конфигурации которые нужно анонсировать)
+        self.configs = {}
+        # топик конфигурации -> sha256 опубликованного payload, подтвержденного брокером
+        self.published_hashes = self._load_state()
+        # топик конфигурации -> sha256 отправленного payload, подтверждения которого еще нет
+        self._unacked_hashes = {}
+        self._lock = threading.Lock()
+
+    def add_inverter(self, inverter_name, registers, state_topic=None, field_topic=None, availability_topic=None):
+        """Generate configs for all registers of an inverter.
+
+        Either state_topic (one JSON message with all fields) or field_topic
+        (one topic per field, '{field}' is replaced with the register name) is used.
+        """
+        for register_name, register_details in registers.items():
+            config = {
+                'name': register_name.replace('_', ' ').capitalize(),
+                'object_id': '{}_{}'.format(inverter_name, register_name),
+                'unique_id': '{}_{}'.format(inverter_name, register_name),
+                'device': {
+                    'identifiers': [inverter_name],
+                    'manufacturer': 'Deye',
+                    'name': 'Deye {}'.format(inverter_name),
+                },
+            }
+            if field_topic:
+                config['state_topic'] = field_topic.format(inverter=inverter_name, field=register_name)
+                config['value_template'] = '{{ value_json }}'
+            else:
+                config['state_topic'] = state_topic.format(inverter=inverter_name)
+                config['value_template'] = '{{{{ value_json.{} }}}}'.format(register_name)
+            if availability_topic:
+                config['availability_topic'] = availability_topic
+
+            units = register_details['units']
+            if units in UNIT_DEVICE_CLASSES:
+                config['device_class'], config['unit_of_measurement'] = UNIT_DEVICE_CLASSES[units]
+                config['state_class'] = 'measurement'
+
+            topic = '{}/sensor/{}/{}/config'.format(self.discovery_prefix, inverter_name, register_name)
+            self.configs[topic] = json.dumps(config, sort_keys=True, ensure_ascii=False)
+
+    def start(self):
+        # Home Assistant публикует 'online' в status_topic при старте - тогда все конфигурации
+        # нужно анонсировать заново, даже если они не изменились.
+        # Анонс - при каждом подключении сессии MQTT (до подключения публиковать некуда)
+        self.mqtt_publisher.subscribe(self.status_topic, self._on_status)
+        self.mqtt_publisher.add_connect_callback(self.announce)
+
+    def announce(self, force=False):
+        to_publish = []
+        with self._lock:
+            for topic, payload in self.configs.items():
+                payload_hash = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+                if (not force) and payload_hash in (self.published_hashes.get(topic), self._unacked_hashes.get(topic)):
+                    continue
+                self._unacked_hashes[topic] = payload_hash
+                to_publish.append((topic, payload, payload_hash))
+        # Публикация - без блокировки: подтверждение может прийти (и взять блокировку) раньше,
+        # чем publish() вернет управление
+        for topic, payload, payload_hash in to_publish:
+            self.mqtt_publisher.publish(
+                topic, payload, qos=1, retain=True,
+                on_ack=lambda topic=topic, payload_hash=payload_hash: self._on_ack(topic, payload_hash)
+            )
+        self.logger.info("[HomeAssistantDiscovery] Published {} of {} discovery configs".format(len(to_publish), len(self.configs)))
+
+    def _on_ack(self, topic, payload_hash):
+        # Хеш сохраняется только когда брокер подтвердил конфигурацию; файл состояния
+        # записывается когда подтверждены все отправленные конфигурации
+        with self._lock:
+            self.published_hashes[topic] = payload_hash
+            if self._unacked_hashes.get(topic) == payload_hash:
+                del self._unacked_hashes[topic]
+            if not self._unacked_hashes:
+                self._save_state()
+
+    def _on_status(self, topic, payload):
+        if payload.decode('utf-8', 'replace').strip().lower() == 'online':
+            self.logger.info("[HomeAssistantDiscovery] Home Assistant birth message received, re-announcing")
+            self.announce(force=True)
+
+    def _load_state(self):
+        if not (self.state_file and os.path.exists(self.state_file)):
+            return {}
+        try:
+            with open(self.state_file) as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError) as E:
+            self.logger.error("[HomeAssistantDiscovery] Can not load %s: %r", self.state_file, E)
+            return {}
+
+    def _save_state(self):
+        if not self.state_file:
+            return
+        try:
+            temporary_file_name = self.state_file + '.tmp'
+            with open(temporary_file_name, 'w') as state_file:
+                json.dump(self.published_hashes, state_file)
+            os.replace(temporary_file_name, self.state_file)
+        except OSError as E:
+            self.logger.error("[HomeAssistantDiscovery] Can not save %s: %r", self.state_file, E)
@@ -0,0 +1,92 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from .logger import getLogger
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        route = self.server.routes.get(url.path)
+        if route is None:
+            self.send_body(404, b'Not Found\n', 'text/plain; charset=utf-8')
+            return
+        try:
+            route(self, parse_qs(url.query))
+        except Exception as E:
+            self.server.logger.error("[ExporterHTTPServer] Error handling %s: %r", self.path, E)
+            self.send_body(500, b'Internal Server Error\n', 'text/plain; charset=utf-8')
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Каждый запрос Prometheus не логируется
+        pass
+
+
+class ExporterHTTPServer(object):
+    """HTTP server of the exporter.
+
+    /metrics is served from an ExpositionCache: the format is negotiated with
+    the Accept header (Prometheus text or OpenMetrics), the body is sent
+    gzip'd when the client accepts it and 304 is returned when If-None-Match
+    matches the ETag of the rendered exposition. Other endpoints are added
+    with add_route(path, handler), handler(request, query) is called with the
+    request handler and the parsed query string.
+    """
+
+    def __init__(self, host, port, exposition_cache, logger=None):
+        self.exposition_cache = exposition_cache
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = getLogger("ExporterHTTPServer")
+        self.httpd = ThreadingHTTPServer((host, port), _RequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.logger = self.logger
+        self.httpd.routes = {}
+        self.add_route('/metrics', self._handle_metrics)
+        self.add_route('/', self._handle_metrics)
+
+    def add_route(self, path, handler):
+        self.httpd.routes[path] = handler
+
+    def start(self):
+        thread = threading.Thread(target=self.httpd.serve_forever, name='http_server_thread', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handle_metrics(self, request, query):
+        openmetrics = 'application/openmetrics-text' in request.headers.get('Accept', '')
+        exposition = self.exposition_cache.get(openmetrics)
+        use_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+        etag = exposition.gzip_etag if use_gzip else exposition.etag
+        headers = {'ETag': etag, 'Vary': 'Accept, Accept-Encoding'}
+
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match and etag in [value.strip() for value in if_none_match.split(',')]:
+            request.send_response(304)
+            for name, value in headers.items():
+                request.send_header(name, value)
+            request.send_header('Content-Length', '0')
+            request.end_headers()
+            return
+
+        if use_gzip:
+            headers['Content-Encoding'] = 'gzip'
+            request.send_body(200, exposition.gzip_body, exposition.content_type, headers)
+        else:
+            request.send_body(200, exposition.body, exposition.content_type, headers)
@@ -1,6 +1,11 @@
+import atexit
 import os
 import sys
 import logging
+import logging.handlers
+import queue
+import threading
+import time
 import traceback
 
 # Override format method in logging.Formatter class
@@ -47,24 +52,98 @@ class ColoredFormatter(logging.Formatter):
         return super(ColoredFormatter, self).format(record)
 
 
+class RateLimitFilter(logging.Filter):
+    """Pass at most burst records with the same message per interval_seconds.
+
+    Applies to records of level and above (repeated errors of a dead stick
+    every poll cycle). Records are the same when the logger, the level and
+    the message template (record.msg) are the same. The first record passed
+    after suppression tells how many records were suppressed.
+    """
+
+    def __init__(self, interval_seconds=60, burst=5, level=logging.WARNING):
+        super(RateLimitFilter, self).__init__()
+        self.interval_seconds = interval_seconds
+        self.burst = burst
+        self.level = level
+        self._lock = threading.Lock()
+        # (logger, уровень, шаблон) -> [начало окна, пропущено в окне, подавлено]
+        self._windows = {}
+
+    def filter(self, record):
+        if (record.levelno < self.level) or (not self.interval_seconds):
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if (window is None) or (now - window[0] >= self.interval_seconds):
+                suppressed = window[2] if window is not None else 0
+                if len(self._windows) > 1000:
+                    self._forget_expired(now)
+                self._windows[key] = [now, 1, 0]
+            elif window[1] < self.burst:
+                window[1] = window[1] + 1
+                suppressed = 0
+            else:
+                window[2] = window[2] + 1
+                return False
+        if suppressed:
+            record.msg = "{} ({} similar message(s) suppressed)".format(record.getMessage(), suppressed)
+            record.args = None
+        return True
+
+    def _forget_expired(self, now):
+        for key in [key for key, window in self._windows.items() if now - window[0] >= self.interval_seconds]:
+            del self._windows[key]
+
+
+def make_queue_handler(handler):
+    """Wrap handler into a QueueHandler: records are written by a background thread.
+
+    The calling thread (e.g. a poll thread) only puts the record into a queue
+    and never blocks on I/O. Repeated errors are rate limited (LOG_RATE_LIMIT_SECONDS,
+    LOG_RATE_LIMIT_BURST) before they are queued. The queue is flushed at exit.
+    """
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(
+        interval_seconds=float(os.environ.get('LOG_RATE_LIMIT_SECONDS', 60)),
+        burst=int(os.environ.get('LOG_RATE_LIMIT_BURST', 5))
+    ))
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return queue_handler
+
+
 class CommonLogger(logging.getLoggerClass()):
     """ Custom Logger class to provide formatting and exception handling """
+
+    # Один обработчик на все логгеры класса - раньше каждый логгер создавал свой StreamHandler
+    _shared_handler = None
+    _shared_handler_lock = threading.Lock()
+
     def __init__(self, name):
         super(CommonLogger, self).__init__(name)
-        handler = logging.StreamHandler()
-        format_string = '%(asctime)s [%(levelname)-5s]' + name + ': %(message)s'
-
-        # тут можно что-то напечтать - это удобно что бы понимать когда какой-то класс
-        # вызывает еще раз создания логгера (и сообщения начинают повторяться)
-        #print(format_string)
-        # Отключить цвета при выводе не в терминал
-        if sys.stdout.isatty():
-            formatter = ColoredFormatter(format_string)
-        else:
-            formatter = logging.Formatter(format_string)
+        self.addHandler(self.shared_handler())
+        # Сообщения уже выводятся своим обработчиком - не дублировать их обработчиками root логгера
+        self.propagate = False
 
-        handler.setFormatter(formatter)
-        self.addHandler(handler)
+    @classmethod
+    def shared_handler(cls):
+        with cls._shared_handler_lock:
+            if cls._shared_handler is None:
+                handler = logging.StreamHandler()
+                format_string = '%(asctime)s [%(levelname)-5s]%(name)s: %(message)s'
+                # Отключить цвета при выводе не в терминал
+                if sys.stdout.isatty():
+                    formatter = ColoredFormatter(format_string)
+                else:
+                    formatter = logging.Formatter(format_string)
+                handler.setFormatter(formatter)
+                cls._shared_handler = make_queue_handler(handler)
+            return cls._shared_handler
 
     def exception(self, *args):
         for l in traceback.format_exc().splitlines():
@@ -75,10 +154,15 @@ class CommonLogger(logging.getLoggerClass()):
 
 def getLogger(name):
     """ Set our logger class and return preconfigured logger """
+    # Класс подменяется только на время создания логгера - логгеры сторонних библиотек
+    # остаются обычными и выводятся обработчиками root логгера
+    logger_class = logging.getLoggerClass()
     logging.setLoggerClass(CommonLogger)
-    logger = logging.getLogger(name)
+    try:
+        logger = logging.getLogger(name)
+    finally:
+        logging.setLoggerClass(logger_class)
     logger.setLevel(logging.INFO)
     if "DEBUG" in os.environ:
         logger.setLevel(logging.DEBUG)
     return logger
-
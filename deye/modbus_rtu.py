@@ -0,0 +1,111 @@
+import struct
+
+
+READ_HOLDING_REGISTERS = 0x03
+WRITE_MULTIPLE_REGISTERS = 0x10
+
+
+class ModbusException(Exception):
+    """Modbus exception response (function code with the 0x80 bit set)."""
+
+    def __init__(self, function_code, exception_code):
+        self.function_code = function_code
+        self.exception_code = exception_code
+        super(ModbusException, self).__init__("Modbus exception response: function 0x{:02X}, exception code {}".format(
+            function_code, exception_code)
+        )
+
+
+class ModbusFrameError(Exception):
+    """Malformed Modbus RTU frame (bad length or CRC)."""
+
+
+def _make_crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc = crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+
+# Таблица для расчета CRC16/Modbus по байту за шаг вместо 8 шагов по битам
+CRC16_TABLE = _make_crc16_table()
+
+
+def crc16(data):
+    """CRC16/Modbus of bytes-like data."""
+    crc = 0xFFFF
+    table = CRC16_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def add_crc(frame):
+    return bytes(frame) + struct.pack('<H', crc16(frame))
+
+
+def check_crc(frame):
+    if len(frame) < 4:
+        return False
+    # CRC16/Modbus кадра вместе с его CRC (младший байт первым) всегда равен 0 - проверка
+    # одним проходом по кадру, без копирования кадра без CRC и распаковки CRC
+    return crc16(frame) == 0
+
+
+def read_holding_registers_request(slave_id, register_addr, quantity):
+    return add_crc(struct.pack('>BBHH', slave_id, READ_HOLDING_REGISTERS, register_addr, quantity))
+
+
+def write_multiple_registers_request(slave_id, register_addr, values):
+    quantity = len(values)
+    return add_crc(struct.pack('>BBHHB{}H'.format(quantity), slave_id, WRITE_MULTIPLE_REGISTERS,
+                               register_addr, quantity, quantity * 2, *values))
+
+
+def expected_response_length(request):
+    """Length of a normal (non-exception) RTU response for a request built above."""
+    function_code = request[1]
+    if function_code == READ_HOLDING_REGISTERS:
+        quantity = struct.unpack_from('>H', request, 4)[0]
+        return 5 + quantity * 2
+    if function_code == WRITE_MULTIPLE_REGISTERS:
+        return 8
+    raise ValueError("Unsupported function code 0x{:02X}".format(function_code))
+
+
+def parse_response(frame, request):
+    """Parse an RTU response to request.
+
+    Returns a list of register values for reads and the number of written
+    registers for writes. frame may be any bytes-like object; register values
+    are unpacked straight from a memoryview without intermediate copies.
+    """
+    frame = memoryview(frame)
+    if len(frame) < 5:
+        raise ModbusFrameError("Modbus RTU frame is too short: {} bytes".format(len(frame)))
+    function_code = frame[1]
+    if function_code & 0x80:
+        if not check_crc(frame[:5]):
+            raise ModbusFrameError("Modbus RTU frame has invalid CRC")
+        raise ModbusException(function_code & 0x7F, frame[2])
+    if function_code != request[1]:
+        raise ModbusFrameError("Modbus RTU frame has unexpected function code 0x{:02X}".format(function_code))
+
+    length = expected_response_length(request)
+    # Некоторые стики добавляют в конец лишний (дублированный) CRC - его просто отбрасываем
+    if len(frame) < length:
+        raise ModbusFrameError("Modbus RTU frame is too short: {} bytes, expected {}".format(len(frame), length))
+    frame = frame[:length]
+    if not check_crc(frame):
+        raise ModbusFrameError("Modbus RTU frame has invalid CRC")
+
+    if function_code == READ_HOLDING_REGISTERS:
+        quantity = frame[2] // 2
+        return list(struct.unpack_from('>{}H'.format(quantity), frame, 3))
+    return struct.unpack_from('>H', frame, 4)[0]
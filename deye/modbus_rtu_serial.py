@@ -0,0 +1,132 @@
+import time
+try:
+    import serial
+except ImportError:
+    serial = None
+from . import modbus_rtu
+from .logger import getLogger
+
+
+# При скорости выше 19200 бод пауза между кадрами по спецификации Modbus фиксированная
+FIXED_INTER_FRAME_BAUDRATE = 19200
+FIXED_INTER_FRAME_SECONDS = 0.00175
+# Самый короткий ответ - исключение: адрес, функция, код исключения, CRC
+MIN_RESPONSE_LENGTH = 5
+
+
+def rtu_character_seconds(baudrate, bytesize=8, parity='N', stopbits=1):
+    """Time to transmit one character: start bit, data bits, parity bit and stop bits."""
+    bits = 1 + bytesize + (0 if parity == 'N' else 1) + stopbits
+    return bits / baudrate
+
+
+def rtu_inter_frame_seconds(baudrate, bytesize=8, parity='N', stopbits=1):
+    """Minimum line silence between Modbus RTU frames (3.5 characters, 1.75 ms above 19200 baud)."""
+    if baudrate > FIXED_INTER_FRAME_BAUDRATE:
+        return FIXED_INTER_FRAME_SECONDS
+    return 3.5 * rtu_character_seconds(baudrate, bytesize, parity, stopbits)
+
+
+class SerialModbusClient(object):
+    """Modbus RTU client over a serial line (RS485) with the interface of SolarmanV5Client.
+
+    Talks straight to the inverter Modbus port instead of the logger stick:
+    the address is the serial device ('/dev/ttyUSB0'), the stick serial
+    number and TCP port are ignored. Requests are strictly serial (the line
+    is half duplex), before every request the line must be silent for
+    inter_frame_seconds (3.5 characters by default) and the input buffer is
+    flushed. The reply length is known from the request, so a frame is read
+    with two reads (the first 5 bytes tell an exception from a normal reply)
+    instead of waiting for the silence after the frame.
+    """
+
+    # Перед каждым запросом входной буфер очищается - опоздавший ответ на запрос с
+    # ошибкой не будет принят за ответ на следующий запрос, сессию можно использовать дальше
+    discards_late_replies = True
+    sock = None
+
+    def __init__(self, device, stick_logger_serial=None, port=None, mb_slave_id=1,
+                 logger=None, socket_timeout=1, on_request_latency=None,
+                 baudrate=9600, bytesize=8, parity='N', stopbits=1, inter_frame_seconds=None, **kwargs):
+        if serial is None:
+            raise RuntimeError("pyserial is required for the Modbus RTU transport")
+        self.device = device
+        self.mb_slave_id = mb_slave_id
+        self.socket_timeout = socket_timeout
+        self.on_request_latency = on_request_latency
+        if inter_frame_seconds is None:
+            inter_frame_seconds = rtu_inter_frame_seconds(baudrate, bytesize, parity, stopbits)
+        self.inter_frame_seconds = inter_frame_seconds
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = getLogger("SerialModbusClient")
+
+        self.serial = serial.Serial(
+            device, baudrate=baudrate, bytesize=bytesize, parity=parity, stopbits=stopbits, timeout=socket_timeout
+        )
+        self._line_idle_at = 0
+
+    def is_connected(self):
+        return (self.serial is not None) and self.serial.is_open
+
+    def read_holding_registers(self, register_addr, quantity):
+        return self.send_modbus_request(
+            modbus_rtu.read_holding_registers_request(self.mb_slave_id, register_addr, quantity)
+        )
+
+    def write_multiple_holding_registers(self, register_addr, values):
+        return self.send_modbus_request(
+            modbus_rtu.write_multiple_registers_request(self.mb_slave_id, register_addr, values)
+        )
+
+    def read_windows(self, windows, return_exceptions=False):
+        results = []
+        for start, quantity in windows:
+            try:
+                results.append(self.read_holding_registers(start, quantity))
+            except Exception as E:
+                if not return_exceptions:
+                    raise
+                results.append(E)
+        return results
+
+    def send_modbus_request(self, modbus_request):
+        if not self.is_connected():
+            raise OSError("Serial port {} is closed".format(self.device))
+        wait_seconds = self._line_idle_at - time.monotonic()
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+        self.serial.reset_input_buffer()
+        sent_at = time.monotonic()
+        try:
+            self.serial.write(modbus_request)
+            response = self._read_response(modbus_request)
+        finally:
+            self._line_idle_at = time.monotonic() + self.inter_frame_seconds
+        if self.on_request_latency is not None:
+            self.on_request_latency(time.monotonic() - sent_at)
+        return modbus_rtu.parse_response(response, modbus_request)
+
+    def disconnect(self):
+        if self.serial is not None:
+            self.serial.close()
+            self.serial = None
+
+    def _read_response(self, modbus_request):
+        response = self.serial.read(MIN_RESPONSE_LENGTH)
+        if len(response) < MIN_RESPONSE_LENGTH:
+            raise TimeoutError("No response from Modbus slave {} on {} ({} byte(s) received)".format(
+                self.mb_slave_id, self.device, len(response))
+            )
+        if response[0] != self.mb_slave_id:
+            raise modbus_rtu.ModbusFrameError("Modbus RTU frame from unexpected slave {}".format(response[0]))
+        if response[1] & 0x80:
+            return response
+        length = modbus_rtu.expected_response_length(modbus_request)
+        response = response + self.serial.read(length - MIN_RESPONSE_LENGTH)
+        if len(response) < length:
+            raise TimeoutError("Incomplete response from Modbus slave {} on {}: {} of {} bytes".format(
+                self.mb_slave_id, self.device, len(response), length)
+            )
+        return response
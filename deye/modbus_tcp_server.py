@@ -0,0 +1,255 @@
+import asyncio
+import struct
+import threading
+import time
+from array import array
+from . import modbus_rtu
+from .logger import getLogger
+from .read_planner import ReadPlanner
+
+
+# Заголовок MBAP: номер транзакции, протокол (0 - Modbus), длина остатка кадра, номер устройства
+MBAP_HEADER = struct.Struct('>HHHB')
+# Коды исключений Modbus
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_DATA_ADDRESS = 0x02
+ILLEGAL_DATA_VALUE = 0x03
+GATEWAY_TARGET_FAILED = 0x0B
+GATEWAY_PATH_UNAVAILABLE = 0x0A
+MAX_READ_QUANTITY = 125
+
+# Откуда взяты регистры ответа (метрика modbus_tcp_requests): только образ опроса, с чтением
+# из стика, с чтением которое уже выполнялось для другого клиента, ошибка
+SOURCE_CACHE = 'cache'
+SOURCE_FORWARDED = 'forwarded'
+SOURCE_COALESCED = 'coalesced'
+SOURCE_ERROR = 'error'
+
+
+class ModbusTcpServer(object):
+    """Modbus TCP server answering read holding registers (0x03) from the polled register image.
+
+    Third-party pollers talk to this server instead of the logger stick.
+    A register is answered from the raw image of the inverter if it was read
+    not earlier than its max age ago: the 'max_age' of the register in the
+    profile, stale_after_intervals poll intervals of the register by default
+    (of default_poll_interval_seconds for addresses read by the poll but not
+    described in the profile). The other addresses of the request (e.g.
+    outside of the polled set) are read from the stick through the inverter
+    bus with scan priority, in runs of missing addresses (runs separated by
+    not more than forward_gap_merge_threshold cached addresses are read as
+    one window), not as the whole span between the first and the last one.
+    Addresses which are already being read for another client are taken
+    from that read, and forwarded values are reused for
+    forward_max_age_seconds.
+
+    deye_inverters is {inverter name: DeyeInverter}, unit_ids - {inverter name:
+    Modbus unit id}; with a single inverter any unit id is answered by it.
+    The server runs its own event loop thread: start() / stop().
+    """
+
+    def __init__(self, deye_inverters, unit_ids=None, host='0.0.0.0', port=502,
+                 default_poll_interval_seconds=10, stale_after_intervals=3, forward_max_age_seconds=1,
+                 forward_gap_merge_threshold=8, self_metrics=None, logger=None):
+        self.host = host
+        self.port = port
+        self.forward_max_age_seconds = forward_max_age_seconds
+        self.forward_planner = ReadPlanner(
+            max_registers_per_request=MAX_READ_QUANTITY, gap_merge_threshold=forward_gap_merge_threshold
+        )
+        self.self_metrics = self_metrics
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = getLogger("ModbusTcpServer")
+
+        self.deye_inverters = dict(deye_inverters)
+        self.inverter_names_by_unit_id = {unit_id: inverter_name for inverter_name, unit_id in (unit_ids or {}).items()}
+        self.default_inverter_name = next(iter(self.deye_inverters)) if len(self.deye_inverters) == 1 else None
+        self.max_ages = {
+            inverter_name: self._max_ages(deye_inverter, default_poll_interval_seconds, stale_after_intervals)
+            for inverter_name, deye_inverter in self.deye_inverters.items()
+        }
+        # Имя инвертора -> {адрес: (время чтения, значение)} - регистры прочитанные по запросу клиентов
+        self.forwarded_values = {inverter_name: {} for inverter_name in self.deye_inverters}
+        # Имя инвертора -> {окно (ReadWindow): выполняющееся чтение окна}
+        self._forwards_in_flight = {inverter_name: {} for inverter_name in self.deye_inverters}
+
+        self.loop = None
+        self._server = None
+        self._loop_thread = None
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self.loop.run_forever, name='modbus_tcp_server', daemon=True)
+        self._loop_thread.start()
+        asyncio.run_coroutine_threadsafe(self._start_server(), self.loop).result(10)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.logger.info("[ModbusTcpServer] Serving Modbus TCP on {}:{}".format(self.host, self.port))
+        return self
+
+    def stop(self):
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._stop_server(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._loop_thread.join(5)
+        self.loop.close()
+        self.loop = None
+
+    async def _start_server(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+
+    async def _stop_server(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    @staticmethod
+    def _max_ages(deye_inverter, default_poll_interval_seconds, stale_after_intervals):
+        max_ages = array('d', [default_poll_interval_seconds * stale_after_intervals]) * len(deye_inverter.register_values)
+        for register_details in deye_inverter.well_known_registers.values():
+            max_age = register_details.get('max_age')
+            if max_age is None:
+                max_age = register_details.get('poll_interval', default_poll_interval_seconds) * stale_after_intervals
+            for address in range(register_details['id'], register_details['id'] + register_details.get('quantity', 1)):
+                # Регистр входит в несколько описаний - действует самое строгое ограничение
+                max_ages[address] = min(max_ages[address], max_age)
+        return max_ages
+
+    async def _handle_connection(self, reader, writer):
+        # Ответы на запросы соединения, которые еще выполняются - отменяются при закрытии соединения
+        reply_tasks = set()
+        try:
+            while True:
+                header = await reader.readexactly(MBAP_HEADER.size)
+                transaction_id, protocol_id, length, unit_id = MBAP_HEADER.unpack(header)
+                if length < 2:
+                    break
+                pdu = await reader.readexactly(length - 1)
+                if protocol_id != 0:
+                    continue
+                # Клиент может отправить несколько запросов не дожидаясь ответов - ответ на
+                # запрос из образа не ждет запроса, который читается из стика
+                reply_task = asyncio.get_running_loop().create_task(self._reply(writer, transaction_id, unit_id, pdu))
+                reply_tasks.add(reply_task)
+                reply_task.add_done_callback(reply_tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for reply_task in list(reply_tasks):
+                reply_task.cancel()
+            writer.close()
+
+    async def _reply(self, writer, transaction_id, unit_id, pdu):
+        response_pdu = await self._response_pdu(unit_id, pdu)
+        if writer.is_closing():
+            return
+        writer.write(MBAP_HEADER.pack(transaction_id, 0, len(response_pdu) + 1, unit_id) + response_pdu)
+        try:
+            # Клиент, который не читает ответы, не должен копить их в памяти сервера
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _response_pdu(self, unit_id, pdu):
+        function_code = pdu[0]
+        if function_code != modbus_rtu.READ_HOLDING_REGISTERS:
+            return struct.pack('>BB', function_code | 0x80, ILLEGAL_FUNCTION)
+        if len(pdu) != 5:
+            return struct.pack('>BB', function_code | 0x80, ILLEGAL_DATA_VALUE)
+        register_addr, quantity = struct.unpack_from('>HH', pdu, 1)
+        if not 1 <= quantity <= MAX_READ_QUANTITY:
+            return struct.pack('>BB', function_code | 0x80, ILLEGAL_DATA_VALUE)
+        if register_addr + quantity > 0x10000:
+            return struct.pack('>BB', function_code | 0x80, ILLEGAL_DATA_ADDRESS)
+        inverter_name = self.inverter_names_by_unit_id.get(unit_id, self.default_inverter_name)
+        if inverter_name is None:
+            return struct.pack('>BB', function_code | 0x80, GATEWAY_PATH_UNAVAILABLE)
+
+        try:
+            values, source = await self._read(inverter_name, register_addr, quantity)
+        except Exception as E:
+            self.logger.error("[ModbusTcpServer] Inverter %s: error reading %s register(s) from %s: %r",
+                              inverter_name, quantity, register_addr, E)
+            self._count(inverter_name, SOURCE_ERROR)
+            if isinstance(E, modbus_rtu.ModbusException):
+                return struct.pack('>BB', function_code | 0x80, E.exception_code)
+            return struct.pack('>BB', function_code | 0x80, GATEWAY_TARGET_FAILED)
+        self._count(inverter_name, source)
+        return struct.pack('>BB{}H'.format(quantity), function_code, quantity * 2, *values)
+
+    async def _read(self, inverter_name, register_addr, quantity):
+        values, missing = self._cached_values(inverter_name, register_addr, quantity)
+        if not missing:
+            return values, SOURCE_CACHE
+        # Адреса, которые уже читаются для другого клиента, берутся из того чтения,
+        # остальные недостающие адреса читаются окнами - отрезками подряд идущих адресов
+        forwards_in_flight = self._forwards_in_flight[inverter_name]
+        # адрес -> окно, из чтения которого он берется
+        windows_by_address = {}
+        not_in_flight = []
+        for address in missing:
+            for window in forwards_in_flight:
+                if window.start <= address < window.start + window.quantity:
+                    windows_by_address[address] = window
+                    break
+            else:
+                not_in_flight.append(address)
+        forwards = {window: forwards_in_flight[window] for window in set(windows_by_address.values())}
+        source = SOURCE_COALESCED
+        if not_in_flight:
+            source = SOURCE_FORWARDED
+            read_plan = self.forward_planner.plan({address: {'id': address} for address in not_in_flight})
+            for window in read_plan.windows:
+                forward = asyncio.ensure_future(self._forward(inverter_name, window.start, window.quantity))
+                forwards_in_flight[window] = forward
+                forward.add_done_callback(lambda future, window=window: forwards_in_flight.pop(window, None))
+                forwards[window] = forward
+                for address in range(window.start, window.start + window.quantity):
+                    windows_by_address.setdefault(address, window)
+        windows = list(forwards)
+        windows_values = dict(zip(windows, await asyncio.gather(*[asyncio.shield(forwards[window]) for window in windows])))
+        for address in missing:
+            window = windows_by_address[address]
+            values[address - register_addr] = windows_values[window][address - window.start]
+        return values, source
+
+    async def _forward(self, inverter_name, start, quantity):
+        deye_inverter = self.deye_inverters[inverter_name]
+        window_values = await asyncio.get_running_loop().run_in_executor(
+            None, deye_inverter.read_holding_registers, start, quantity
+        )
+        read_at = time.monotonic()
+        forwarded_values = self.forwarded_values[inverter_name]
+        for offset, value in enumerate(window_values):
+            forwarded_values[start + offset] = (read_at, value)
+        return window_values
+
+    def _cached_values(self, inverter_name, register_addr, quantity):
+        """Values of the request from the image or earlier forwarded reads and the addresses which are missing."""
+        deye_inverter = self.deye_inverters[inverter_name]
+        register_values = deye_inverter.register_values
+        register_valid = deye_inverter.register_valid
+        register_read_at = deye_inverter.register_read_at
+        max_ages = self.max_ages[inverter_name]
+        forwarded_values = self.forwarded_values[inverter_name]
+        image_length = len(register_values)
+        now = time.monotonic()
+
+        values = [0] * quantity
+        missing = []
+        for offset in range(quantity):
+            address = register_addr + offset
+            if (address < image_length) and register_valid[address] and (now - register_read_at[address] <= max_ages[address]):
+                values[offset] = register_values[address]
+                continue
+            forwarded = forwarded_values.get(address)
+            if (forwarded is not None) and (now - forwarded[0] <= self.forward_max_age_seconds):
+                values[offset] = forwarded[1]
+                continue
+            missing.append(address)
+        return values, missing
+
+    def _count(self, inverter_name, source):
+        if self.self_metrics:
+            self.self_metrics.modbus_tcp_requests.labels(inverter_name, source).inc()
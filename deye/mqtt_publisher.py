@@ -0,0 +1,195 @@
+import threading
+import time
+import paho.mqtt.client as mqtt
+import prometheus_client
+from .logger import getLogger
+
+
+class MqttPublisher(object):
+    """Long-lived MQTT session shared by everything the exporter publishes.
+
+    The session is opened once and paho reconnects it automatically with a
+    backoff. A retained availability topic is set to 'online' on every
+    connect and to 'offline' by the broker (last will) when the session is
+    lost. publish() never blocks the caller: QoS1 messages are handed to
+    paho, which keeps up to max_inflight_messages unacknowledged messages
+    on the wire and queues the rest (also while disconnected). on_ack of
+    publish() is called when the broker acknowledges the message, callbacks
+    of add_connect_callback() - after every connect; both are called from
+    the MQTT network thread (on_ack of an early acknowledgement - from publish()).
+    """
+
+    def __init__(self, mqtt_host, mqtt_username, mqtt_password, mqtt_port=1883, client_id='',
+                 availability_topic=None, max_inflight_messages=20, max_queued_messages=1000,
+                 keepalive=60, logger=None, registry=prometheus_client.REGISTRY):
+        self.mqtt_host = mqtt_host
+        self.mqtt_port = mqtt_port
+        self.keepalive = keepalive
+        self.availability_topic = availability_topic
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = getLogger("MqttPublisher")
+
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
+        self.client.username_pw_set(mqtt_username, mqtt_password)
+        self.client.max_inflight_messages_set(max_inflight_messages)
+        self.client.max_queued_messages_set(max_queued_messages)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=60)
+        if availability_topic:
+            self.client.will_set(availability_topic, 'offline', qos=1, retain=True)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+
+        # mid -> время отправки сообщений QoS1 и выше, для расчета задержки подтверждения (PUBACK).
+        # on_publish может быть вызван раньше чем publish() вернет mid - неизвестные mid
+        # запоминаются в _acked_before_registered, пока выполняется хотя бы один publish()
+        # (_publishing - их число)
+        self._published_at = {}
+        self._acked_before_registered = set()
+        self._publishing = 0
+        self._pending_lock = threading.Lock()
+        # mid -> on_ack, для сообщений которые ждут подтверждения
+        self._ack_callbacks = {}
+        # topic -> qos, подписки восстанавливаются после каждого переподключения
+        self._subscriptions = {}
+        self._connect_callbacks = []
+
+        self.publish_latency = prometheus_client.Histogram(
+            'deye_exporter_mqtt_publish_latency_seconds',
+            'Time from MQTT publish to broker acknowledgement',
+            buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+            registry=registry
+        )
+        self.queue_depth = prometheus_client.Gauge(
+            'deye_exporter_mqtt_queue_depth',
+            'MQTT messages published but not acknowledged by the broker yet',
+            registry=registry
+        )
+        self.queue_depth.set_function(lambda: len(self._published_at))
+        self.published_messages = prometheus_client.Counter(
+            'deye_exporter_mqtt_published_messages',
+            'MQTT messages acknowledged by the broker',
+            registry=registry
+        )
+        self.failed_messages = prometheus_client.Counter(
+            'deye_exporter_mqtt_failed_messages',
+            'MQTT messages rejected by the client (queue is full)',
+            registry=registry
+        )
+        self.connects = prometheus_client.Counter(
+            'deye_exporter_mqtt_connects',
+            'Connections to the MQTT broker',
+            registry=registry
+        )
+
+    def start(self):
+        # connect_async не блокирует: если брокер недоступен, paho будет переподключаться сам
+        self.client.connect_async(self.mqtt_host, self.mqtt_port, self.keepalive)
+        self.client.loop_start()
+
+    def stop(self):
+        if self.availability_topic:
+            self.client.publish(self.availability_topic, 'offline', qos=1, retain=True).wait_for_publish(5)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def is_connected(self):
+        return self.client.is_connected()
+
+    def publish(self, topic, payload, qos=1, retain=False, on_ack=None):
+        published_at = time.monotonic()
+        with self._pending_lock:
+            self._publishing = self._publishing + 1
+        try:
+            msg_info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        except Exception:
+            with self._pending_lock:
+                self._publishing = self._publishing - 1
+            raise
+        failed = msg_info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN)
+        with self._pending_lock:
+            self._publishing = self._publishing - 1
+            acked = msg_info.mid in self._acked_before_registered
+            self._acked_before_registered.discard(msg_info.mid)
+            # Для QoS0 подтверждения нет, on_publish вызывается сразу после отправки -
+            # регистрируются только сообщения QoS1 и выше
+            registered = (not failed) and (qos > 0)
+            if registered and (not acked):
+                self._published_at[msg_info.mid] = published_at
+                if on_ack is not None:
+                    self._ack_callbacks[msg_info.mid] = on_ack
+            if registered and (self._publishing == 0):
+                # Остальные mid - от QoS0 сообщений или давно подтвержденных; mid 16 битный и
+                # переиспользуется, такой mid не должен быть принят за подтверждение нового сообщения
+                self._acked_before_registered.clear()
+        if failed:
+            self.failed_messages.inc()
+            self.logger.error("[MqttPublisher] Failed to publish to %s: %s", topic, mqtt.error_string(msg_info.rc))
+            return msg_info
+        if registered and acked:
+            self.publish_latency.observe(time.monotonic() - published_at)
+            self.published_messages.inc()
+            self._call_ack_callback(on_ack, msg_info.mid)
+        return msg_info
+
+    def add_connect_callback(self, callback):
+        """callback() is called after every connect (and right away if the session is connected)."""
+        self._connect_callbacks.append(callback)
+        if self.client.is_connected():
+            callback()
+
+    def subscribe(self, topic, callback, qos=1):
+        """Subscribe to topic, callback(topic, payload) is called from the MQTT network thread."""
+        def on_message(client, userdata, message):
+            try:
+                callback(message.topic, message.payload)
+            except Exception as E:
+                self.logger.error("[MqttPublisher] Error handling message from %s: %r", message.topic, E)
+
+        self.client.message_callback_add(topic, on_message)
+        self._subscriptions[topic] = qos
+        if self.client.is_connected():
+            self.client.subscribe(topic, qos)
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            self.logger.error("[MqttPublisher] Connection to %s:%s failed: %s", self.mqtt_host, self.mqtt_port, reason_code)
+            return
+        self.connects.inc()
+        self.logger.info("[MqttPublisher] Connected to {}:{}".format(self.mqtt_host, self.mqtt_port))
+        if self.availability_topic:
+            self.publish(self.availability_topic, 'online', qos=1, retain=True)
+        for topic, qos in list(self._subscriptions.items()):
+            client.subscribe(topic, qos)
+        for callback in list(self._connect_callbacks):
+            try:
+                callback()
+            except Exception as E:
+                self.logger.error("[MqttPublisher] Error in connect callback: %r", E)
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        self.logger.warning("[MqttPublisher] Disconnected from %s:%s: %s", self.mqtt_host, self.mqtt_port, reason_code)
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        with self._pending_lock:
+            published_at = self._published_at.pop(mid, None)
+            if published_at is None:
+                # Подтверждение раньше чем publish() зарегистрировал mid. Без выполняющихся
+                # publish() это QoS0 сообщение (или сообщение отправленное в обход publish())
+                if self._publishing:
+                    self._acked_before_registered.add(mid)
+                return
+            on_ack = self._ack_callbacks.pop(mid, None)
+        self.publish_latency.observe(time.monotonic() - published_at)
+        self.published_messages.inc()
+        self._call_ack_callback(on_ack, mid)
+
+    def _call_ack_callback(self, on_ack, mid):
+        if on_ack is None:
+            return
+        try:
+            on_ack()
+        except Exception as E:
+            self.logger.error("[MqttPublisher] Error in acknowledgement callback of message %s: %r", mid, E)
@@ -0,0 +1,58 @@
+import time
+
+
+class PollScheduler(object):
+    """Monotonic-deadline scheduler of per-register poll intervals.
+
+    Every register may declare 'poll_interval' (seconds) in its description,
+    registers without it are polled every default_poll_interval_seconds.
+    due() returns the names of registers whose deadline has passed; the caller
+    reads them (planning windows only for these registers) and calls
+    mark_polled() to move their deadlines forward.
+    """
+
+    def __init__(self, registers, default_poll_interval_seconds, clock=time.monotonic):
+        self.clock = clock
+        self.default_poll_interval_seconds = default_poll_interval_seconds
+        self.poll_intervals = {}
+        for register_name, register_details in registers.items():
+            poll_interval = register_details.get('poll_interval', default_poll_interval_seconds)
+            if poll_interval <= 0:
+                raise ValueError("poll_interval of register {} must be positive".format(register_name))
+            self.poll_intervals[register_name] = poll_interval
+        # Сразу после старта все регистры должны быть прочитаны
+        now = self.clock()
+        self.deadlines = {register_name: now for register_name in self.poll_intervals}
+
+    def due(self, now=None):
+        if now is None:
+            now = self.clock()
+        return [register_name for register_name, deadline in self.deadlines.items() if deadline <= now]
+
+    def mark_polled(self, register_names, now=None):
+        if now is None:
+            now = self.clock()
+        for register_name in register_names:
+            # Следующий срок отсчитывается от предыдущего срока, а не от фактического времени
+            # опроса - так интервал не "уплывает". Если опрос сильно опоздал (например стик был
+            # недоступен) то пропущенные сроки не наверстываем
+            deadline = self.deadlines[register_name] + self.poll_intervals[register_name]
+            if deadline <= now:
+                deadline = now + self.poll_intervals[register_name]
+            self.deadlines[register_name] = deadline
+
+    def mark_due(self, register_names, now=None):
+        """Poll register_names as soon as possible (e.g. after they were written)."""
+        if now is None:
+            now = self.clock()
+        for register_name in register_names:
+            self.deadlines[register_name] = min(self.deadlines[register_name], now)
+
+    def is_fast(self, register_names):
+        """True if any of register_names is polled at least every default_poll_interval_seconds."""
+        return any(
+            self.poll_intervals[register_name] <= self.default_poll_interval_seconds for register_name in register_names
+        )
+
+    def next_deadline(self):
+        return min(self.deadlines.values())
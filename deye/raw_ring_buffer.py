@@ -0,0 +1,192 @@
+import mmap
+import os
+import struct
+import threading
+import time
+from .logger import getLogger
+
+
+# Заголовок файла: сигнатура, версия формата, число записей в кольце, число регистров
+# в образе, размер записи, сколько всего записей было добавлено
+RING_HEADER = struct.Struct('<8sIIIIQ')
+RING_MAGIC = b'DEYERING'
+RING_FORMAT_VERSION = 2
+# Заголовок записи: время (time.time()), имя инвертора (utf-8, дополнено нулями)
+RECORD_HEADER = struct.Struct('<d32s')
+RECORD_TIMESTAMP = struct.Struct('<d')
+INVERTER_NAME_LENGTH = 32
+# Сколько записей копируется за одну блокировку при чтении
+RECORDS_BATCH = 64
+
+
+class RawRingBuffer(object):
+    """Fixed-size, mmap-backed ring buffer of raw register images.
+
+    Every record holds the time, the inverter name and the whole raw image
+    (uint16 per register plus a flag byte per register, 1 - it was read by
+    the poll of the record).
+    When the ring is full the oldest records are overwritten. The file
+    survives restarts: it is reopened as is when its geometry matches
+    capacity and image_registers, otherwise it is recreated.
+    """
+
+    def __init__(self, path, capacity=50000, image_registers=None, logger=None):
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = getLogger("RawRingBuffer")
+        self.path = path
+        self._lock = threading.Lock()
+
+        existing_header = self._read_existing_header(path)
+        if existing_header is not None and image_registers is None:
+            # Открыть существующий файл не зная его геометрии (например для воспроизведения)
+            capacity, image_registers = existing_header[2], existing_header[3]
+        if image_registers is None:
+            raise ValueError("image_registers must be set to create {}".format(path))
+
+        self.capacity = capacity
+        self.image_registers = image_registers
+        self.record_size = RECORD_HEADER.size + image_registers * 3
+        self.file_size = RING_HEADER.size + capacity * self.record_size
+        # Формат записи образа регистров: признаки прочитанных регистров + значения
+        self._image_format = struct.Struct('<{}s{}H'.format(image_registers, image_registers))
+
+        expected_header = (RING_MAGIC, RING_FORMAT_VERSION, capacity, image_registers, self.record_size)
+        if (existing_header is None) or (tuple(existing_header[:5]) != expected_header):
+            if existing_header is not None:
+                self.logger.info("[RawRingBuffer] Geometry of {} has changed, recreating it".format(path))
+            self._create(path)
+
+        self._file = open(path, 'r+b')
+        self._mmap = mmap.mmap(self._file.fileno(), self.file_size)
+        self.written = RING_HEADER.unpack_from(self._mmap, 0)[5]
+
+    def append(self, inverter_name, values, valid=None, timestamp=None):
+        """Append a raw image.
+
+        values is a sequence of register values (array('H') or list), valid -
+        bytes-like with 1 for registers which were read at timestamp (by this
+        poll), the values of the others are not stored. Without valid, None
+        in values marks registers which were not read.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if len(values) > self.image_registers:
+            raise ValueError("Image has {} registers, ring buffer holds {}".format(len(values), self.image_registers))
+        if valid is None:
+            valid = bytes(0 if value is None else 1 for value in values)
+            values = [0 if value is None else value for value in values]
+        padding = self.image_registers - len(values)
+        flags = bytes(valid) + bytes(padding)
+        values = list(values) + [0] * padding
+        encoded_name = inverter_name.encode('utf-8')[:INVERTER_NAME_LENGTH]
+
+        with self._lock:
+            offset = self._offset(self.written)
+            RECORD_HEADER.pack_into(self._mmap, offset, timestamp, encoded_name)
+            self._image_format.pack_into(self._mmap, offset + RECORD_HEADER.size, flags, *values)
+            # Счетчик записей обновляется после самой записи - читатель не увидит недописанную запись
+            self.written = self.written + 1
+            RING_HEADER.pack_into(
+                self._mmap, 0, RING_MAGIC, RING_FORMAT_VERSION, self.capacity, self.image_registers,
+                self.record_size, self.written
+            )
+
+    def records(self, start_time=None, end_time=None, inverter_name=None, limit=None):
+        """Iterate (timestamp, inverter name, image) of records from start_time to end_time, oldest first.
+
+        With limit only the newest limit matching records are returned. Record
+        times grow with every append, so the time range is found by binary search.
+        """
+        with self._lock:
+            written = self.written
+            first = max(0, written - self.capacity)
+            end = written
+            if start_time is not None:
+                first = self._search(first, end, start_time, after=False)
+            if end_time is not None:
+                end = self._search(first, end, end_time, after=True)
+        if limit is None:
+            for timestamp, record_inverter_name, record in self._matching(first, end, inverter_name, reverse=False):
+                yield timestamp, record_inverter_name, self._image(record)
+            return
+        # Последние limit записей: ищутся от новых к старым, возвращаются от старых к новым
+        newest = []
+        if limit > 0:
+            for matching in self._matching(first, end, inverter_name, reverse=True):
+                newest.append(matching)
+                if len(newest) >= limit:
+                    break
+        for timestamp, record_inverter_name, record in reversed(newest):
+            yield timestamp, record_inverter_name, self._image(record)
+
+    def _matching(self, first, end, inverter_name, reverse):
+        """(timestamp, inverter name, record bytes) of records first..end-1 of inverter_name (any by default)."""
+        record_numbers = range(first, end)
+        if reverse:
+            record_numbers = record_numbers[::-1]
+        for batch_start in range(0, len(record_numbers), RECORDS_BATCH):
+            batch = record_numbers[batch_start:batch_start + RECORDS_BATCH]
+            # Записи копируются под блокировкой (append не перезапишет их наполовину) пачками,
+            # разбираются - без нее. Записи, которые успели перезаписать более новыми, пропускаются
+            with self._lock:
+                oldest = self.written - self.capacity
+                records = [self._record(record_number) for record_number in batch if record_number >= oldest]
+            for record in records:
+                timestamp, encoded_name = RECORD_HEADER.unpack_from(record, 0)
+                record_inverter_name = encoded_name.rstrip(b'\x00').decode('utf-8', 'replace')
+                if (inverter_name is not None) and (record_inverter_name != inverter_name):
+                    continue
+                yield timestamp, record_inverter_name, record
+
+    def _search(self, first, end, timestamp, after):
+        """First record number of first..end-1 with the time >= timestamp (> timestamp if after), end if none."""
+        while first < end:
+            middle = (first + end) // 2
+            record_timestamp = RECORD_TIMESTAMP.unpack_from(self._mmap, self._offset(middle))[0]
+            if (record_timestamp < timestamp) or (after and record_timestamp == timestamp):
+                first = middle + 1
+            else:
+                end = middle
+        return first
+
+    def _offset(self, record_number):
+        return RING_HEADER.size + (record_number % self.capacity) * self.record_size
+
+    def _record(self, record_number):
+        offset = self._offset(record_number)
+        return self._mmap[offset:offset + self.record_size]
+
+    def _image(self, record):
+        unpacked = self._image_format.unpack_from(record, RECORD_HEADER.size)
+        return [value if valid else None for value, valid in zip(unpacked[1:], unpacked[0])]
+
+    def flush(self):
+        self._mmap.flush()
+
+    def close(self):
+        with self._lock:
+            self._mmap.flush()
+            self._mmap.close()
+            self._file.close()
+
+    def _create(self, path):
+        with open(path, 'wb') as ring_file:
+            ring_file.truncate(self.file_size)
+            ring_file.write(RING_HEADER.pack(
+                RING_MAGIC, RING_FORMAT_VERSION, self.capacity, self.image_registers, self.record_size, 0
+            ))
+
+    @staticmethod
+    def _read_existing_header(path):
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as ring_file:
+            header = ring_file.read(RING_HEADER.size)
+        if len(header) != RING_HEADER.size:
+            return None
+        header = RING_HEADER.unpack(header)
+        if (header[0] != RING_MAGIC) or (header[1] != RING_FORMAT_VERSION):
+            return None
+        return header
@@ -0,0 +1,126 @@
+from collections import namedtuple
+
+
+# Окно чтения: непрерывный диапазон регистров, который читается одним
+# запросом read_holding_registers(register_addr=start, quantity=quantity)
+ReadWindow = namedtuple('ReadWindow', ['start', 'quantity'])
+
+
+class ReadPlan(object):
+    """Result of ReadPlanner.plan(): windows to read and their estimated cost."""
+
+    def __init__(self, windows, round_trip_cost_ms, register_cost_ms):
+        self.windows = tuple(windows)
+        # Сколько регистров будет прочитано всего (включая "лишние" регистры в промежутках)
+        self.total_registers = sum(window.quantity for window in self.windows)
+        self.round_trips = len(self.windows)
+        # Оценка времени выполнения плана в миллисекундах
+        self.estimated_cost_ms = self.round_trips * round_trip_cost_ms + self.total_registers * register_cost_ms
+
+    @property
+    def last_register(self):
+        # Номер последнего читаемого регистра, -1 если план пустой
+        if not self.windows:
+            return -1
+        return max(window.start + window.quantity for window in self.windows) - 1
+
+    def as_dict(self):
+        return {
+            'windows': [[window.start, window.quantity] for window in self.windows],
+            'total_registers': self.total_registers,
+            'round_trips': self.round_trips,
+            'estimated_cost_ms': self.estimated_cost_ms,
+        }
+
+    def __repr__(self):
+        return "ReadPlan(windows={}, total_registers={}, estimated_cost_ms={})".format(
+            [(window.start, window.quantity) for window in self.windows],
+            self.total_registers,
+            self.estimated_cost_ms
+        )
+
+
+class ReadPlanner(object):
+    """Groups known registers into the cheapest set of contiguous read windows.
+
+    Neighbouring register ranges may be read by a single request only when the
+    gap between them is not larger than gap_merge_threshold registers and the
+    merged window still fits into max_registers_per_request. Among the allowed
+    groupings the one with the lowest estimated cost is chosen.
+    """
+
+    def __init__(self, max_registers_per_request=125, gap_merge_threshold=None,
+                 round_trip_cost_ms=500, register_cost_ms=0.5):
+        if max_registers_per_request < 1:
+            raise ValueError("max_registers_per_request must be positive")
+        self.max_registers_per_request = max_registers_per_request
+        self.round_trip_cost_ms = round_trip_cost_ms
+        self.register_cost_ms = register_cost_ms
+
+        # Если порог не задан явно - вычисляем его из оценки стоимости: прочитать лишние
+        # регистры выгодно пока это дешевле чем еще один запрос к инвертору
+        if gap_merge_threshold is None:
+            if register_cost_ms > 0:
+                gap_merge_threshold = int(round_trip_cost_ms // register_cost_ms)
+            else:
+                gap_merge_threshold = max_registers_per_request
+        if gap_merge_threshold < 0:
+            raise ValueError("gap_merge_threshold can not be negative")
+        self.gap_merge_threshold = gap_merge_threshold
+
+    @staticmethod
+    def register_ranges(registers):
+        # Перевести описание регистров (как в well_known_registers) в список
+        # диапазонов [start, end) с учетом quantity
+        ranges = []
+        for register_details in registers.values():
+            start = register_details['id']
+            quantity = register_details.get('quantity', 1)
+            ranges.append((start, start + quantity))
+        return sorted(ranges)
+
+    def plan(self, registers):
+        """Build a ReadPlan for a dict of register descriptions (name -> {'id', 'quantity'})."""
+        # Сначала склеить пересекающиеся и соседние диапазоны - их точно читать вместе
+        ranges = []
+        for start, end in self.register_ranges(registers):
+            if ranges and start <= ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+            else:
+                ranges.append((start, end))
+
+        # Динамическое программирование по отсортированным диапазонам:
+        # best[i] - минимальная стоимость чтения первых i диапазонов и окна для этого.
+        # Окно может объединять диапазоны j..i-1 если ни один разрыв между ними не больше
+        # gap_merge_threshold и окно помещается в один запрос. Диапазонов единицы-десятки,
+        # так что квадратичная сложность тут не важна.
+        best = [(0, [])]
+        for i in range(1, len(ranges) + 1):
+            best_cost, best_windows = None, None
+            for j in range(i - 1, -1, -1):
+                if j < i - 1:
+                    gap = ranges[j + 1][0] - ranges[j][1]
+                    if gap > self.gap_merge_threshold:
+                        break
+                    if ranges[i - 1][1] - ranges[j][0] > self.max_registers_per_request:
+                        break
+                windows = self._split(ranges[j][0], ranges[i - 1][1])
+                cost = best[j][0] + self._cost(windows)
+                if best_cost is None or cost < best_cost:
+                    best_cost, best_windows = cost, best[j][1] + windows
+            best.append((best_cost, best_windows))
+
+        return ReadPlan(best[-1][1], self.round_trip_cost_ms, self.register_cost_ms)
+
+    def _cost(self, windows):
+        return sum(self.round_trip_cost_ms + window.quantity * self.register_cost_ms for window in windows)
+
+    def _split(self, start, end):
+        # Одиночный диапазон (например регистр с большим quantity) может быть длиннее
+        # чем разрешено читать за раз - тогда режем его на несколько окон
+        windows = []
+        while start < end:
+            quantity = min(self.max_registers_per_request, end - start)
+            windows.append(ReadWindow(start, quantity))
+            start = start + quantity
+        return windows
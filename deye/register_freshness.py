@@ -0,0 +1,70 @@
+import time
+
+
+# Качество значения регистра:
+#  fresh  - прочитано в последнем опросе этого регистра
+#  stale  - последний опрос прошел без ошибки, но значение давно не обновлялось
+#           (дольше чем stale_after секунд, например опрос пропущен)
+#  failed - последний опрос регистра завершился ошибкой, value - последнее удачно прочитанное
+#           значение (None, если регистр еще ни разу не был прочитан)
+QUALITY_FRESH = 'fresh'
+QUALITY_STALE = 'stale'
+QUALITY_FAILED = 'failed'
+
+
+def register_quality(register_data, now=None):
+    """Quality of one register entry of RegisterFreshness.merge() at the time now."""
+    if register_data['quality'] == QUALITY_FAILED:
+        return QUALITY_FAILED
+    if now is None:
+        now = time.time()
+    if (register_data['updated_at'] is None) or (now - register_data['updated_at'] > register_data['stale_after']):
+        return QUALITY_STALE
+    return QUALITY_FRESH
+
+
+class RegisterFreshness(object):
+    """Per-register timestamps and quality of collected data.
+
+    Every poll reads only a part of the registers, and a part of them may
+    fail. merge() combines the previous data of an inverter with the newly
+    decoded registers: decoded registers get updated_at and 'fresh' quality,
+    failed ones keep their last good value with 'failed' quality, the rest
+    keep everything. A register becomes stale when it was not updated for
+    stale_after_intervals of its poll interval.
+    """
+
+    def __init__(self, registers, default_poll_interval_seconds, stale_after_intervals=3):
+        self.units = {}
+        self.stale_after = {}
+        for register_name, register_details in registers.items():
+            self.units[register_name] = register_details['units']
+            self.stale_after[register_name] = \
+                register_details.get('poll_interval', default_poll_interval_seconds) * stale_after_intervals
+
+    def merge(self, previous_data, decoded_data, failed_register_names, now=None):
+        """Returns new {register name: {'value', 'units', 'updated_at', 'stale_after', 'quality'}}."""
+        if now is None:
+            now = time.time()
+        data = dict(previous_data or {})
+        for register_name, register_data in decoded_data.items():
+            data[register_name] = {
+                'value': register_data['value'],
+                'units': register_data['units'],
+                'updated_at': now,
+                'stale_after': self.stale_after[register_name],
+                'quality': QUALITY_FRESH,
+            }
+        for register_name in failed_register_names:
+            previous_register_data = data.get(register_name)
+            if previous_register_data is None:
+                data[register_name] = {
+                    'value': None,
+                    'units': self.units[register_name],
+                    'updated_at': None,
+                    'stale_after': self.stale_after[register_name],
+                    'quality': QUALITY_FAILED,
+                }
+            else:
+                data[register_name] = dict(previous_register_data, quality=QUALITY_FAILED)
+        return data
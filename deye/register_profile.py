@@ -0,0 +1,315 @@
+import hashlib
+import json
+import numbers
+import os
+import tempfile
+import threading
+from types import MappingProxyType
+from .logger import getLogger
+from .read_planner import ReadPlanner, ReadPlan, ReadWindow
+from .fault_decoder import FaultDecoder
+
+
+# Профили регистров (по одному на семейство моделей) лежат рядом с модулем
+PROFILES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+DEFAULT_PROFILE = 'single_phase'
+# Версия формата скомпилированного профиля, входит в хеш - при ее изменении кеш на диске
+# перестает совпадать и профиль компилируется заново
+COMPILER_VERSION = 3
+
+# Допустимые поля описания регистра (опечатка в файле профиля - ошибка, а не молча
+# игнорируемое поле), см. описание полей в deye_inverter.py
+REGISTER_FIELDS = {
+    'id', 'units', 'scale', 'offset', 'do_rounding', 'decoder', 'enum', 'quantity', 'signed',
+    'poll_interval', 'deadband', 'deadband_percent', 'writable', 'min', 'max', 'max_age',
+}
+# Декодеры: u16 - значение регистра как есть (со scale/offset/signed для числовых единиц),
+# enum - строка из таблицы enums профиля, faults - битовая карта ошибок (FaultDecoder)
+DECODERS = ('u16', 'enum', 'faults')
+
+
+class ProfileError(ValueError):
+    pass
+
+
+class RegisterProfile(object):
+    """Compiled, immutable register profile of an inverter model family.
+
+    registers - read-only {name: details} in the well_known_registers format
+    (enum and faults registers get a decode_method), read_plan - windows to
+    read all of them, registers_by_address - {address: names using it}.
+    One instance (and its read plans of register subsets) is shared by all
+    inverters of the profile.
+    """
+
+    def __init__(self, name, profile_hash, compiled, read_planner):
+        self.name = name
+        self.profile_hash = profile_hash
+        self.description = compiled['description']
+        self.enums = MappingProxyType({
+            enum_name: MappingProxyType({int(key): value for key, value in table.items()})
+            for enum_name, table in compiled['enums'].items()
+        })
+        self.faults = MappingProxyType({int(code): description for code, description in compiled['faults'].items()})
+
+        self.fault_register_name = None
+        self.fault_decoder = None
+        registers = {}
+        for register_name, register_details in compiled['registers'].items():
+            register_details = dict(register_details)
+            decoder = register_details.get('decoder', 'u16')
+            if decoder == 'enum':
+                register_details['decode_method'] = make_enum_decoder(self.enums[register_details['enum']])
+            elif decoder == 'faults':
+                self.fault_register_name = register_name
+                self.fault_decoder = FaultDecoder(self.faults, words=register_details.get('quantity', 1))
+                register_details['decode_method'] = self.fault_decoder.decode
+            registers[register_name] = MappingProxyType(register_details)
+        self.registers = MappingProxyType(registers)
+
+        self.read_plan = ReadPlan(
+            [ReadWindow(start, quantity) for start, quantity in compiled['windows']],
+            read_planner.round_trip_cost_ms, read_planner.register_cost_ms
+        )
+        self.read_planner = read_planner
+        # Планы чтения подмножеств регистров (опрос только регистров, срок опроса которых наступил)
+        # общие для всех инверторов профиля, ключ - frozenset имен регистров
+        self._read_plans = {frozenset(self.registers): self.read_plan}
+        self._read_plans_lock = threading.Lock()
+        registers_by_address = {}
+        for register_name, register_details in self.registers.items():
+            for address in range(register_details['id'], register_details['id'] + register_details.get('quantity', 1)):
+                registers_by_address.setdefault(address, []).append(register_name)
+        self.registers_by_address = MappingProxyType({
+            address: tuple(register_names) for address, register_names in registers_by_address.items()
+        })
+
+    def get_read_plan(self, register_names=None):
+        """Read plan for the given register names (all registers by default)."""
+        if register_names is None:
+            return self.read_plan
+        key = frozenset(register_names)
+        read_plan = self._read_plans.get(key)
+        if read_plan is None:
+            read_plan = self.read_planner.plan({register_name: self.registers[register_name] for register_name in key})
+            with self._read_plans_lock:
+                read_plan = self._read_plans.setdefault(key, read_plan)
+        return read_plan
+
+    def __repr__(self):
+        return "RegisterProfile(name={!r}, registers={}, hash={})".format(self.name, len(self.registers), self.profile_hash[:12])
+
+
+def make_enum_decoder(table):
+    def decode_enum(data):
+        if len(data) != 1:
+            raise ValueError("Expected size of list is 1")
+        return table[data[0]]
+    return decode_enum
+
+
+class ProfileLoader(object):
+    """Loads register profiles: validates and compiles them once.
+
+    A profile is a JSON file in PROFILES_DIRECTORY (by name) or any path. It
+    may extend another profile ("extends": name), its registers, enums and
+    faults override the parent ones. The compiled profile (validated
+    registers and the read plan) is cached on disk in cache_directory, keyed
+    by the hash of the resolved profile and the planner settings, and in
+    memory: loading the same profile again returns the same RegisterProfile.
+    """
+
+    def __init__(self, cache_directory=None, logger=None):
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = getLogger("ProfileLoader")
+        if cache_directory is None:
+            cache_directory = os.environ.get(
+                'DEYE_PROFILE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'deye_exporter_profiles')
+            )
+        self.cache_directory = cache_directory
+        self._lock = threading.Lock()
+        # хеш профиля -> RegisterProfile
+        self._profiles = {}
+
+    def load(self, profile, max_registers_per_request=125, gap_merge_threshold=None):
+        read_planner = ReadPlanner(
+            max_registers_per_request=max_registers_per_request, gap_merge_threshold=gap_merge_threshold
+        )
+        name, source = self._resolve(profile, ())
+        profile_hash = hashlib.sha256(json.dumps([
+            COMPILER_VERSION, source, read_planner.max_registers_per_request, read_planner.gap_merge_threshold,
+            read_planner.round_trip_cost_ms, read_planner.register_cost_ms,
+        ], sort_keys=True).encode('utf-8')).hexdigest()
+
+        with self._lock:
+            register_profile = self._profiles.get(profile_hash)
+            if register_profile is None:
+                compiled = self._read_cache(name, profile_hash)
+                if compiled is None:
+                    compiled = compile_profile(name, source, read_planner)
+                    self._write_cache(name, profile_hash, compiled)
+                register_profile = RegisterProfile(name, profile_hash, compiled, read_planner)
+                self._profiles[profile_hash] = register_profile
+            return register_profile
+
+    def _resolve(self, profile, seen):
+        # Прочитать профиль и всех его предков, вернуть (имя, объединенное описание)
+        if os.path.sep in profile or profile.endswith('.json'):
+            path = profile
+            name = os.path.splitext(os.path.basename(profile))[0]
+        else:
+            path = os.path.join(PROFILES_DIRECTORY, profile + '.json')
+            name = profile
+        if name in seen:
+            raise ProfileError("Profile {} extends itself: {}".format(name, ' -> '.join(seen + (name,))))
+        try:
+            with open(path) as profile_file:
+                source = json.load(profile_file)
+        except (OSError, ValueError) as E:
+            raise ProfileError("Can not load register profile {} from {}: {}".format(name, path, E))
+        if not isinstance(source, dict):
+            raise ProfileError("Profile {}: must be a JSON object".format(name))
+
+        parent_name = source.pop('extends', None)
+        if parent_name is None:
+            return name, source
+        parent_source = self._resolve(parent_name, seen + (name,))[1]
+        for section in ('registers', 'enums', 'faults'):
+            merged = dict(parent_source.get(section, {}))
+            merged.update(source.get(section, {}))
+            source[section] = merged
+        source.setdefault('description', parent_source.get('description', ''))
+        return name, source
+
+    def _cache_path(self, name, profile_hash):
+        return os.path.join(self.cache_directory, '{}-{}.json'.format(name, profile_hash[:16]))
+
+    def _read_cache(self, name, profile_hash):
+        try:
+            with open(self._cache_path(name, profile_hash)) as cache_file:
+                cached = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+        if (not isinstance(cached, dict)) or (cached.get('profile_hash') != profile_hash):
+            return None
+        self.logger.debug("[ProfileLoader] Profile %s is loaded from cache", name)
+        return cached['compiled']
+
+    def _write_cache(self, name, profile_hash, compiled):
+        # Кеш не обязателен: если записать не удалось - профиль просто будет скомпилирован в следующий раз
+        cache_path = self._cache_path(name, profile_hash)
+        try:
+            os.makedirs(self.cache_directory, exist_ok=True)
+            temporary_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+            with open(temporary_path, 'w') as cache_file:
+                json.dump({'profile_hash': profile_hash, 'compiled': compiled}, cache_file)
+            os.replace(temporary_path, cache_path)
+        except OSError as E:
+            self.logger.warning("[ProfileLoader] Can not cache compiled profile %s in %s: %r", name, cache_path, E)
+
+
+def compile_profile(name, source, read_planner):
+    """Validate a resolved profile and compute its read plan.
+
+    Returns a JSON serializable dict: description, registers (details
+    without defaults), enums, faults and windows ([[start, quantity], ...]).
+    Raises ProfileError describing the first problem found.
+    """
+    unknown_sections = set(source) - {'description', 'registers', 'enums', 'faults'}
+    if unknown_sections:
+        raise ProfileError("Profile {}: unknown sections {}".format(name, sorted(unknown_sections)))
+    enums = source.get('enums', {})
+    faults = source.get('faults', {})
+    registers = source.get('registers', {})
+    if not registers:
+        raise ProfileError("Profile {}: no registers".format(name))
+
+    for enum_name, table in enums.items():
+        if not isinstance(table, dict) or not all(key.isdigit() and isinstance(value, str) for key, value in table.items()):
+            raise ProfileError("Profile {}: enum {} must map register values to strings".format(name, enum_name))
+    if not all(code.isdigit() and isinstance(description, str) for code, description in faults.items()):
+        raise ProfileError("Profile {}: faults must map fault code numbers to descriptions".format(name))
+
+    fault_registers = []
+    for register_name, register_details in registers.items():
+        def fail(message):
+            raise ProfileError("Profile {}, register {}: {}".format(name, register_name, message))
+
+        if not isinstance(register_details, dict):
+            fail("must be an object")
+        unknown_fields = set(register_details) - REGISTER_FIELDS
+        if unknown_fields:
+            fail("unknown fields {}".format(sorted(unknown_fields)))
+        if not _is_integer(register_details.get('id')) or not 0 <= register_details['id'] <= 0xFFFF:
+            fail("id must be a register number 0..65535")
+        if not isinstance(register_details.get('units'), str):
+            fail("units must be a string")
+        quantity = register_details.get('quantity', 1)
+        if not _is_integer(quantity) or not 1 <= quantity <= read_planner.max_registers_per_request:
+            fail("quantity must be 1..{}".format(read_planner.max_registers_per_request))
+        for field in ('scale', 'offset'):
+            if not isinstance(register_details.get(field, 0), numbers.Real) or isinstance(register_details.get(field), bool):
+                fail("{} must be a number".format(field))
+        for field in ('poll_interval', 'deadband', 'deadband_percent', 'max_age'):
+            value = register_details.get(field, 0)
+            if isinstance(value, bool) or not isinstance(value, numbers.Real) or value < 0:
+                fail("{} must be a non-negative number".format(field))
+        if register_details.get('poll_interval', 1) == 0:
+            fail("poll_interval must be positive")
+        for field in ('min', 'max'):
+            if (field in register_details) and (isinstance(register_details[field], bool) or
+                                                not isinstance(register_details[field], numbers.Real)):
+                fail("{} must be a number".format(field))
+        for field in ('signed', 'do_rounding', 'writable'):
+            if not isinstance(register_details.get(field, False), bool):
+                fail("{} must be true or false".format(field))
+
+        decoder = register_details.get('decoder', 'u16')
+        if decoder not in DECODERS:
+            fail("decoder must be one of {}".format(DECODERS))
+        if decoder == 'u16' and quantity != 1:
+            fail("u16 decoder reads one register, quantity is {}".format(quantity))
+        if decoder == 'enum':
+            if register_details.get('enum') not in enums:
+                fail("enum {!r} is not defined in enums".format(register_details.get('enum')))
+            if quantity != 1:
+                fail("enum decoder reads one register")
+        elif 'enum' in register_details:
+            fail("enum is used only with the enum decoder")
+        if decoder == 'faults':
+            fault_registers.append(register_name)
+        # Запись поддерживается только для числовых однорегистровых величин
+        if register_details.get('writable', False) and decoder != 'u16':
+            fail("only u16 registers can be writable")
+    if len(fault_registers) > 1:
+        raise ProfileError("Profile {}: only one faults register is supported, found {}".format(name, fault_registers))
+
+    read_plan = read_planner.plan(registers)
+    return {
+        'description': source.get('description', ''),
+        'registers': registers,
+        'enums': enums,
+        'faults': faults,
+        'windows': [[window.start, window.quantity] for window in read_plan.windows],
+    }
+
+
+def _is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+# Общий загрузчик: профиль компилируется один раз на процесс, сколько бы инверторов его не использовали
+_default_loader = None
+_default_loader_lock = threading.Lock()
+
+
+def load_profile(profile=DEFAULT_PROFILE, max_registers_per_request=125, gap_merge_threshold=None):
+    """Compiled RegisterProfile by name (file in PROFILES_DIRECTORY) or path to a JSON file."""
+    global _default_loader
+    with _default_loader_lock:
+        if _default_loader is None:
+            _default_loader = ProfileLoader()
+    return _default_loader.load(profile, max_registers_per_request=max_registers_per_request,
+                                gap_merge_threshold=gap_merge_threshold)
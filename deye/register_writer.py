@@ -0,0 +1,159 @@
+import threading
+import time
+from .logger import getLogger
+
+
+# Результаты команд записи
+WRITE_OK = 'ok'                  # записано и прочитано обратно то же значение
+WRITE_MISMATCH = 'mismatch'      # записано, но прочитано другое значение
+WRITE_SUPERSEDED = 'superseded'  # не записывалось: в окне объединения пришло более новое значение
+WRITE_REJECTED = 'rejected'      # не записывалось: регистр не для записи или значение недопустимо
+WRITE_FAILED = 'failed'          # ошибка записи или чтения обратно
+
+
+class RegisterWriter(object):
+    """Coalescing, rate-limited writer of holding registers of one inverter.
+
+    submit() queues a value for a writable register. Values for the same
+    register received within coalesce_seconds of the first one are coalesced:
+    only the last one is written, the others are reported as superseded.
+    Writes go through the inverter polling session, not more often than once
+    per min_write_interval_seconds, and every write is verified by reading
+    the register back. on_result(result) is called for every command with
+    {'register', 'id', 'status', 'requested', 'value', 'error'}.
+
+    write() writes a value right away (without coalescing) and returns the
+    result; it shares the write interval with the queued commands.
+    """
+
+    def __init__(self, deye_inverter, coalesce_seconds=0.5, min_write_interval_seconds=1.0,
+                 on_result=None, logger=None, clock=time.monotonic):
+        self.deye_inverter = deye_inverter
+        self.coalesce_seconds = coalesce_seconds
+        self.min_write_interval_seconds = min_write_interval_seconds
+        self.on_result = on_result
+        self.clock = clock
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = getLogger("RegisterWriter")
+
+        self._condition = threading.Condition()
+        # имя регистра -> {'value', 'id', 'write_at'} - последняя команда, ожидающая записи
+        self._pending = {}
+        self._next_write_at = 0
+        # Идет запись (из потока очереди или из write()) - следующая ждет ее окончания
+        self._writing = False
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='register_writer', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def writable_registers(self):
+        return [
+            register_name for register_name, register_details in self.deye_inverter.well_known_registers.items()
+            if register_details.get('writable', False)
+        ]
+
+    def submit(self, register_name, value, command_id=None):
+        try:
+            self.deye_inverter.encode_value(register_name, value)
+        except ValueError as E:
+            self._report(register_name, command_id, WRITE_REJECTED, value, error=str(E))
+            return
+        with self._condition:
+            pending = self._pending.get(register_name)
+            if pending is None:
+                write_at = self.clock() + self.coalesce_seconds
+            else:
+                # Окно объединения отсчитывается от первой команды - поток команд не откладывает запись бесконечно
+                write_at = pending['write_at']
+            self._pending[register_name] = {'value': value, 'id': command_id, 'write_at': write_at}
+            self._condition.notify_all()
+        if pending is not None:
+            self._report(register_name, pending['id'], WRITE_SUPERSEDED, pending['value'])
+
+    def write(self, register_name, value, command_id=None):
+        """Write a value without coalescing, waits for the write interval; returns the result."""
+        try:
+            self.deye_inverter.encode_value(register_name, value)
+        except ValueError as E:
+            return self._report(register_name, command_id, WRITE_REJECTED, value, error=str(E))
+        with self._condition:
+            while True:
+                if self._stopped:
+                    return self._report(register_name, command_id, WRITE_FAILED, value, error="Writer is stopped")
+                wait_seconds = self._next_write_at - self.clock()
+                if (wait_seconds <= 0) and not self._writing:
+                    break
+                self._condition.wait(wait_seconds if wait_seconds > 0 else None)
+            self._writing = True
+        try:
+            return self._write(register_name, {'value': value, 'id': command_id})
+        finally:
+            self._write_done()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._stopped:
+                        return
+                    now = self.clock()
+                    if self._pending:
+                        register_name = min(self._pending, key=lambda name: self._pending[name]['write_at'])
+                        wait_seconds = max(self._pending[register_name]['write_at'], self._next_write_at) - now
+                        if (wait_seconds <= 0) and not self._writing:
+                            command = self._pending.pop(register_name)
+                            self._writing = True
+                            break
+                        if wait_seconds <= 0:
+                            wait_seconds = None
+                    else:
+                        wait_seconds = None
+                    self._condition.wait(wait_seconds)
+            try:
+                self._write(register_name, command)
+            finally:
+                self._write_done()
+
+    def _write_done(self):
+        with self._condition:
+            self._writing = False
+            self._next_write_at = self.clock() + self.min_write_interval_seconds
+            self._condition.notify_all()
+
+    def _write(self, register_name, command):
+        try:
+            raw_value, read_back_raw_value, read_back_value = self.deye_inverter.write_register(register_name, command['value'])
+        except Exception as E:
+            self.logger.error("[RegisterWriter] Writing %s = %s failed: %r", register_name, command['value'], E)
+            return self._report(register_name, command['id'], WRITE_FAILED, command['value'], error=repr(E))
+        if read_back_raw_value == raw_value:
+            self.logger.info("[RegisterWriter] %s = %s is written", register_name, read_back_value)
+            return self._report(register_name, command['id'], WRITE_OK, command['value'], value=read_back_value)
+        self.logger.error("[RegisterWriter] %s: wrote %s, read back %s", register_name, raw_value, read_back_raw_value)
+        return self._report(register_name, command['id'], WRITE_MISMATCH, command['value'], value=read_back_value)
+
+    def _report(self, register_name, command_id, status, requested, value=None, error=None):
+        result = {
+            'register': register_name, 'id': command_id, 'status': status,
+            'requested': requested, 'value': value, 'error': error,
+        }
+        if self.on_result is None:
+            return result
+        try:
+            self.on_result(result)
+        except Exception as E:
+            self.logger.error("[RegisterWriter] Error reporting result of %s: %r", register_name, E)
+        return result
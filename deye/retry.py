@@ -0,0 +1,124 @@
+import random
+import threading
+import time
+from .connection import CONNECTION_ERRORS
+from .modbus_rtu import ModbusException
+
+
+# Коды исключений Modbus после которых запрос имеет смысл повторить:
+# 5 - Acknowledge (запрос принят, но еще выполняется), 6 - Slave Device Busy
+RETRYABLE_MODBUS_EXCEPTION_CODES = (5, 6)
+
+
+class CircuitOpenError(Exception):
+    """The stick is marked unhealthy, requests are not sent until the breaker half-opens."""
+
+
+class RetryPolicy(object):
+    """Jittered exponential backoff for repeating failed requests.
+
+    The delay before attempt n (1 - the first repeat) is a random value
+    between 0 and min(backoff_max_seconds, backoff_initial_seconds * 2 ** (n - 1))
+    ("full jitter"), so concurrent pollers do not retry in lockstep.
+    """
+
+    def __init__(self, max_attempts=4, backoff_initial_seconds=0.25, backoff_max_seconds=5, random_uniform=random.uniform):
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+        self.max_attempts = max_attempts
+        self.backoff_initial_seconds = backoff_initial_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.random_uniform = random_uniform
+
+    def backoff(self, attempt):
+        return self.random_uniform(0, min(self.backoff_max_seconds, self.backoff_initial_seconds * 2 ** (attempt - 1)))
+
+    def is_retryable(self, exception):
+        if isinstance(exception, ModbusException):
+            return exception.exception_code in RETRYABLE_MODBUS_EXCEPTION_CODES
+        return isinstance(exception, CONNECTION_ERRORS)
+
+
+class CircuitBreaker(object):
+    """Marks a stick unhealthy after repeated failures.
+
+    closed    - requests are sent, consecutive failures are counted;
+    open      - after failure_threshold consecutive failures no requests are sent
+                for reset_timeout_seconds;
+    half_open - after the timeout exactly one request (the probe) is let through,
+                the others are rejected until the probe succeeds (the breaker
+                closes) or fails (it opens again). A caller whose allowed request
+                did not reach the stick gives the probe back with release(); a
+                probe which is not recorded in probe_timeout_seconds
+                (reset_timeout_seconds by default) is given to the next caller.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout_seconds=60, probe_timeout_seconds=None, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_seconds = reset_timeout_seconds
+        if probe_timeout_seconds is None:
+            probe_timeout_seconds = reset_timeout_seconds
+        self.probe_timeout_seconds = probe_timeout_seconds
+        self.clock = clock
+        self.consecutive_failures = 0
+        self.opened_count = 0
+        self._opened_at = None
+        # Время начала пробного запроса в half_open (None - пробного запроса нет)
+        self._probe_started_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def allow(self):
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return True
+            if state == self.OPEN:
+                return False
+            now = self.clock()
+            if (self._probe_started_at is not None) and (now - self._probe_started_at < self.probe_timeout_seconds):
+                return False
+            self._probe_started_at = now
+            return True
+
+    def release(self):
+        """The allowed request was not sent to the stick: let the next caller probe in half_open."""
+        with self._lock:
+            self._probe_started_at = None
+
+    def seconds_until_retry(self):
+        with self._lock:
+            if self._state() != self.OPEN:
+                return 0
+            return self._opened_at + self.reset_timeout_seconds - self.clock()
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self._opened_at = None
+            self._probe_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            state = self._state()
+            self.consecutive_failures = self.consecutive_failures + 1
+            if (state == self.HALF_OPEN) or (self.consecutive_failures >= self.failure_threshold):
+                if state != self.OPEN:
+                    self.opened_count = self.opened_count + 1
+                self._opened_at = self.clock()
+            self._probe_started_at = None
+
+    def _state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if self.clock() - self._opened_at < self.reset_timeout_seconds:
+            return self.OPEN
+        return self.HALF_OPEN
@@ -0,0 +1,126 @@
+import time
+import prometheus_client
+import prometheus_client.core
+
+
+# Границы корзин гистограмм задержек (секунды): от быстрого ответа стика в локальной
+# сети до таймаута сокета
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30)
+# Декодирование одного набора регистров занимает доли миллисекунды
+DECODE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+
+class InverterMetrics(object):
+    """Metric children of one inverter, passed to DeyeInverter / SolarmanConnection."""
+
+    def __init__(self, self_metrics, inverter_name):
+        self.connect_seconds = self_metrics.connect_seconds.labels(inverter_name)
+        self.window_read_seconds = self_metrics.window_read_seconds.labels(inverter_name)
+        self.decode_seconds = self_metrics.decode_seconds.labels(inverter_name)
+        self.cycle_jitter_seconds = self_metrics.cycle_jitter_seconds.labels(inverter_name)
+        self.retries = self_metrics.retries.labels(inverter_name)
+        self._errors = self_metrics.errors
+        self._bus_queue_wait_seconds = self_metrics.bus_queue_wait_seconds
+        self._inverter_name = inverter_name
+
+    def count_error(self, exception):
+        # Ошибки считаются по имени класса исключения (NoSocketAvailableError, TimeoutError, ...)
+        self._errors.labels(self._inverter_name, type(exception).__name__).inc()
+
+    def observe_bus_queue_wait(self, priority_name, seconds):
+        self._bus_queue_wait_seconds.labels(self._inverter_name, priority_name).observe(seconds)
+
+
+class _SnapshotAgeCollector(object):
+    def __init__(self, name, snapshot_store):
+        self.name = name
+        self.snapshot_store = snapshot_store
+
+    def collect(self):
+        snapshot_age = prometheus_client.core.GaugeMetricFamily(
+            self.name, 'Seconds since the data of the inverter was collected', labels=['inverter']
+        )
+        now = time.time()
+        for inverter_name, inverter_data in self.snapshot_store.latest().data.items():
+            # Данные инвертора еще ни разу не были собраны
+            if inverter_data['data_collected_at'] is None:
+                continue
+            snapshot_age.add_metric([inverter_name], now - inverter_data['data_collected_at'])
+        return [snapshot_age]
+
+
+class SelfMetrics(object):
+    """Metrics of the exporter itself.
+
+    All metrics are registered in a separate registry under the namespace
+    prefix (deye_exporter_* by default), so they do not mix with inverter
+    metrics, and are exposed on the same HTTP endpoint through the exposition
+    cache. Per-inverter children are created with for_inverter().
+    """
+
+    def __init__(self, namespace='deye_exporter', registry=None):
+        self.namespace = namespace
+        if registry is None:
+            registry = prometheus_client.CollectorRegistry()
+        self.registry = registry
+
+        prometheus_client.ProcessCollector(namespace=namespace, registry=registry)
+
+        self.connect_seconds = prometheus_client.Histogram(
+            'connect_seconds', 'Time to open a session to the logger stick',
+            ['inverter'], namespace=namespace, buckets=LATENCY_BUCKETS, registry=registry
+        )
+        self.window_read_seconds = prometheus_client.Histogram(
+            'window_read_seconds', 'Latency of one Modbus read window (request to response)',
+            ['inverter'], namespace=namespace, buckets=LATENCY_BUCKETS, registry=registry
+        )
+        self.decode_seconds = prometheus_client.Histogram(
+            'decode_seconds', 'Time to decode the registers read in one poll',
+            ['inverter'], namespace=namespace, buckets=DECODE_BUCKETS, registry=registry
+        )
+        self.cycle_jitter_seconds = prometheus_client.Histogram(
+            'cycle_jitter_seconds', 'Delay of the poll start relative to the scheduled deadline',
+            ['inverter'], namespace=namespace, buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+            registry=registry
+        )
+        self.retries = prometheus_client.Counter(
+            'read_retries', 'Repeated read attempts after a failed read',
+            ['inverter'], namespace=namespace, registry=registry
+        )
+        self.errors = prometheus_client.Counter(
+            'errors', 'Connection and read errors by exception type',
+            ['inverter', 'error'], namespace=namespace, registry=registry
+        )
+        self.bus_queue_wait_seconds = prometheus_client.Histogram(
+            'bus_queue_wait_seconds', 'Time a request to the stick waited for the bus by priority (write, fast_poll, slow_poll, scan)',
+            ['inverter', 'priority'], namespace=namespace,
+            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30), registry=registry
+        )
+        self.modbus_tcp_requests = prometheus_client.Counter(
+            'modbus_tcp_requests', 'Modbus TCP server reads by source (cache, forwarded, coalesced, error)',
+            ['inverter', 'source'], namespace=namespace, registry=registry
+        )
+        self.v5_proxy_requests = prometheus_client.Counter(
+            'v5_proxy_requests', 'Solarman V5 proxy requests by source (cache, forwarded, collapsed, error)',
+            ['inverter', 'source'], namespace=namespace, registry=registry
+        )
+        self.register_writes = prometheus_client.Counter(
+            'register_writes', 'Commands to write holding registers by result (ok, mismatch, superseded, rejected, failed)',
+            ['inverter', 'status'], namespace=namespace, registry=registry
+        )
+        self.circuit_breaker_open = prometheus_client.Gauge(
+            'circuit_breaker_open', '1 while the stick is marked unhealthy and is not polled',
+            ['inverter'], namespace=namespace, registry=registry
+        )
+
+    def for_inverter(self, inverter_name):
+        return InverterMetrics(self, inverter_name)
+
+    def watch_circuit_breaker(self, inverter_name, circuit_breaker):
+        self.circuit_breaker_open.labels(inverter_name).set_function(
+            lambda: int(circuit_breaker.state == circuit_breaker.OPEN)
+        )
+
+    def watch_snapshot_store(self, snapshot_store):
+        """Export the age of every inverter's data in snapshot_store."""
+        self.registry.register(_SnapshotAgeCollector(self.namespace + '_snapshot_age_seconds', snapshot_store))
@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+
+# Неизменяемый снимок данных: version растет на 1 при каждой публикации,
+# data - MappingProxyType (только чтение), created_at - time.time() публикации
+Snapshot = namedtuple('Snapshot', ['version', 'data', 'created_at'])
+
+
+def freeze(value):
+    """Read-only view of nested dicts (lists become tuples)."""
+    if isinstance(value, (dict, MappingProxyType)):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    """Plain dict copy of a frozen value (e.g. for json.dumps)."""
+    if isinstance(value, MappingProxyType):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+
+class SnapshotStore(object):
+    """Versioned store of immutable snapshots.
+
+    Writers replace the whole snapshot atomically (publish) or one top-level
+    key of it (update). Readers never copy data: they get the current
+    Snapshot with latest() or block in wait_for_newer() until a version newer
+    than the one they have seen is published.
+
+    A reader registered with add_consumer() reports processed versions with
+    consumed(); a writer which must not outrun it (e.g. replay of recorded
+    data) waits for that in wait_consumed().
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._snapshot = Snapshot(0, MappingProxyType({}), None)
+        # имя получателя -> последняя обработанная им версия
+        self._consumers = {}
+
+    def latest(self):
+        return self._snapshot
+
+    def publish(self, data):
+        frozen_data = freeze(data)
+        with self._condition:
+            self._snapshot = Snapshot(self._snapshot.version + 1, frozen_data, time.time())
+            self._condition.notify_all()
+            return self._snapshot
+
+    def update(self, key, value):
+        """Publish a new snapshot where only data[key] is replaced with value."""
+        frozen_value = freeze(value)
+        with self._condition:
+            data = dict(self._snapshot.data)
+            data[key] = frozen_value
+            self._snapshot = Snapshot(self._snapshot.version + 1, MappingProxyType(data), time.time())
+            self._condition.notify_all()
+            return self._snapshot
+
+    def wait_for_newer(self, version, timeout=None):
+        """Wait until a snapshot newer than version is published or timeout passes.
+
+        Returns the latest snapshot, its version is not newer than version on timeout.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._snapshot.version > version, timeout)
+            return self._snapshot
+
+    def add_consumer(self, name):
+        with self._condition:
+            self._consumers[name] = self._snapshot.version
+
+    def consumed(self, name, version):
+        with self._condition:
+            if name not in self._consumers:
+                return
+            self._consumers[name] = max(self._consumers[name], version)
+            self._condition.notify_all()
+
+    def wait_consumed(self, version, timeout=None):
+        """Wait until every registered consumer has processed version, returns False on timeout."""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: all(consumed_version >= version for consumed_version in self._consumers.values()), timeout
+            )
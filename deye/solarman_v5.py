@@ -0,0 +1,293 @@
+import asyncio
+import concurrent.futures
+import logging
+import struct
+import threading
+import time
+import pysolarmanv5
+from . import modbus_rtu
+from .logger import getLogger
+
+
+V5_START = 0xA5
+V5_END = 0x15
+V5_REQUEST_CONTROL_CODE = 0x4510
+V5_RESPONSE_CONTROL_CODE = 0x1510
+# "Keep-alive"/счетчик, который стик иногда присылает сам по себе - такие кадры игнорируются
+V5_COUNTER_CONTROL_CODE = 0x4710
+V5_FRAME_TYPE_SOLAR_INVERTER = 0x02
+
+# start(1) + length(2) + control code(2) + sequence(2) + logger serial(4)
+V5_HEADER_LENGTH = 11
+# checksum(1) + end(1)
+V5_TRAILER_LENGTH = 2
+# Полезная нагрузка перед Modbus RTU кадром в запросе: frame type(1) + sensor type(2) + 3 x time(4)
+V5_REQUEST_PAYLOAD_PREFIX = struct.pack('<BHIII', V5_FRAME_TYPE_SOLAR_INVERTER, 0, 0, 0, 0)
+# В ответе: frame type(1) + status(1) + 3 x time(4)
+V5_RESPONSE_PAYLOAD_PREFIX = struct.pack('<BBIII', V5_FRAME_TYPE_SOLAR_INVERTER, 1, 0, 0, 0)
+V5_RESPONSE_PAYLOAD_PREFIX_LENGTH = len(V5_RESPONSE_PAYLOAD_PREFIX)
+
+_HEADER = struct.Struct('<BHHBBI')
+
+
+def v5_checksum(frame):
+    # Сумма всех байт кроме start, checksum и end
+    return sum(memoryview(frame)[1:-2]) & 0xFF
+
+
+def encode_v5_frame(logger_serial, sequence_number, modbus_frame,
+                    control_code=V5_REQUEST_CONTROL_CODE, payload_prefix=V5_REQUEST_PAYLOAD_PREFIX, logger_sequence_number=0):
+    payload_length = len(payload_prefix) + len(modbus_frame)
+    frame = bytearray(V5_HEADER_LENGTH + payload_length + V5_TRAILER_LENGTH)
+    _HEADER.pack_into(frame, 0, V5_START, payload_length, control_code, sequence_number, logger_sequence_number, logger_serial)
+    frame[V5_HEADER_LENGTH:V5_HEADER_LENGTH + len(payload_prefix)] = payload_prefix
+    frame[V5_HEADER_LENGTH + len(payload_prefix):-V5_TRAILER_LENGTH] = modbus_frame
+    frame[-2] = v5_checksum(frame)
+    frame[-1] = V5_END
+    return frame
+
+
+def decode_v5_header(header):
+    """Returns (payload_length, control_code, sequence_number, logger_serial) of a V5 header."""
+    start, payload_length, control_code, sequence_number, _, logger_serial = _HEADER.unpack_from(header, 0)
+    if start != V5_START:
+        raise pysolarmanv5.V5FrameError("V5 frame contains invalid start value")
+    return payload_length, control_code, sequence_number, logger_serial
+
+
+def check_v5_frame(frame):
+    if frame[-1] != V5_END:
+        raise pysolarmanv5.V5FrameError("V5 frame contains invalid end value")
+    if frame[-2] != v5_checksum(frame):
+        raise pysolarmanv5.V5FrameError("V5 frame contains invalid V5 checksum")
+
+
+async def read_v5_frame(reader):
+    """Read one complete V5 frame from an asyncio StreamReader.
+
+    Returns (frame, control_code, sequence_number, logger_serial) where frame
+    is a memoryview over the received bytes.
+    """
+    header = await reader.readexactly(V5_HEADER_LENGTH)
+    payload_length, control_code, sequence_number, logger_serial = decode_v5_header(header)
+    body = await reader.readexactly(payload_length + V5_TRAILER_LENGTH)
+    frame = memoryview(header + body)
+    check_v5_frame(frame)
+    return frame, control_code, sequence_number, logger_serial
+
+
+class AsyncSolarmanV5Client(object):
+    """asyncio Solarman V5 client which keeps several requests in flight.
+
+    Every request gets its own V5 sequence number and replies are matched to
+    the waiting request by that number, so up to max_in_flight requests may be
+    outstanding on a single TCP connection at the same time.
+    on_request_latency(seconds), if set, is called with the time from sending
+    every request to receiving its reply.
+    """
+
+    def __init__(self, stick_logger_ip, stick_logger_serial, port=8899, mb_slave_id=1,
+                 logger=None, socket_timeout=15, max_in_flight=4, on_request_latency=None):
+        self.stick_logger_ip = stick_logger_ip
+        self.stick_logger_serial = stick_logger_serial
+        self.port = port
+        self.mb_slave_id = mb_slave_id
+        self.socket_timeout = socket_timeout
+        self.max_in_flight = max_in_flight
+        self.on_request_latency = on_request_latency
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = getLogger("AsyncSolarmanV5Client")
+
+        self.writer = None
+        self._reader_task = None
+        self._pending = {}
+        self._sequence_number = 0
+        self._in_flight = None
+
+    def is_connected(self):
+        return (self.writer is not None) and (not self.writer.is_closing()) and \
+            (self._reader_task is not None) and (not self._reader_task.done())
+
+    async def connect(self):
+        try:
+            reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.stick_logger_ip, self.port), self.socket_timeout
+            )
+        except (OSError, asyncio.TimeoutError) as E:
+            raise pysolarmanv5.NoSocketAvailableError("No socket available: {!r}".format(E))
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        self._reader_task = asyncio.get_running_loop().create_task(self._receive(reader))
+
+    async def disconnect(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.writer = None
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        self._fail_pending(pysolarmanv5.NoSocketAvailableError("Connection closed"))
+
+    async def read_holding_registers(self, register_addr, quantity):
+        return await self.send_modbus_request(
+            modbus_rtu.read_holding_registers_request(self.mb_slave_id, register_addr, quantity)
+        )
+
+    async def write_multiple_holding_registers(self, register_addr, values):
+        return await self.send_modbus_request(
+            modbus_rtu.write_multiple_registers_request(self.mb_slave_id, register_addr, values)
+        )
+
+    async def read_windows(self, windows, return_exceptions=False):
+        """Read all (start, quantity) windows concurrently, results are returned in windows order.
+
+        With return_exceptions a failed window does not fail the others, its
+        exception is returned in place of its values.
+        """
+        return await asyncio.gather(
+            *[self.read_holding_registers(start, quantity) for start, quantity in windows],
+            return_exceptions=return_exceptions
+        )
+
+    async def send_modbus_request(self, modbus_request):
+        response = await self.send_raw_modbus_frame(modbus_request)
+        return modbus_rtu.parse_response(response, modbus_request)
+
+    async def send_raw_modbus_frame(self, modbus_request):
+        """Send a Modbus RTU frame wrapped into V5 and return the RTU frame from the reply."""
+        if not self.is_connected():
+            raise pysolarmanv5.NoSocketAvailableError("Connection already closed.")
+        async with self._in_flight:
+            sequence_number = self._next_sequence_number()
+            future = asyncio.get_running_loop().create_future()
+            self._pending[sequence_number] = future
+            try:
+                sent_at = time.monotonic()
+                self.writer.write(encode_v5_frame(self.stick_logger_serial, sequence_number, modbus_request))
+                await self.writer.drain()
+                response = await asyncio.wait_for(future, self.socket_timeout)
+                if self.on_request_latency is not None:
+                    self.on_request_latency(time.monotonic() - sent_at)
+                return response
+            finally:
+                self._pending.pop(sequence_number, None)
+
+    def _next_sequence_number(self):
+        # Номер последовательности - 1 байт, который стик возвращает в ответе.
+        # Пропускаем номера, по которым еще ждем ответ
+        for _ in range(256):
+            self._sequence_number = (self._sequence_number + 1) & 0xFF
+            if self._sequence_number not in self._pending:
+                return self._sequence_number
+        raise pysolarmanv5.V5FrameError("No free V5 sequence numbers")
+
+    async def _receive(self, reader):
+        try:
+            while True:
+                frame, control_code, sequence_number, logger_serial = await read_v5_frame(reader)
+                if control_code == V5_COUNTER_CONTROL_CODE:
+                    continue
+                future = self._pending.get(sequence_number & 0xFF)
+                if future is None or future.done():
+                    if self.logger.isEnabledFor(logging.DEBUG):
+                        self.logger.debug("[AsyncSolarmanV5Client] Discarding unexpected frame: %s", bytes(frame).hex(' '))
+                    continue
+                if control_code != V5_RESPONSE_CONTROL_CODE or logger_serial != self.stick_logger_serial:
+                    future.set_exception(pysolarmanv5.V5FrameError("V5 frame contains incorrect control code or logger serial"))
+                    continue
+                if frame[V5_HEADER_LENGTH] != V5_FRAME_TYPE_SOLAR_INVERTER:
+                    future.set_exception(pysolarmanv5.V5FrameError("V5 frame contains invalid frametype"))
+                    continue
+                modbus_frame = frame[V5_HEADER_LENGTH + V5_RESPONSE_PAYLOAD_PREFIX_LENGTH:-V5_TRAILER_LENGTH]
+                if len(modbus_frame) < 5:
+                    future.set_exception(pysolarmanv5.V5FrameError("V5 frame does not contain a valid Modbus RTU frame"))
+                    continue
+                future.set_result(modbus_frame)
+        except asyncio.CancelledError:
+            raise
+        except (asyncio.IncompleteReadError, OSError, pysolarmanv5.V5FrameError) as E:
+            # Соединение закрыто или поток байт рассинхронизирован - дальше читать нельзя
+            self.logger.debug("[AsyncSolarmanV5Client] Receiver stopped: %r", E)
+            self._fail_pending(pysolarmanv5.NoSocketAvailableError("Connection closed on read: {!r}".format(E)))
+            if self.writer is not None:
+                self.writer.close()
+
+    def _fail_pending(self, exception):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(exception)
+
+
+# Общий цикл событий всех синхронных клиентов - один поток на весь процесс, а не на стик
+_shared_loop = None
+_shared_loop_lock = threading.Lock()
+
+
+def shared_event_loop():
+    """The event loop all SolarmanV5Client sessions run on, started with its thread on first use."""
+    global _shared_loop
+    with _shared_loop_lock:
+        if _shared_loop is None:
+            _shared_loop = asyncio.new_event_loop()
+            threading.Thread(target=_shared_loop.run_forever, name='solarman_v5_loop', daemon=True).start()
+        return _shared_loop
+
+
+class SolarmanV5Client(object):
+    """Synchronous facade over AsyncSolarmanV5Client.
+
+    The asyncio clients of all sessions run on one shared event loop thread
+    (shared_event_loop()), calls from the caller thread submit a coroutine
+    to it and block until the coroutine finishes. A coroutine which does not
+    finish in time is cancelled.
+    """
+
+    # Ответы сопоставляются с запросами по номеру последовательности, опоздавший ответ
+    # на запрос с ошибкой (таймаутом) просто отбрасывается - сессию можно использовать дальше
+    discards_late_replies = True
+
+    def __init__(self, stick_logger_ip, stick_logger_serial, port=8899, mb_slave_id=1,
+                 logger=None, socket_timeout=15, max_in_flight=4, on_request_latency=None, **kwargs):
+        self.socket_timeout = socket_timeout
+        self.client = AsyncSolarmanV5Client(
+            stick_logger_ip, stick_logger_serial, port=port, mb_slave_id=mb_slave_id,
+            logger=logger, socket_timeout=socket_timeout, max_in_flight=max_in_flight,
+            on_request_latency=on_request_latency
+        )
+        self.loop = shared_event_loop()
+        self._run(self.client.connect())
+
+    @property
+    def sock(self):
+        if self.client.writer is None:
+            return None
+        return self.client.writer.get_extra_info('socket')
+
+    def is_connected(self):
+        return self.loop.is_running() and self.client.is_connected()
+
+    def read_holding_registers(self, register_addr, quantity):
+        return self._run(self.client.read_holding_registers(register_addr, quantity))
+
+    def write_multiple_holding_registers(self, register_addr, values):
+        return self._run(self.client.write_multiple_holding_registers(register_addr, values))
+
+    def read_windows(self, windows, return_exceptions=False):
+        return self._run(self.client.read_windows(windows, return_exceptions))
+
+    def disconnect(self):
+        self._run(self.client.disconnect())
+
+    def _run(self, coroutine):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        try:
+            # Запас сверх socket_timeout - что бы таймаут сработал внутри цикла событий, а не здесь
+            return future.result(self.socket_timeout * 2)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
@@ -0,0 +1,251 @@
+import asyncio
+import struct
+import threading
+import time
+import pysolarmanv5
+from . import modbus_rtu
+from .logger import getLogger
+from .register_writer import WRITE_OK, WRITE_MISMATCH, WRITE_REJECTED
+from .solarman_v5 import (
+    read_v5_frame, encode_v5_frame,
+    V5_HEADER_LENGTH, V5_TRAILER_LENGTH, V5_REQUEST_CONTROL_CODE, V5_RESPONSE_CONTROL_CODE,
+    V5_REQUEST_PAYLOAD_PREFIX, V5_RESPONSE_PAYLOAD_PREFIX,
+)
+
+
+# Коды исключений Modbus которые возвращает прокси
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_DATA_VALUE = 0x03
+SLAVE_DEVICE_FAILURE = 0x04
+GATEWAY_TARGET_FAILED = 0x0B
+
+# Откуда взят ответ (метрика v5_proxy_requests): кеш ответов, запрос к стику, такой же запрос
+# другого клиента который уже выполнялся, ошибка
+SOURCE_CACHE = 'cache'
+SOURCE_FORWARDED = 'forwarded'
+SOURCE_COLLAPSED = 'collapsed'
+SOURCE_ERROR = 'error'
+
+
+class SolarmanV5Proxy(object):
+    """Solarman V5 server multiplexing many client sessions onto the exporter's stick sessions.
+
+    Clients which only speak V5 (e.g. the vendor app) connect to the proxy
+    as if it was the logger stick. The Modbus request of every client frame
+    is executed through the bus of the inverter (DeyeInverter.read_holding_registers
+    and the bus arbiter), so the clients do not take sockets of the stick;
+    the reply is sent back with the client's logger serial and sequence
+    number. Clients are routed to an inverter by the logger serial in their
+    frames (the stick serial of the inverter); with a single inverter any
+    serial is accepted.
+
+    Identical read requests (0x03) outstanding at the same time are sent to
+    the stick once, replies to reads are reused for cache_seconds. Writes
+    (0x10) are accepted only with allow_writes and only of a single writable
+    register of the profile with a value within its min/max (otherwise
+    ILLEGAL_DATA_VALUE, so a request is never written partially); they go
+    through the RegisterWriter of the inverter (register_writers is
+    {inverter name: RegisterWriter}), so they share its write interval with
+    the MQTT commands, and drop the reply cache of the inverter. A write
+    which does not read back as written gets SLAVE_DEVICE_FAILURE. Other
+    function codes get an ILLEGAL_FUNCTION exception.
+    deye_inverters is {inverter name: DeyeInverter}. The proxy runs its own
+    event loop thread: start() / stop().
+    """
+
+    def __init__(self, deye_inverters, host='127.0.0.1', port=8899, cache_seconds=1, allow_writes=False,
+                 register_writers=None, self_metrics=None, logger=None):
+        self.host = host
+        self.port = port
+        self.cache_seconds = cache_seconds
+        self.allow_writes = allow_writes
+        self.register_writers = dict(register_writers or {})
+        self.self_metrics = self_metrics
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = getLogger("SolarmanV5Proxy")
+
+        self.deye_inverters = dict(deye_inverters)
+        self.inverter_names_by_serial = {
+            int(deye_inverter.stick_logger_serial): inverter_name for inverter_name, deye_inverter in self.deye_inverters.items()
+        }
+        self.default_inverter_name = next(iter(self.deye_inverters)) if len(self.deye_inverters) == 1 else None
+        # Имя инвертора -> {Modbus RTU запрос: (время, Modbus RTU ответ)}
+        self.response_cache = {inverter_name: {} for inverter_name in self.deye_inverters}
+        # (имя инвертора, Modbus RTU запрос) -> выполняющийся запрос к стику
+        self._requests_in_flight = {}
+        # Счетчики для мониторинга и проверки
+        self.clients_count = 0
+        self.open_clients = 0
+
+        self.loop = None
+        self._server = None
+        self._loop_thread = None
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self.loop.run_forever, name='solarman_v5_proxy', daemon=True)
+        self._loop_thread.start()
+        asyncio.run_coroutine_threadsafe(self._start_server(), self.loop).result(10)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.logger.info("[SolarmanV5Proxy] Serving Solarman V5 on {}:{}".format(self.host, self.port))
+        return self
+
+    def stop(self):
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._stop_server(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._loop_thread.join(5)
+        self.loop.close()
+        self.loop = None
+
+    async def _start_server(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+
+    async def _stop_server(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle_connection(self, reader, writer):
+        self.clients_count = self.clients_count + 1
+        self.open_clients = self.open_clients + 1
+        # Ответы на запросы клиента, которые еще выполняются - отменяются при закрытии соединения
+        reply_tasks = set()
+        try:
+            while True:
+                frame, control_code, sequence_number, logger_serial = await read_v5_frame(reader)
+                if control_code != V5_REQUEST_CONTROL_CODE:
+                    continue
+                inverter_name = self.inverter_names_by_serial.get(logger_serial, self.default_inverter_name)
+                if inverter_name is None:
+                    # Как и стик - запросы с чужим серийным номером остаются без ответа
+                    continue
+                modbus_request = bytes(frame[V5_HEADER_LENGTH + len(V5_REQUEST_PAYLOAD_PREFIX):-V5_TRAILER_LENGTH])
+                if (len(modbus_request) < 4) or (not modbus_rtu.check_crc(modbus_request)):
+                    continue
+                # Запросы клиента выполняются параллельно - ответ из кеша не ждет ответа стика
+                reply_task = asyncio.get_running_loop().create_task(
+                    self._reply(writer, logger_serial, sequence_number, inverter_name, modbus_request)
+                )
+                reply_tasks.add(reply_task)
+                reply_task.add_done_callback(reply_tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError, pysolarmanv5.V5FrameError):
+            pass
+        finally:
+            for reply_task in list(reply_tasks):
+                reply_task.cancel()
+            self.open_clients = self.open_clients - 1
+            writer.close()
+
+    async def _reply(self, writer, logger_serial, sequence_number, inverter_name, modbus_request):
+        modbus_response, source = await self._modbus_response(inverter_name, modbus_request)
+        self._count(inverter_name, source)
+        if writer.is_closing():
+            return
+        writer.write(encode_v5_frame(
+            logger_serial, sequence_number, modbus_response,
+            control_code=V5_RESPONSE_CONTROL_CODE, payload_prefix=V5_RESPONSE_PAYLOAD_PREFIX
+        ))
+        try:
+            # Клиент, который не читает ответы, не должен копить их в памяти прокси
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _modbus_response(self, inverter_name, modbus_request):
+        function_code = modbus_request[1]
+        if function_code == modbus_rtu.READ_HOLDING_REGISTERS and len(modbus_request) == 8:
+            response_cache = self.response_cache[inverter_name]
+            cached = response_cache.get(modbus_request)
+            if (cached is not None) and (time.monotonic() - cached[0] <= self.cache_seconds):
+                return cached[1], SOURCE_CACHE
+            key = (inverter_name, modbus_request)
+            request = self._requests_in_flight.get(key)
+            source = SOURCE_COLLAPSED
+            if request is None:
+                source = SOURCE_FORWARDED
+                request = asyncio.ensure_future(self._execute(inverter_name, modbus_request))
+                self._requests_in_flight[key] = request
+                request.add_done_callback(lambda future: self._requests_in_flight.pop(key, None))
+            modbus_response, failed = await asyncio.shield(request)
+            return modbus_response, (SOURCE_ERROR if failed else source)
+
+        if function_code == modbus_rtu.WRITE_MULTIPLE_REGISTERS and self.allow_writes and \
+                (inverter_name in self.register_writers) and \
+                len(modbus_request) >= 9 and len(modbus_request) == 9 + modbus_request[6]:
+            # После записи ранее прочитанные ответы могут быть неверны (в том числе ответы на
+            # чтения, которые выполнялись во время записи)
+            self.response_cache[inverter_name].clear()
+            modbus_response, failed = await self._write(inverter_name, modbus_request)
+            self.response_cache[inverter_name].clear()
+            return modbus_response, (SOURCE_ERROR if failed else SOURCE_FORWARDED)
+
+        return self._exception(modbus_request, ILLEGAL_FUNCTION), SOURCE_ERROR
+
+    async def _execute(self, inverter_name, modbus_request):
+        """Execute a read request through the inverter bus, returns (RTU response, failed)."""
+        deye_inverter = self.deye_inverters[inverter_name]
+        slave_id, function_code, register_addr, quantity = struct.unpack_from('>BBHH', modbus_request, 0)
+        try:
+            values = await asyncio.get_running_loop().run_in_executor(
+                None, deye_inverter.read_holding_registers, register_addr, quantity
+            )
+            modbus_response = modbus_rtu.add_crc(struct.pack(
+                '>BBB{}H'.format(len(values)), slave_id, function_code, len(values) * 2, *values
+            ))
+            self._cache_response(inverter_name, modbus_request, modbus_response)
+            return modbus_response, False
+        except modbus_rtu.ModbusException as E:
+            return self._exception(modbus_request, E.exception_code), True
+        except Exception as E:
+            self.logger.error("[SolarmanV5Proxy] Inverter %s: error executing request %s: %r",
+                              inverter_name, modbus_request.hex(' '), E)
+            return self._exception(modbus_request, GATEWAY_TARGET_FAILED), True
+
+    async def _write(self, inverter_name, modbus_request):
+        """Write registers of a write request through the RegisterWriter, returns (RTU response, failed)."""
+        register_writer = self.register_writers[inverter_name]
+        register_addr, quantity = struct.unpack_from('>HH', modbus_request, 2)
+        if modbus_request[6] != quantity * 2:
+            return self._exception(modbus_request, ILLEGAL_DATA_VALUE), True
+        raw_values = struct.unpack_from('>{}H'.format(quantity), modbus_request, 7)
+        try:
+            if quantity != 1:
+                # RegisterWriter пишет по одному регистру - запрос из нескольких регистров мог бы
+                # записаться частично, если запись одного из них не удалась
+                raise ValueError("Write of {} registers from {}, only single register writes are allowed".format(
+                    quantity, register_addr))
+            [(register_name, value)] = self.deye_inverters[inverter_name].writable_values(register_addr, raw_values)
+        except ValueError as E:
+            self.logger.error("[SolarmanV5Proxy] Inverter %s: write rejected: %s", inverter_name, E)
+            return self._exception(modbus_request, ILLEGAL_DATA_VALUE), True
+        result = await asyncio.get_running_loop().run_in_executor(
+            None, register_writer.write, register_name, value, 'v5_proxy'
+        )
+        if result['status'] == WRITE_OK:
+            return modbus_rtu.add_crc(modbus_request[:6]), False
+        if result['status'] == WRITE_REJECTED:
+            return self._exception(modbus_request, ILLEGAL_DATA_VALUE), True
+        if result['status'] == WRITE_MISMATCH:
+            # Инвертор не принял значение - клиенту нельзя сообщать что настройка применена
+            return self._exception(modbus_request, SLAVE_DEVICE_FAILURE), True
+        return self._exception(modbus_request, GATEWAY_TARGET_FAILED), True
+
+    def _cache_response(self, inverter_name, modbus_request, modbus_response):
+        response_cache = self.response_cache[inverter_name]
+        now = time.monotonic()
+        if len(response_cache) >= 1024:
+            for cached_request, cached in list(response_cache.items()):
+                if now - cached[0] > self.cache_seconds:
+                    del response_cache[cached_request]
+        response_cache[modbus_request] = (now, modbus_response)
+
+    @staticmethod
+    def _exception(modbus_request, exception_code):
+        return modbus_rtu.add_crc(struct.pack('>BBB', modbus_request[0], modbus_request[1] | 0x80, exception_code))
+
+    def _count(self, inverter_name, source):
+        if self.self_metrics:
+            self.self_metrics.v5_proxy_requests.labels(inverter_name, source).inc()
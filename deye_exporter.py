@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import json
 import logging
 import os
@@ -9,8 +10,6 @@ import select
 import sys
 import time
 import threading
-import queue
-import paho.mqtt.client as mqtt
 # custom module
 import deye
 
@@ -18,48 +17,156 @@ log = logging.getLogger()
 
 def main():
 
-    empty_queue_sleep_seconds = 10
+    # Минимальный интервал между публикациями полного JSON сообщения в MQTT
     mqtt_send_sleep_seconds = 30
     data_collection_period_seconds = 20
-    sleep_on_data_collection_error_seconds = 60
     # Если в течении этого числа секунд нет новых данных
     # то считаем что данные устарели
     data_is_outdated_after_collected_seconds = 600
 
-    init_logging(True)
+    # Уровень как у логгеров модуля deye: DEBUG только если задана переменная DEBUG
+    init_logging("DEBUG" in os.environ)
     log.info('[main] Starting ...')
 
-    if ("DEYE_LOGGER_IP" in os.environ) and ("DEYE_LOGGER_SERIAL" in os.environ):
-        log.info("[main] Found inverter configuration env variables: DEYE_LOGGER_IP, DEYE_LOGGER_SERIAL")
+    # Режим воспроизведения: вместо опроса стиков данные берутся из записанного кольцевого
+    # буфера сырых образов регистров (DEYE_REPLAY_FILE) и ускоряются в DEYE_REPLAY_SPEED раз
+    replay_file = os.environ.get('DEYE_REPLAY_FILE')
+    raw_ring_buffer = None
+    if replay_file:
+        raw_ring_buffer = deye.RawRingBuffer(replay_file)
+        inverters_configuration = [
+            {'name': inverter_name, 'ip': 'replay', 'serial': 0, 'port': 8899, 'mb_slave_id': 1,
+             'profile': os.environ.get('DEYE_PROFILE', deye.register_profile.DEFAULT_PROFILE)}
+            for inverter_name in sorted(set(record[1] for record in raw_ring_buffer.records()))
+        ]
+        fleet_workers = 1
+        log.info("[main] Inverters to replay: {}".format([inverter_configuration['name'] for inverter_configuration in inverters_configuration]))
     else:
-        raise ValueError("Please define DEYE_LOGGER_IP and  DEYE_LOGGER_SERIAL environment variables")
+        inverters_configuration, fleet_workers = load_inverters_configuration()
+        log.info("[main] Inverters to poll: {}, poll workers: {}".format(
+            [inverter_configuration['name'] for inverter_configuration in inverters_configuration], fleet_workers)
+        )
+    # Метрики самого экспортера (задержки, ошибки, возраст данных) - в отдельном реестре
+    # с префиксом deye_exporter_, отдаются тем же HTTP сервером что и метрики инверторов
+    self_metrics = deye.SelfMetrics()
+    deye_inverters = create_inverters(inverters_configuration, self_metrics)
+
+    # Необязательная запись каждого прочитанного образа регистров в кольцевой буфер на диске
+    # (RAW_RING_BUFFER_FILE, RAW_RING_BUFFER_CAPACITY записей) - история высокого разрешения
+    # для разбора инцидентов, доступна по HTTP /raw и для воспроизведения
+    if (not replay_file) and os.environ.get('RAW_RING_BUFFER_FILE'):
+        raw_ring_buffer = deye.RawRingBuffer(
+            os.environ.get('RAW_RING_BUFFER_FILE'),
+            capacity=int(os.environ.get('RAW_RING_BUFFER_CAPACITY', 50000)),
+            image_registers=max(
+                len(deye_inverter.inverter_read_raw_result_all_registers) for deye_inverter in deye_inverters.values()
+            )
+        )
+        log.info("[main] Raw register images are recorded to {}".format(raw_ring_buffer.path))
 
-    # Очередь для передачи данных в поток експортера
-    collected_data_queue_for_exporter = queue.LifoQueue(maxsize=1)
-    # Определяем переменную для очереди, но создаем ее только если это нужно
-    # (нужно когда определены параметры MQTT)
-    collected_data_queue_for_mqtt = None
+    # Хранилище снимков собранных данных: поток сбора данных публикует в него новые версии,
+    # экспортер и поток MQTT читают последнюю версию не копируя и не изменяя данные
+    snapshot_store = deye.SnapshotStore()
+    self_metrics.watch_snapshot_store(snapshot_store)
+
+    # Имя инвертора -> RegisterWriter: запись регистров командами MQTT и клиентами прокси V5
+    register_writers = {}
+
+    # Расписания опроса регистров (у каждого регистра свой poll_interval), общие для потока
+    # сбора данных и записи регистров: записанный регистр опрашивается сразу после записи
+    poll_schedulers = {
+        inverter_name: deye.PollScheduler(deye_inverter.well_known_registers, data_collection_period_seconds)
+        for inverter_name, deye_inverter in deye_inverters.items()
+    }
 
     # Если параметры MQTT определены то создавать отдельный поток для отправки в в MQTT
-    # и отдельную очередь для таких сообщений
     if ( ('MQTT_HOST' in os.environ) and ('MQTT_USERNAME' in os.environ) and ('MQTT_PASSWORD' in os.environ) ):
         mqtt_host = os.environ.get('MQTT_HOST')
         mqtt_username = os.environ.get('MQTT_USERNAME')
         mqtt_password = os.environ.get('MQTT_PASSWORD')
-        mqtt_topic = os.environ.get('MQTT_TOPIC', 'homeassistant/sensor/inverter/state')
-
-        collected_data_queue_for_mqtt = queue.LifoQueue(maxsize=1)
+        # В топике можно использовать {inverter} - он будет заменен на имя инвертора,
+        # для одного инвертора имя по-умолчанию 'inverter'
+        mqtt_topic = os.environ.get('MQTT_TOPIC', 'homeassistant/sensor/{inverter}/state')
+        # Режим публикации:
+        #  json  - весь набор данных инвертора одним JSON сообщением в MQTT_TOPIC (по-умолчанию)
+        #  delta - каждое поле в свой retained топик MQTT_FIELD_TOPIC и только когда значение
+        #          изменилось больше чем на deadband регистра (или прошло MQTT_HEARTBEAT_SECONDS)
+        mqtt_publish_mode = os.environ.get('MQTT_PUBLISH_MODE', 'json')
+        if mqtt_publish_mode not in ('json', 'delta'):
+            raise ValueError("MQTT_PUBLISH_MODE must be 'json' or 'delta'")
+        mqtt_field_topic = os.environ.get('MQTT_FIELD_TOPIC', 'deye/{inverter}/{field}')
+        mqtt_heartbeat_seconds = int(os.environ.get('MQTT_HEARTBEAT_SECONDS', 300))
+        # События ошибок инвертора (появилась / исчезла), пустая строка - не публиковать
+        mqtt_fault_events_topic = os.environ.get('MQTT_FAULT_EVENTS_TOPIC', 'deye/{inverter}/fault_events')
+        delta_filters = {
+            inverter_name: deye.DeltaFilter(deye_inverter.well_known_registers, heartbeat_seconds=mqtt_heartbeat_seconds)
+            for inverter_name, deye_inverter in deye_inverters.items()
+        }
+
+        # Одна долгоживущая сессия MQTT на все время работы. Топик доступности получает 'online'
+        # при подключении и 'offline' (last will) при потере сессии
+        mqtt_publisher = deye.MqttPublisher(
+            mqtt_host, mqtt_username, mqtt_password,
+            mqtt_port=int(os.environ.get('MQTT_PORT', 1883)),
+            availability_topic=os.environ.get('MQTT_AVAILABILITY_TOPIC', 'deye_exporter/availability'),
+            max_inflight_messages=int(os.environ.get('MQTT_MAX_INFLIGHT', 20)),
+            registry=self_metrics.registry
+        )
+        mqtt_publisher.start()
+
+        # Конфигурации MQTT discovery для Home Assistant генерируются из таблицы регистров
+        # и публикуются (retained) только если изменились, либо когда HA сообщает о своем старте
+        if os.environ.get('HA_DISCOVERY', '1') != '0':
+            ha_discovery = deye.HomeAssistantDiscovery(
+                mqtt_publisher,
+                discovery_prefix=os.environ.get('HA_DISCOVERY_PREFIX', 'homeassistant'),
+                status_topic=os.environ.get('HA_STATUS_TOPIC', 'homeassistant/status'),
+                state_file=os.environ.get(
+                    'HA_DISCOVERY_STATE_FILE',
+                    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ha_discovery_state.json')
+                )
+            )
+            for inverter_name, deye_inverter in deye_inverters.items():
+                ha_discovery.add_inverter(
+                    inverter_name, deye_inverter.well_known_registers,
+                    state_topic=mqtt_topic,
+                    field_topic=mqtt_field_topic if mqtt_publish_mode == 'delta' else None,
+                    availability_topic=mqtt_publisher.availability_topic
+                )
+            ha_discovery.start()
+
+        # Команды записи регистров, помеченных в профиле как writable: значение публикуется в
+        # MQTT_COMMAND_TOPIC (число или JSON {"value": ..., "id": ...}), результат записи -
+        # в MQTT_COMMAND_RESULT_TOPIC. Пустой MQTT_COMMAND_TOPIC - команды отключены
+        mqtt_command_topic = os.environ.get('MQTT_COMMAND_TOPIC', 'deye/{inverter}/{field}/set')
+        if mqtt_command_topic and not replay_file:
+            register_writers = start_register_writers(
+                deye_inverters, mqtt_publisher, mqtt_command_topic,
+                os.environ.get('MQTT_COMMAND_RESULT_TOPIC', 'deye/{inverter}/{field}/result'),
+                poll_schedulers, self_metrics,
+                coalesce_seconds=float(os.environ.get('MQTT_COMMAND_COALESCE_SECONDS', 0.5)),
+                min_write_interval_seconds=float(os.environ.get('MQTT_COMMAND_MIN_INTERVAL_SECONDS', 1))
+            )
+            log.info("[main] Register commands are accepted for: {}".format(
+                {inverter_name: register_writer.writable_registers() for inverter_name, register_writer in register_writers.items()})
+            )
 
         th_send_data_to_mqtt = threading.Thread(target=send_data_to_mqtt, args=(
-                collected_data_queue_for_mqtt,
-                empty_queue_sleep_seconds,
+                snapshot_store,
                 mqtt_send_sleep_seconds,
                 mqtt_topic,
-                mqtt_host,
-                mqtt_username,
-                mqtt_password,
+                mqtt_publisher,
+                mqtt_publish_mode,
+                mqtt_field_topic,
+                delta_filters,
+                mqtt_heartbeat_seconds,
+                mqtt_fault_events_topic,
+                bool(replay_file),
             ),
             name='send_data_therad')
+        if replay_file:
+            # Воспроизведение ждет публикации каждой версии данных
+            snapshot_store.add_consumer('send_data_to_mqtt')
 
         th_send_data_to_mqtt.daemon = True
         th_send_data_to_mqtt.start()
@@ -68,44 +175,104 @@ def main():
         log.debug("[main] MQTT variables are not defined, thread is not started")
 
     # Создаем отдельный поток для сбора данных который будет опрашивать инвертор
-    th_collect_data = threading.Thread(target=collect_data, args=(
-            collected_data_queue_for_mqtt,
-            collected_data_queue_for_exporter,
-            data_collection_period_seconds,
-            sleep_on_data_collection_error_seconds
-        ),
-        name='collect_data_therad')
+    # (или воспроизводить записанные данные)
+    if replay_file:
+        th_collect_data = threading.Thread(target=replay_data, args=(
+                deye_inverters,
+                raw_ring_buffer,
+                snapshot_store,
+                data_collection_period_seconds,
+                float(os.environ.get('DEYE_REPLAY_SPEED', 10))
+            ),
+            name='replay_data_therad')
+    else:
+        th_collect_data = threading.Thread(target=collect_data, args=(
+                deye_inverters,
+                fleet_workers,
+                snapshot_store,
+                data_collection_period_seconds,
+                raw_ring_buffer,
+                poll_schedulers
+            ),
+            name='collect_data_therad')
     th_collect_data.daemon = True
     th_collect_data.start()
 
+    # Необязательный Modbus TCP сервер (MODBUS_TCP_PORT) для сторонних программ: чтение регистров
+    # (функция 0x03) из последнего образа опроса, остальные регистры читаются из стика через
+    # соединение экспортера - вместо нескольких программ стик опрашивает один экспортер
+    if (not replay_file) and os.environ.get('MODBUS_TCP_PORT'):
+        modbus_tcp_server = deye.ModbusTcpServer(
+            deye_inverters,
+            unit_ids={
+                inverter_configuration['name']: inverter_configuration['modbus_unit_id']
+                for inverter_configuration in inverters_configuration
+            },
+            host=os.environ.get('MODBUS_TCP_HOST', '127.0.0.1'),
+            port=int(os.environ.get('MODBUS_TCP_PORT')),
+            default_poll_interval_seconds=data_collection_period_seconds,
+            forward_max_age_seconds=float(os.environ.get('MODBUS_TCP_FORWARD_MAX_AGE_SECONDS', 1)),
+            self_metrics=self_metrics
+        )
+        modbus_tcp_server.start()
+
+    # Необязательный прокси Solarman V5 (V5_PROXY_PORT) для программ которые умеют только V5
+    # (например приложение производителя): запросы всех клиентов выполняются через соединение
+    # экспортера со стиком, одинаковые одновременные чтения объединяются, ответы кешируются
+    if (not replay_file) and os.environ.get('V5_PROXY_PORT'):
+        # Запись клиентами прокси - через тот же RegisterWriter что и команды MQTT (общий интервал
+        # между записями); без команд MQTT - отдельный RegisterWriter с тем же интервалом
+        proxy_register_writers = dict(register_writers)
+        for inverter_name, deye_inverter in deye_inverters.items():
+            if inverter_name not in proxy_register_writers:
+                proxy_register_writers[inverter_name] = deye.RegisterWriter(
+                    deye_inverter, min_write_interval_seconds=float(os.environ.get('MQTT_COMMAND_MIN_INTERVAL_SECONDS', 1))
+                )
+        solarman_v5_proxy = deye.SolarmanV5Proxy(
+            deye_inverters,
+            host=os.environ.get('V5_PROXY_HOST', '127.0.0.1'),
+            port=int(os.environ.get('V5_PROXY_PORT')),
+            cache_seconds=float(os.environ.get('V5_PROXY_CACHE_SECONDS', 1)),
+            allow_writes=os.environ.get('V5_PROXY_ALLOW_WRITES', '0') in ('1', 'true', 'yes'),
+            register_writers=proxy_register_writers,
+            self_metrics=self_metrics
+        )
+        solarman_v5_proxy.start()
 
-    idx = 0
 
-    # отключить встроенные метрики языка
-    prometheus_client.REGISTRY.unregister(prometheus_client.PROCESS_COLLECTOR)
-    prometheus_client.REGISTRY.unregister(prometheus_client.PLATFORM_COLLECTOR)
-    prometheus_client.REGISTRY.unregister(prometheus_client.GC_COLLECTOR)
-    # зарегестрировать объект как экспортер для того что бы его метод
-    # collect()  был вызван при обращении по https(s) к экспортеру.
-    # При этом этот класс должен быть написан специальным образом -
-    # отнаследован от prometheus_client.registry.Collector и иметь
-    # метода collect()
-    # Примерно вот так (см ниже):
-    # class Exporter(prometheus_client.registry.Collector):
-    prometheus_client.REGISTRY.register(CustomCollector(collected_data_queue_for_exporter, data_is_outdated_after_collected_seconds))
+    idx = 0
 
+    # Текст экспозиции рендерится один раз на каждую новую версию снимка (плюс сжатая копия),
+    # обращения Prometheus обслуживаются из готовых байт и не зависят от сбора данных.
+    # Метрики самого экспортера попадают в ту же экспозицию
+    exposition_cache = deye.ExpositionCache(
+        snapshot_store,
+        CustomCollector(data_is_outdated_after_collected_seconds, replay=bool(replay_file)),
+        registry=self_metrics.registry
+    )
+    exposition_cache.start()
 
     prometheus_exporter_port = int(os.environ.get('HTTP_PORT', 8181))
     prometheus_exporter_host = os.environ.get('HTTP_HOST', '127.0.0.1')
     log.info("[main] Staring web server on {}:{}".format(prometheus_exporter_host, prometheus_exporter_port))
-    # Запуск веб сервера в отдельном потоке (то что он в отдельном потоке - неявно, так устроен метод)
-    prometheus_client.start_http_server(prometheus_exporter_port, addr=prometheus_exporter_host)
+    http_server = deye.ExporterHTTPServer(prometheus_exporter_host, prometheus_exporter_port, exposition_cache)
+    if raw_ring_buffer is not None:
+        http_server.add_route('/raw', make_raw_records_handler(raw_ring_buffer))
+    http_server.start()
 
+    replay_finished = False
     while True:
-        log.info('[main] Main iteration (%s)', idx)
+        log.debug('[main] Main iteration (%s)', idx)
         th_collect_data.join(timeout=3)
         if not th_collect_data.is_alive():
-            break
+            if not replay_file:
+                break
+            # Воспроизведение закончено - процесс не завершается, HTTP и MQTT продолжают
+            # отдавать воспроизведенные данные
+            if not replay_finished:
+                log.info('[main] Replay is finished, serving the replayed data until stopped')
+                replay_finished = True
+            time.sleep(3)
 
         idx = idx + 1
         #if 2 < idx:
@@ -114,137 +281,522 @@ def main():
     log.info('[main] Main end, exiting')
 
 
-def collect_data(collected_data_queue_for_mqtt, collected_data_queue_for_exporter, data_collection_period_seconds, sleep_on_data_collection_error_seconds):
-    log.info('[collect_data] Entering thread collect_data')
-    collected_data = {}
-    while True:
-        log.info('[Thread info: collect_data]')
+def load_inverters_configuration():
+    """ Returns (list of inverters to poll, number of poll workers) """
+    # Несколько инверторов (fleet) описываются JSON файлом, путь к которому задан в DEYE_FLEET_CONFIG:
+    # {
+    #     "workers": 8,
+    #     "inverters": [
+    #         {"name": "house", "ip": "192.168.1.10", "serial": 1234567890, "port": 8899, "mb_slave_id": 1},
+    #         ...
+    #     ]
+    # }
+    # Если файл не задан - опрашивается один инвертор из DEYE_LOGGER_IP/DEYE_LOGGER_SERIAL
+    fleet_config_path = os.environ.get("DEYE_FLEET_CONFIG")
+    if fleet_config_path:
+        log.info("[load_inverters_configuration] Loading fleet configuration from {}".format(fleet_config_path))
+        with open(fleet_config_path) as fleet_config_file:
+            fleet_config = json.load(fleet_config_file)
+        raw_inverters_configuration = fleet_config.get('inverters', [])
+        fleet_workers = fleet_config.get('workers')
+    elif ("DEYE_LOGGER_IP" in os.environ) and ("DEYE_LOGGER_SERIAL" in os.environ):
+        log.info("[load_inverters_configuration] Found inverter configuration env variables: DEYE_LOGGER_IP, DEYE_LOGGER_SERIAL")
+        raw_inverters_configuration = [{
+            'name': os.environ.get("DEYE_INVERTER_NAME", "inverter"),
+            'ip': os.environ.get("DEYE_LOGGER_IP"),
+            'serial': os.environ.get("DEYE_LOGGER_SERIAL"),
+        }]
+        fleet_workers = None
+    elif "DEYE_RTU_DEVICE" in os.environ:
+        log.info("[load_inverters_configuration] Found inverter configuration env variable: DEYE_RTU_DEVICE")
+        raw_inverters_configuration = [{
+            'name': os.environ.get("DEYE_INVERTER_NAME", "inverter"),
+            'transport': 'rtu',
+            'device': os.environ.get("DEYE_RTU_DEVICE"),
+            'baudrate': os.environ.get("DEYE_RTU_BAUDRATE", 9600),
+            'parity': os.environ.get("DEYE_RTU_PARITY", 'N'),
+            'stopbits': os.environ.get("DEYE_RTU_STOPBITS", 1),
+            'inter_frame_ms': os.environ.get("DEYE_RTU_INTER_FRAME_MS"),
+            'timeout_ms': os.environ.get("DEYE_RTU_TIMEOUT_MS", 1000),
+            'mb_slave_id': os.environ.get("DEYE_MB_SLAVE_ID", 1),
+        }]
+        fleet_workers = None
+    else:
+        raise ValueError("Please define DEYE_LOGGER_IP and  DEYE_LOGGER_SERIAL (or DEYE_RTU_DEVICE or DEYE_FLEET_CONFIG) environment variables")
+
+    default_profile = os.environ.get('DEYE_PROFILE', deye.register_profile.DEFAULT_PROFILE)
+    inverters_configuration = []
+    for raw_inverter_configuration in raw_inverters_configuration:
+        if raw_inverter_configuration.get('transport') == 'rtu':
+            inverters_configuration.append(load_rtu_inverter_configuration(raw_inverter_configuration, default_profile))
+            continue
+        if ('ip' not in raw_inverter_configuration) or ('serial' not in raw_inverter_configuration):
+            raise ValueError("Inverter configuration must define 'ip' and 'serial': {}".format(raw_inverter_configuration))
+        inverters_configuration.append({
+            'name': str(raw_inverter_configuration.get('name', raw_inverter_configuration['ip'])),
+            'ip': raw_inverter_configuration['ip'],
+            'serial': int(raw_inverter_configuration['serial']),
+            'port': int(raw_inverter_configuration.get('port', 8899)),
+            'mb_slave_id': int(raw_inverter_configuration.get('mb_slave_id', 1)),
+            # Профиль регистров модели (deye/profiles/<profile>.json или путь к своему файлу)
+            'profile': str(raw_inverter_configuration.get('profile', default_profile)),
+        })
+
+    # Номер устройства инвертора в Modbus TCP сервере (MODBUS_TCP_PORT), по-умолчанию - по порядку с 1
+    for unit_id, (inverter_configuration, raw_inverter_configuration) in enumerate(
+            zip(inverters_configuration, raw_inverters_configuration), 1):
+        inverter_configuration['modbus_unit_id'] = int(raw_inverter_configuration.get('modbus_unit_id', unit_id))
+
+    if not inverters_configuration:
+        raise ValueError("No inverters are configured")
+    names = [inverter_configuration['name'] for inverter_configuration in inverters_configuration]
+    if len(set(names)) != len(names):
+        raise ValueError("Inverter names must be unique: {}".format(names))
+
+    # Число потоков опроса: из DEYE_FLEET_WORKERS, файла конфигурации или по числу инверторов (но не больше 8)
+    fleet_workers = int(os.environ.get("DEYE_FLEET_WORKERS", fleet_workers or min(8, len(inverters_configuration))))
+    return inverters_configuration, max(1, fleet_workers)
+
+
+def load_rtu_inverter_configuration(raw_inverter_configuration, default_profile):
+    # Инвертор подключен напрямую по RS485 (Modbus RTU): вместо ip/serial/port - последовательный
+    # порт и его параметры. Пауза между кадрами по-умолчанию - 3.5 символа (1.75 мс выше 19200 бод)
+    if 'device' not in raw_inverter_configuration:
+        raise ValueError("Modbus RTU inverter configuration must define 'device': {}".format(raw_inverter_configuration))
+    transport_options = {
+        'baudrate': int(raw_inverter_configuration.get('baudrate', 9600)),
+        'parity': str(raw_inverter_configuration.get('parity', 'N')),
+        'stopbits': int(raw_inverter_configuration.get('stopbits', 1)),
+        'bytesize': int(raw_inverter_configuration.get('bytesize', 8)),
+    }
+    if raw_inverter_configuration.get('inter_frame_ms') is not None:
+        transport_options['inter_frame_seconds'] = float(raw_inverter_configuration['inter_frame_ms']) / 1000
+    return {
+        'name': str(raw_inverter_configuration.get('name', raw_inverter_configuration['device'])),
+        'ip': raw_inverter_configuration['device'],
+        'serial': 0,
+        'port': 0,
+        'mb_slave_id': int(raw_inverter_configuration.get('mb_slave_id', 1)),
+        'profile': str(raw_inverter_configuration.get('profile', default_profile)),
+        'transport': 'rtu',
+        'transport_options': transport_options,
+        'socket_timeout': float(raw_inverter_configuration.get('timeout_ms', 1000)) / 1000,
+    }
+
+
+def create_inverters(inverters_configuration, self_metrics=None):
+    # Максимальный разрыв между известными регистрами, который дешевле прочитать
+    # лишними регистрами чем отдельным запросом (если не задан - вычисляется автоматически)
+    gap_merge_threshold = os.environ.get("DEYE_READ_GAP_MERGE_THRESHOLD")
+    if gap_merge_threshold is not None:
+        gap_merge_threshold = int(gap_merge_threshold)
+    # Сколько окон чтения отправлять стику одновременно, не дожидаясь ответа на предыдущее
+    # (1 - строго последовательные запросы, для стиков которые не справляются с конвейером)
+    max_in_flight = int(os.environ.get("DEYE_MAX_IN_FLIGHT", 4))
+    # Ограничения арбитра шины стика: не больше DEYE_BUS_REQUESTS_PER_SECOND запросов в секунду
+    # (0 - без ограничения, до DEYE_BUS_BURST подряд) и пауза не меньше DEYE_BUS_MIN_FRAME_GAP_MS
+    # между обменами со стиком
+    bus_requests_per_second = float(os.environ.get("DEYE_BUS_REQUESTS_PER_SECOND", 20))
+    bus_burst = int(os.environ.get("DEYE_BUS_BURST", 0)) or None
+    bus_min_frame_gap_seconds = float(os.environ.get("DEYE_BUS_MIN_FRAME_GAP_MS", 10)) / 1000
+
+    # Инверторы (и их соединения со стиками) создаются один раз и живут все время работы
+    deye_inverters = {}
+    for inverter_configuration in inverters_configuration:
+        deye_inverter = deye.DeyeInverter(
+            inverter_configuration['ip'], inverter_configuration['serial'],
+            port=inverter_configuration['port'], mb_slave_id=inverter_configuration['mb_slave_id'],
+            gap_merge_threshold=gap_merge_threshold, max_in_flight=max_in_flight,
+            bus_requests_per_second=bus_requests_per_second, bus_burst=bus_burst,
+            bus_min_frame_gap_seconds=bus_min_frame_gap_seconds,
+            transport=inverter_configuration.get('transport', deye.connection.DEFAULT_TRANSPORT),
+            transport_options=inverter_configuration.get('transport_options'),
+            socket_timeout=inverter_configuration.get('socket_timeout', 15),
+            metrics=self_metrics.for_inverter(inverter_configuration['name']) if self_metrics else None,
+            # Профиль компилируется один раз, инверторы одной модели используют его совместно
+            profile=inverter_configuration.get('profile')
+        )
+        log.debug("[create_inverters] Inverter %s: profile: %s, read plan: %s",
+                  inverter_configuration['name'], deye_inverter.profile, deye_inverter.read_plan.as_dict())
+        if self_metrics:
+            self_metrics.watch_circuit_breaker(inverter_configuration['name'], deye_inverter.circuit_breaker)
+        deye_inverters[inverter_configuration['name']] = deye_inverter
 
-        stick_logger_ip = os.environ.get("DEYE_LOGGER_IP")
-        stick_logger_serial = int(os.environ.get("DEYE_LOGGER_SERIAL"))
-        deye_inverter = deye.DeyeInverter(stick_logger_ip, stick_logger_serial)
+    return deye_inverters
 
+
+def collect_data(deye_inverters, fleet_workers, snapshot_store,
+                 data_collection_period_seconds, raw_ring_buffer=None, poll_schedulers=None):
+    log.info('[collect_data] Entering thread collect_data')
+
+    # У каждого регистра может быть свой интервал опроса ('poll_interval' в well_known_registers),
+    # в каждый момент опрашиваются только регистры срок опроса которых наступил
+    if poll_schedulers is None:
+        poll_schedulers = {
+            inverter_name: deye.PollScheduler(deye_inverter.well_known_registers, data_collection_period_seconds)
+            for inverter_name, deye_inverter in deye_inverters.items()
+        }
+
+    # Последние собранные данные всех инверторов хранятся в snapshot_store:
+    # имя инвертора -> {'data': ..., 'data_collected_at': ...}, где data - имя регистра ->
+    # {'value', 'units', 'updated_at', 'stale_after', 'quality'} (см. RegisterFreshness)
+    register_freshness = {
+        inverter_name: deye.RegisterFreshness(deye_inverter.well_known_registers, data_collection_period_seconds)
+        for inverter_name, deye_inverter in deye_inverters.items()
+    }
+    polls_lock = threading.Lock()
+    # Инверторы, опрос которых еще не закончен - их не опрашиваем повторно пока не закончится
+    # предыдущий опрос, так медленный или недоступный стик не задерживает опрос остальных
+    polls_in_progress = set()
+    # Не опрашивать инвертор раньше этого времени (пока стик считается неисправным, см. CircuitBreaker)
+    next_poll_allowed_at = {inverter_name: 0 for inverter_name in deye_inverters}
+
+    def poll_inverter(inverter_name, deye_inverter, register_names, scheduled_at, priority):
+        # Насколько опрос начался позже запланированного срока (ожидание свободного потока,
+        # занятость главного цикла)
+        if deye_inverter.metrics:
+            deye_inverter.metrics.cycle_jitter_seconds.observe(max(0, time.monotonic() - scheduled_at))
         try:
-            deye_inverter.read_registers()
-            collected_data = deye_inverter.decode_registers()
-        except Exception as E:
-            log.error("[collect_data] Error collecting data {}, sleepping for {} seconds  ".format(
-                E, sleep_on_data_collection_error_seconds)
+            # Окна, которые так и не удалось прочитать, не отменяют весь опрос: их регистры
+            # помечаются как failed (с последним удачным значением), остальные обновляются
+            poll_started_at = time.monotonic()
+            failed_windows = deye_inverter.read_registers(register_names, priority)
+            if raw_ring_buffer is not None:
+                # В запись попадают только регистры прочитанные этим опросом - остальные значения
+                # образа могли быть прочитаны давно и не должны выглядеть свежими при воспроизведении
+                raw_ring_buffer.append(
+                    inverter_name, deye_inverter.register_values, deye_inverter.registers_read_since(poll_started_at)
+                )
+            failed_register_names = set(deye_inverter.registers_in_windows(failed_windows, register_names))
+            # Декодируются только регистры, слова которых изменились с прошлого опроса,
+            # значения остальных берутся из предыдущего декодирования
+            collected_data, changed_register_names = deye_inverter.decode_changed_registers(
+                [register_name for register_name in register_names if register_name not in failed_register_names]
             )
-            time.sleep(sleep_on_data_collection_error_seconds)
-            # так как данных нет то перейти к следующей иттерации и попробовать прочитать снова
-            continue
+            # Регистры которые не удалось декодировать - тоже failed
+            failed_register_names.update(set(register_names) - set(collected_data))
+            # Аргументы вместо .format() - строка собирается только если уровень DEBUG включен
+            log.debug("[collect_data] Inverter %s: connection: connects: %s, reconnects: %s",
+                      inverter_name, deye_inverter.connection.connect_count, deye_inverter.connection.reconnect_count)
+            log.debug("[collect_data] Inverter %s: Changed registers: %s, failed registers: %s",
+                      inverter_name, changed_register_names, failed_register_names)
+            # Активные ошибки инвертора: переходы (появилась / исчезла) считаются по битовой карте
+            fault_codes = deye_inverter.fault_codes() if deye_inverter.profile.fault_register_name in collected_data else None
+            update_inverter_snapshot(snapshot_store, register_freshness[inverter_name], inverter_name,
+                                     collected_data, failed_register_names, changed_register_names,
+                                     fault_decoder=deye_inverter.fault_decoder, fault_codes=fault_codes)
+        except Exception as E:
+            # Не прочитано ни одно окно: все опрашиваемые регистры помечаются как failed,
+            # значения и время последнего сбора данных остаются прежними
+            update_inverter_snapshot(snapshot_store, register_freshness[inverter_name], inverter_name,
+                                     {}, register_names, collected=False)
+            # Неудачные окна уже повторены внутри read_registers, следующая попытка - по расписанию
+            # или, если стик признан неисправным, после таймаута CircuitBreaker, но не раньше
+            # окончания паузы перед переподключением к стику
+            retry_seconds = max(0, deye_inverter.circuit_breaker.seconds_until_retry(),
+                                deye_inverter.connection.seconds_until_reconnect())
+            log.error("[collect_data] Inverter %s: Error collecting data %r, will retry in %.1f seconds",
+                      inverter_name, E, retry_seconds)
+            next_poll_allowed_at[inverter_name] = time.monotonic() + retry_seconds
+        finally:
+            with polls_lock:
+                polls_in_progress.discard(inverter_name)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=fleet_workers, thread_name_prefix='poll_inverter')
+    while True:
+        log.debug('[Thread info: collect_data]')
+
+        now = time.monotonic()
+        for inverter_name, deye_inverter in deye_inverters.items():
+            register_names = poll_schedulers[inverter_name].due(now)
+            if not register_names:
+                continue
+            # Сроки отсчитываются от расписания, а не от окончания опроса, что бы все инверторы
+            # опрашивались по единому расписанию. Если инвертор сейчас опросить нельзя - этот
+            # срок пропускается
+            scheduled_at = min(poll_schedulers[inverter_name].deadlines[register_name] for register_name in register_names)
+            poll_schedulers[inverter_name].mark_polled(register_names, now)
+            with polls_lock:
+                if inverter_name in polls_in_progress:
+                    log.debug("[collect_data] Inverter %s: previous poll is not finished yet, skipping", inverter_name)
+                    continue
+                if now < next_poll_allowed_at[inverter_name]:
+                    continue
+                polls_in_progress.add(inverter_name)
+            # Опрос в котором есть регистры с общим периодом опроса (или чаще) - регулярный,
+            # только редко опрашиваемые регистры - пропускают регулярные опросы и запись вперед
+            if poll_schedulers[inverter_name].is_fast(register_names):
+                priority = deye.PRIORITY_FAST_POLL
+            else:
+                priority = deye.PRIORITY_SLOW_POLL
+            executor.submit(poll_inverter, inverter_name, deye_inverter, register_names, scheduled_at, priority)
 
-        collected_data['data_collected_at'] = time.time()
-        log.debug("[collect_data] Collected Data: {}".format(collected_data))
-
-        for collected_data_queue in [collected_data_queue_for_exporter, collected_data_queue_for_mqtt]:
-            log.debug("[collect_data] Sending data to queue {}".format(collected_data_queue))
-            # Пробуем отправить данные если очередь определена
-            # (не определена может быть очередь для MQTT если соответвующие переменные не передали)
-            if collected_data_queue:
-                try:
-                    collected_data_queue.put(collected_data, block=False)
-                except queue.Full:
-                    log.debug("[collect_data] Queue is full, removing last data")
-                    old_collected_data = collected_data_queue.get(block=False)
-                    log.debug("[collect_data] Removing old dtata: {}, replacing with new data {}".format(
-                            old_collected_data,
-                            collected_data
-                        )
-                    )
-
-        log.debug("[collect_data] Sleeping for {} before next collection period".format(data_collection_period_seconds))
-        time.sleep(data_collection_period_seconds)
+        # Спать до ближайшего срока опроса какого-либо регистра любого инвертора
+        next_collection_at = min(
+            [poll_scheduler.next_deadline() for poll_scheduler in poll_schedulers.values()] +
+            [now + data_collection_period_seconds]
+        )
+        sleep_seconds = max(0.1, next_collection_at - time.monotonic())
+        log.debug("[collect_data] Sleeping for %.2f second(s) before next collection", sleep_seconds)
+        time.sleep(sleep_seconds)
 
     log.error('[collect_data] Finishing thread (this is not expected, it should be an endless loop!!!')
 
-def on_publish(client, userdata, mid, reason_code, properties):
-    # reason_code and properties will only be present in MQTTv5. It's always unset in MQTTv3
-    try:
-        log.debug("[on_publish] client: {}, userdata: {}, mid: {}, reason_code: {}, properties: {}".format(
-                client, userdata, mid, reason_code, properties)
+def update_inverter_snapshot(snapshot_store, register_freshness, inverter_name,
+                             collected_data, failed_register_names, changed_register_names=(), collected=True,
+                             fault_decoder=None, fault_codes=None, collected_at=None):
+    # Прочитана только часть регистров - остальные значения остаются от предыдущих опросов.
+    # Инвертор опрашивается не более чем одним потоком одновременно, так что предыдущие
+    # данные этого инвертора между чтением и обновлением никто не изменит.
+    # values_version растет только когда изменилось значение какого-либо регистра
+    # (changed_register_names): по нему получатели (MQTT) понимают что публиковать нечего.
+    # Имена измененных регистров в снимок не попадают - получатель может пропустить версии
+    # снимка, поэтому сравнивает значения сам (DeltaFilter).
+    # faults - активные ошибки и события их появления/исчезновения (FaultDecoder.merge),
+    # обновляются только когда прочитана битовая карта ошибок (fault_codes).
+    # collected_at - время сбора данных (при воспроизведении - время записи), по-умолчанию текущее
+    previous_inverter_data = snapshot_store.latest().data.get(inverter_name)
+    if collected_at is None:
+        collected_at = time.time()
+    if collected:
+        data_collected_at = collected_at
+    else:
+        data_collected_at = previous_inverter_data['data_collected_at'] if previous_inverter_data else None
+    values_version = previous_inverter_data['values_version'] if previous_inverter_data else 0
+    if changed_register_names:
+        values_version = values_version + 1
+    faults = previous_inverter_data['faults'] if previous_inverter_data else None
+    if fault_codes is not None:
+        faults = fault_decoder.merge(faults, fault_codes, now=collected_at)
+    return snapshot_store.update(inverter_name, {
+        'data': register_freshness.merge(
+            previous_inverter_data['data'] if previous_inverter_data else None,
+            collected_data, failed_register_names, now=collected_at
+        ),
+        'data_collected_at': data_collected_at,
+        'values_version': values_version,
+        'faults': faults,
+    })
+
+
+def replay_data(deye_inverters, raw_ring_buffer, snapshot_store, data_collection_period_seconds, replay_speed):
+    # Воспроизведение записанных образов регистров: каждый образ декодируется как после
+    # опроса и публикуется в snapshot_store (оттуда - в экспортер и MQTT) со временем записи.
+    # Паузы между записями сокращаются в replay_speed раз (0 - без пауз), но следующая запись
+    # публикуется только когда получатели снимка (MQTT) обработали предыдущую
+    log.info('[replay_data] Replaying {} with speed {}'.format(raw_ring_buffer.path, replay_speed))
+    register_freshness = {
+        inverter_name: deye.RegisterFreshness(deye_inverter.well_known_registers, data_collection_period_seconds)
+        for inverter_name, deye_inverter in deye_inverters.items()
+    }
+    replayed = 0
+    previous_timestamp = None
+    started_at = time.monotonic()
+    for timestamp, inverter_name, image in raw_ring_buffer.records():
+        deye_inverter = deye_inverters.get(inverter_name)
+        if deye_inverter is None:
+            continue
+        if replay_speed and (previous_timestamp is not None) and (timestamp > previous_timestamp):
+            time.sleep((timestamp - previous_timestamp) / replay_speed)
+        previous_timestamp = timestamp
+
+        deye_inverter.load_image(image)
+        register_names = deye_inverter.registers_read()
+        collected_data, changed_register_names = deye_inverter.decode_changed_registers(register_names)
+        snapshot = update_inverter_snapshot(
+            snapshot_store, register_freshness[inverter_name], inverter_name,
+            collected_data, set(register_names) - set(collected_data), changed_register_names,
+            fault_decoder=deye_inverter.fault_decoder,
+            fault_codes=deye_inverter.fault_codes() if deye_inverter.profile.fault_register_name in collected_data else None,
+            collected_at=timestamp
         )
-        userdata.remove(mid)
-    except KeyError:
-        print("on_publish() is called with a mid not present in unacked_publish")
-        print("This is due to an unavoidable race-condition:")
-        print("* publish() return the mid of the message sent.")
-        print("* mid from publish() is added to unacked_publish by the main thread")
-        print("* on_publish() is called by the loop_start thread")
-        print("While unlikely (because on_publish() will be called after a network round-trip),")
-        print(" this is a race-condition that COULD happen")
-        print("")
-        print("The best solution to avoid race-condition is using the msg_info from publish()")
-        print("We could also try using a list of acknowledged mid rather than removing from pending list,")
-        print("but remember that mid could be re-used !")
-
-
-def send_data_to_mqtt(collected_data_queue, empty_queue_sleep_seconds, mqtt_send_sleep_seconds, topic, mqtt_host, mqtt_username, mqtt_password):
+        while not snapshot_store.wait_consumed(snapshot.version, timeout=60):
+            log.error('[replay_data] Data version %s is not consumed in 60 seconds, waiting', snapshot.version)
+        replayed = replayed + 1
+
+    log.info('[replay_data] Replayed {} record(s) in {:.2f} second(s)'.format(replayed, time.monotonic() - started_at))
+
+
+def make_raw_records_handler(raw_ring_buffer):
+    # GET /raw?inverter=<имя>&from=<unix time>&to=<unix time>&limit=<N>
+    # Записи кольцевого буфера в формате NDJSON (одна JSON запись на строку):
+    # {"timestamp": ..., "inverter": ..., "registers": [значение или null для каждого регистра]}
+    # Возвращаются последние limit (1000 по-умолчанию) записей диапазона, от старых к новым
+    def handle_raw_records(request, query):
+        def query_value(name, convert):
+            values = query.get(name)
+            return convert(values[0]) if values else None
+
+        try:
+            records = raw_ring_buffer.records(
+                start_time=query_value('from', float),
+                end_time=query_value('to', float),
+                inverter_name=query_value('inverter', str),
+                limit=query_value('limit', int) or 1000
+            )
+        except ValueError as E:
+            request.send_body(400, "Bad query: {}\n".format(E).encode('utf-8'), 'text/plain; charset=utf-8')
+            return
+        body = ''.join(
+            json.dumps({'timestamp': timestamp, 'inverter': inverter_name, 'registers': image}) + '\n'
+            for timestamp, inverter_name, image in records
+        ).encode('utf-8')
+        request.send_body(200, body, 'application/x-ndjson; charset=utf-8')
+
+    return handle_raw_records
+
+
+def send_data_to_mqtt(snapshot_store, mqtt_send_sleep_seconds, topic, mqtt_publisher,
+                      publish_mode='json', field_topic=None, delta_filters=None, heartbeat_seconds=300,
+                      fault_events_topic=None, replay=False):
+    # При воспроизведении (replay) публикуется каждая версия данных без пауз, обработанная версия
+    # подтверждается в snapshot_store (см. replay_data), качество считается на время записи
     log.info('[send_data_to_mqtt] Entering thread send_data_to_mqtt')
-    commected_data = {}
+    last_version = 0
+    # имя инвертора -> номер последнего опубликованного события ошибок
+    last_fault_event_numbers = {}
+    # имя инвертора -> (values_version, качество полей, время публикации) последней публикации:
+    # если значения и качество не изменились, инвертор не публикуется (кроме heartbeat)
+    last_published = {}
     while True:
         try:
-            collected_data = collected_data_queue.get(block=False)
-            # Удлаить отметку времени - она нужна только для для части экспортера, и не
-            # нужна для MQTT
-            if 'data_collected_at' in collected_data:
-                collected_data.pop('data_collected_at')
-            mqtt_message = {}
-            for k, v in collected_data.items():
-                mqtt_message[k] = v['value']
-            log.debug("[send_data_to_mqtt] Got data from queue: {}, mqtt_message: {}".format(
-                collected_data, mqtt_message)
-            )
-
-            mqtt_message = json.dumps(mqtt_message)
-
-            unacked_publish = set()
-            mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-            mqttc.password = mqtt_password
-            mqttc.username = mqtt_username
-            mqttc.host = mqtt_host
-            mqttc.on_publish = on_publish
-
-            mqttc.user_data_set(unacked_publish)
-            mqttc.connect(mqtt_host)
-            log.debug("[send_data_to_mqtt] Connect done")
-            mqttc.loop_start()
-
-            # Our application produce some messages
-            msg_info = mqttc.publish(topic, mqtt_message, qos=1)
-            unacked_publish.add(msg_info.mid)
-            # Wait for all message to be published
-            while len(unacked_publish):
-                time.sleep(0.1)
-                # Due to race-condition described above, the following way to wait for all publish is safer
-            msg_info.wait_for_publish()
-            mqttc.disconnect()
-            log.debug("[send_data_to_mqtt] Disconnect")
-            mqttc.loop_stop()
-
-
-            log.debug("[send_data_to_mqtt] Sleeping for {} second(s) before next MQTT queue update".format(mqtt_send_sleep_seconds))
-            time.sleep(mqtt_send_sleep_seconds)
-        except queue.Empty:
-            log.debug("[send_data_to_mqtt] Queue is Empty (First data collection or data was not updated), sleeping for {} second(s)".format(empty_queue_sleep_seconds))
-            time.sleep(empty_queue_sleep_seconds)
+            # Ждать пока не появится версия данных новее уже отправленной
+            snapshot = snapshot_store.wait_for_newer(last_version, timeout=60)
+            if snapshot.version == last_version:
+                log.debug("[send_data_to_mqtt] No new data (First data collection or data was not updated)")
+                continue
+            last_version = snapshot.version
+            log.debug("[send_data_to_mqtt] Got data version %s: %s", snapshot.version, snapshot.data)
+            for inverter_name, inverter_data in snapshot.data.items():
+                if fault_events_topic:
+                    publish_fault_events(mqtt_publisher, fault_events_topic, inverter_name, inverter_data['faults'],
+                                         last_fault_event_numbers)
+                # Публикуются последние удачно прочитанные значения и их качество (fresh/stale/failed),
+                # регистры которые еще ни разу не были прочитаны - пропускаются
+                now = inverter_data['data_collected_at'] if replay else time.time()
+                qualities = {
+                    k: deye.register_quality(v, now) for k, v in inverter_data['data'].items() if v['value'] is not None
+                }
+                published = last_published.get(inverter_name)
+                if (published is not None) and (published[0] == inverter_data['values_version']) and \
+                        (published[1] == qualities) and (now - published[2] < heartbeat_seconds):
+                    continue
+                last_published[inverter_name] = (inverter_data['values_version'], qualities, now)
+                values = {k: v['value'] for k, v in inverter_data['data'].items() if v['value'] is not None}
+                # Публикация не блокирует: сообщения отправляются по уже открытой сессии
+                # (или ставятся в очередь пока сессия переподключается)
+                if publish_mode == 'delta':
+                    publish_mqtt_delta(mqtt_publisher, field_topic, delta_filters[inverter_name], inverter_name, values, qualities)
+                else:
+                    # Одно сообщение для каждого инвертора, в сообщении есть имя инвертора
+                    mqtt_message = dict(values, inverter=inverter_name, quality=qualities)
+                    mqtt_publisher.publish(topic.format(inverter=inverter_name), json.dumps(mqtt_message), qos=1)
+
+            snapshot_store.consumed('send_data_to_mqtt', last_version)
+            # Изменения публикуются сразу, полное сообщение - не чаще чем раз в mqtt_send_sleep_seconds
+            if (publish_mode != 'delta') and not replay:
+                log.debug("[send_data_to_mqtt] Sleeping for %s second(s) before next MQTT update", mqtt_send_sleep_seconds)
+                time.sleep(mqtt_send_sleep_seconds)
         except Exception as E:
-            log.debug("[send_data_to_mqtt] Unexpected Exception : {}".format(E))
-            time.sleep(empty_queue_sleep_seconds)
+            log.error("[send_data_to_mqtt] Unexpected Exception : %s", E)
+            snapshot_store.consumed('send_data_to_mqtt', last_version)
+            time.sleep(mqtt_send_sleep_seconds)
 
     log.error('[send_data_to_mqtt] Finishing thread (this is not expected, it should be an endless loop!!!')
 
 
 
 
+def start_register_writers(deye_inverters, mqtt_publisher, command_topic, result_topic, poll_schedulers,
+                           self_metrics=None, coalesce_seconds=0.5, min_write_interval_seconds=1):
+    # Для каждого инвертора с writable регистрами - свой RegisterWriter (запись через сессию
+    # опроса этого инвертора) и подписка на топик команд каждого такого регистра
+    register_writers = {}
+    for inverter_name, deye_inverter in deye_inverters.items():
+        def on_result(result, inverter_name=inverter_name):
+            if self_metrics:
+                self_metrics.register_writes.labels(inverter_name, result['status']).inc()
+            if result['status'] in (deye.register_writer.WRITE_OK, deye.register_writer.WRITE_MISMATCH):
+                # Новое значение попадет в данные (Prometheus, MQTT) со следующим опросом
+                poll_schedulers[inverter_name].mark_due([result['register']])
+            mqtt_publisher.publish(
+                result_topic.format(inverter=inverter_name, field=result['register']),
+                json.dumps(dict(result, inverter=inverter_name)), qos=1
+            )
+
+        register_writer = deye.RegisterWriter(
+            deye_inverter, coalesce_seconds=coalesce_seconds, min_write_interval_seconds=min_write_interval_seconds,
+            on_result=on_result
+        )
+        writable_registers = register_writer.writable_registers()
+        if not writable_registers:
+            continue
+        register_writer.start()
+        for register_name in writable_registers:
+            mqtt_publisher.subscribe(
+                command_topic.format(inverter=inverter_name, field=register_name),
+                make_register_command_handler(register_writer, register_name)
+            )
+        register_writers[inverter_name] = register_writer
+    return register_writers
+
+
+def make_register_command_handler(register_writer, register_name):
+    # Команда: число ("25") или JSON {"value": 25, "id": "<идентификатор для ответа>"}.
+    # Недопустимое значение не записывается, в ответе - status rejected
+    def handle_register_command(topic, payload):
+        command_id = None
+        command = payload.decode('utf-8', 'replace')
+        try:
+            command = json.loads(command)
+        except ValueError:
+            pass
+        if isinstance(command, dict):
+            command_id = command.get('id')
+            command = command.get('value')
+        register_writer.submit(register_name, command, command_id)
+
+    return handle_register_command
+
+
+def publish_fault_events(mqtt_publisher, fault_events_topic, inverter_name, faults, last_fault_event_numbers):
+    # Каждое событие (ошибка появилась / исчезла) - отдельное сообщение, события которые уже
+    # были опубликованы пропускаются по номеру. Если между публикациями событий было больше
+    # чем помещается в журнал (FaultDecoder.event_log_length), самые старые теряются
+    if not faults:
+        return
+    last_event_number = last_fault_event_numbers.get(inverter_name, 0)
+    for event in faults['log']:
+        if event['number'] <= last_event_number:
+            continue
+        mqtt_message = dict(event, inverter=inverter_name)
+        mqtt_publisher.publish(fault_events_topic.format(inverter=inverter_name), json.dumps(mqtt_message), qos=1)
+    last_fault_event_numbers[inverter_name] = faults['last_event_number']
+
+
+def publish_mqtt_delta(mqtt_publisher, field_topic, delta_filter, inverter_name, values, qualities=None):
+    # Каждое поле - в свой retained топик, только поля которые изменились больше чем на deadband
+    # (или которые давно не публиковались). Качество поля - в подтопик '<топик поля>/quality',
+    # только когда оно изменилось
+    values = dict(values)
+    for field, quality in (qualities or {}).items():
+        values[field + '/quality'] = quality
+    changed_values = delta_filter.changed(inverter_name, values)
+    log.debug("[send_data_to_mqtt] Inverter %s: changed fields: %s", inverter_name, changed_values)
+    for field, value in changed_values.items():
+        mqtt_publisher.publish(field_topic.format(inverter=inverter_name, field=field), json.dumps(value), qos=1, retain=True)
+    delta_filter.mark_published(inverter_name, changed_values)
+
+
 def init_logging(debug=False):
     root = logging.getLogger()
 
     stderr_handler = logging.StreamHandler(stream=sys.stdout)
     stderr_handler.setFormatter(logging.Formatter(
         '## %(asctime)s %(threadName)s %(message)s'))
-    root.addHandler(stderr_handler)
+    # Вывод в отдельном потоке через очередь: потоки опроса не ждут записи в stdout,
+    # повторяющиеся ошибки ограничиваются по частоте
+    root.addHandler(deye.make_queue_handler(stderr_handler))
 
     if debug:
         root.setLevel(logging.DEBUG)
@@ -255,83 +807,108 @@ def init_logging(debug=False):
 
 
 class CustomCollector(object):
+    # Метрики инверторов из одного снимка данных. Вызывается из ExpositionCache один раз
+    # на каждую версию снимка, а не при каждом обращении Prometheus
 
-    def __init__(self, exporter_queue, data_is_outdated_after_collected_seconds):
-        self.exporter_queue = exporter_queue
-        self.collected_data = {}
-        self.data_collected_at = time.time()
-        self.data_is_outdated_after_collected_seconds = data_is_outdated_after_collected_seconds
+    # replay - данные воспроизводятся: возраст и качество считаются на время последней записи инвертора
 
-    def describe(self):
-        return [self._make_gauge_metric_family()]
+    def __init__(self, data_is_outdated_after_collected_seconds, replay=False):
+        self.data_is_outdated_after_collected_seconds = data_is_outdated_after_collected_seconds
+        self.replay = replay
 
     def _make_gauge_metric_family(self):
         return prometheus_client.core.GaugeMetricFamily(
                 'deye_inverter_metrics',
                 'Metrics from Deye inverter',
-                labels=['metic_name', 'metric_unit']
+                labels=['inverter', 'metic_name', 'metric_unit']
             )
 
     def _make_info_metric_family(self):
         return prometheus_client.core.InfoMetricFamily(
                 'deye_inverter_metrics_info',
                 'Metrics from Deye inverter (info)',
-                labels=['metic_name', 'metric_string_value']
+                labels=['inverter', 'metic_name', 'metric_string_value']
+            )
+
+    def _make_age_metric_family(self):
+        return prometheus_client.core.GaugeMetricFamily(
+                'deye_inverter_metrics_age_seconds',
+                'Seconds since the value of the metric was read from Deye inverter',
+                labels=['inverter', 'metic_name']
+            )
+
+    def _make_quality_metric_family(self):
+        return prometheus_client.core.GaugeMetricFamily(
+                'deye_inverter_metrics_quality',
+                'Quality of the metric value: fresh, stale (not updated in time) or failed (last read failed)',
+                labels=['inverter', 'metic_name', 'quality']
+            )
+
+    def _make_fault_active_metric_family(self):
+        return prometheus_client.core.GaugeMetricFamily(
+                'deye_inverter_fault_active',
+                'Faults which are active on Deye inverter',
+                labels=['inverter', 'fault_code', 'description']
+            )
+
+    def _make_fault_events_metric_family(self):
+        return prometheus_client.core.CounterMetricFamily(
+                'deye_inverter_fault_events',
+                'Fault transitions of Deye inverter since the exporter start: set or cleared',
+                labels=['inverter', 'fault_code', 'event']
             )
 
-    def collect(self):
+    def collect_snapshot(self, snapshot):
         gauge_metrics = self._make_gauge_metric_family()
         info_metrics = self._make_info_metric_family()
+        age_metrics = self._make_age_metric_family()
+        quality_metrics = self._make_quality_metric_family()
+        fault_active_metrics = self._make_fault_active_metric_family()
+        fault_events_metrics = self._make_fault_events_metric_family()
         gauge_units_list = ['C', 'V', '%', 'A', 'Hz', 'W']
-        try:
-            # Получить данные из очереди, если они там есть
-            self.collected_data = self.exporter_queue.get(block=False)
-            log.debug("[collect] Got data from queue: {}".format(self.collected_data))
-        except queue.Empty:
-            # Если данных в очереди нет то работаем с данными полученными на прошлой итерации,
-            # если они не устарели
-            log.debug("[collect] Queue is Empty, Data is not colleced yet")
-        except Exception as E:
-            # Не ожидаемое исключение
-            log.debug("[collect] Unexpected Exception: {}".format(E))
-            return []
-
-        # Проверить есть ли ключ 'data_collected_at' в данных,
-        # его может не быть если например он был удален на предыдущем опросе, и за время
-        # между опросами новых данных не появилось
-        if 'data_collected_at' in self.collected_data:
-            log.debug("[collect] data_collected_at = {}".format(self.data_collected_at))
-            self.data_collected_at = self.collected_data.pop('data_collected_at')
-
-        now_time = time.time()
-        data_commected_ago_seconds = now_time - self.data_collected_at
-        if ( data_commected_ago_seconds > self.data_is_outdated_after_collected_seconds):
-            log.error("[collect] Data from queue is outdated: Collected {} seconds ago, data is outdated after {}".format(
-                data_commected_ago_seconds,
-                self.data_is_outdated_after_collected_seconds
-                )
-            )
-            # данные устарели - с ними нельзя работать, просто отбрасываем
-            self.collected_data = {}
-
-        for metric_name, metric_data in self.collected_data.items():
-            log.debug("[collect] Metric: {}, Value: {} Units {}".format(metric_name, metric_data['value'], metric_data['units']))
-
-            if ( metric_data['units'] in gauge_units_list ):
-                log.debug("[collect] {} is gauge ({}) Value: {}".format(metric_name, metric_data['units'], metric_data['value']))
-                gauge_metrics.add_metric([metric_name, metric_data['units']], metric_data['value'])
-            elif metric_data['units'] == '':
-                log.debug("[collect] {} is INFO ({}) Value: {}".format(metric_name, metric_data['units'], metric_data['value']))
-                info_metrics.add_metric([metric_name], {metric_name: str(metric_data['value'])})
-            # Если юнит не один из известных и не пустой то что делать с таким не ясно - пропускаем
-            else:
-                log.error("Nothing to do with metric: {}, value: {}".format(
-                    metric_name, str(metric_data))
-                )
-        log.debug("[collect] gauge_metrics: {}".format(gauge_metrics))
-        log.debug("[collect] info_metrics: {}".format(info_metrics))
-
-        return [gauge_metrics, info_metrics]
+        # Снимок данных всех инверторов: имя инвертора -> {'data': ..., 'data_collected_at': ...}
+        # (снимок неизменяемый, его можно читать без блокировок)
+
+        for inverter_name, inverter_data in snapshot.data.items():
+            now_time = time.time()
+            if self.replay and (inverter_data['data_collected_at'] is not None):
+                now_time = inverter_data['data_collected_at']
+            outdated_metric_names = []
+            for metric_name, metric_data in inverter_data['data'].items():
+                # Регистр еще ни разу не был прочитан
+                if metric_data['value'] is None:
+                    continue
+                # Последнее удачное значение отдается вместе с его возрастом и качеством, но только
+                # пока оно не устарело совсем - такие данные нельзя использовать, просто отбрасываем
+                data_commected_ago_seconds = now_time - metric_data['updated_at']
+                if ( data_commected_ago_seconds > self.data_is_outdated_after_collected_seconds):
+                    outdated_metric_names.append(metric_name)
+                    continue
+
+                if ( metric_data['units'] in gauge_units_list ):
+                    gauge_metrics.add_metric([inverter_name, metric_name, metric_data['units']], metric_data['value'])
+                elif metric_data['units'] == '':
+                    info_metrics.add_metric([inverter_name, metric_name], {metric_name: str(metric_data['value'])})
+                # Если юнит не один из известных и не пустой то что делать с таким не ясно - пропускаем
+                else:
+                    log.error("Nothing to do with metric: %s, value: %s", metric_name, metric_data)
+                    continue
+                age_metrics.add_metric([inverter_name, metric_name], data_commected_ago_seconds)
+                quality_metrics.add_metric([inverter_name, metric_name, deye.register_quality(metric_data, now_time)], 1)
+
+            if outdated_metric_names:
+                log.error("[collect] Inverter %s: Data is outdated (older than %s seconds): %s",
+                          inverter_name, self.data_is_outdated_after_collected_seconds, outdated_metric_names)
+
+            faults = inverter_data['faults']
+            if faults:
+                for fault_code, description in faults['active'].items():
+                    fault_active_metrics.add_metric([inverter_name, fault_code, description], 1)
+                for fault_code, counters in faults['events'].items():
+                    for event, count in counters.items():
+                        fault_events_metrics.add_metric([inverter_name, fault_code, event], count)
+
+        return [gauge_metrics, info_metrics, age_metrics, quality_metrics, fault_active_metrics, fault_events_metrics]
 
 
 if __name__ == '__main__':
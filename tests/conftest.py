@@ -0,0 +1,21 @@
+import pytest
+# custom module
+import deye
+
+
+STICK_LOGGER_SERIAL = 2700000000
+
+
+@pytest.fixture
+def emulator():
+    # Эмулируемый стик на свободном порту, неисправности задаются атрибутами в самом тесте
+    emulator = deye.SolarmanV5Emulator(STICK_LOGGER_SERIAL, host='127.0.0.1', port=0).start()
+    yield emulator
+    emulator.stop()
+
+
+@pytest.fixture
+def deye_inverter(emulator):
+    deye_inverter = deye.DeyeInverter('127.0.0.1', STICK_LOGGER_SERIAL, port=emulator.port)
+    yield deye_inverter
+    deye_inverter.close()
@@ -0,0 +1,29 @@
+# Векторный декодер (deye.ColumnarDecoder) должен декодировать образ регистров так же как
+# decode_registers(): образ читается из эмулируемого стика так же как это делает экспортер
+import math
+
+
+def same_value(expected, actual):
+    if isinstance(expected, (int, float)) and not isinstance(expected, bool):
+        return (actual is not None) and math.isclose(expected, float(actual), rel_tol=1e-9, abs_tol=1e-9)
+    return expected == actual
+
+
+def test_decode_register_images_agrees_with_decode_registers(deye_inverter):
+    deye_inverter.read_registers()
+    expected = deye_inverter.decode_registers()
+    assert expected
+    columns = deye_inverter.decode_register_images(
+        [deye_inverter.register_values], [[bool(valid) for valid in deye_inverter.register_valid]]
+    )
+
+    mismatches = {}
+    for register_name in deye_inverter.well_known_registers:
+        actual = columns[register_name][0]
+        if isinstance(actual, float) and math.isnan(actual):
+            actual = None
+        # Регистр, который не декодируется построчно, должен быть None (NaN) в векторном результате
+        expected_value = expected[register_name]['value'] if register_name in expected else None
+        if not same_value(expected_value, actual):
+            mismatches[register_name] = (expected_value, actual)
+    assert mismatches == {}
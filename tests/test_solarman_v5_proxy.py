@@ -0,0 +1,167 @@
+# Прокси Solarman V5 (deye.SolarmanV5Proxy) на эмулируемом стике (deye.SolarmanV5Emulator)
+import socket
+import threading
+import time
+import pytest
+# custom module
+import deye
+from deye import modbus_rtu
+from deye.solarman_v5 import (
+    encode_v5_frame, decode_v5_header,
+    V5_HEADER_LENGTH, V5_TRAILER_LENGTH, V5_RESPONSE_CONTROL_CODE, V5_RESPONSE_PAYLOAD_PREFIX_LENGTH,
+)
+from .conftest import STICK_LOGGER_SERIAL
+
+
+LATENCY_SECONDS = 0.2
+CACHE_SECONDS = 0.5
+CLIENTS = 4
+
+
+class StuckRegisterImage(dict):
+    # Образ регистров стика, который не принимает записи (инвертор не применил настройку)
+    def __setitem__(self, address, value):
+        pass
+
+
+@pytest.fixture
+def proxy(emulator, deye_inverter):
+    emulator.latency_seconds = LATENCY_SECONDS
+    proxy = deye.SolarmanV5Proxy(
+        {'inverter': deye_inverter}, host='127.0.0.1', port=0, cache_seconds=CACHE_SECONDS
+    ).start()
+    yield proxy
+    proxy.stop()
+
+
+@pytest.fixture
+def writing_proxy(deye_inverter):
+    register_writer = deye.RegisterWriter(deye_inverter, min_write_interval_seconds=0)
+    proxy = deye.SolarmanV5Proxy(
+        {'inverter': deye_inverter}, host='127.0.0.1', port=0, cache_seconds=CACHE_SECONDS,
+        allow_writes=True, register_writers={'inverter': register_writer}
+    ).start()
+    yield proxy
+    proxy.stop()
+
+
+def make_client(proxy):
+    return deye.SolarmanV5Client('127.0.0.1', STICK_LOGGER_SERIAL, port=proxy.port, socket_timeout=5)
+
+
+@pytest.fixture
+def client(proxy):
+    client = make_client(proxy)
+    yield client
+    client.disconnect()
+
+
+@pytest.fixture
+def writing_client(writing_proxy):
+    client = make_client(writing_proxy)
+    yield client
+    client.disconnect()
+
+
+def write_exception_code(client, register_addr, values):
+    try:
+        client.write_multiple_holding_registers(register_addr, values)
+    except modbus_rtu.ModbusException as E:
+        return E.exception_code
+    return None
+
+
+def receive(client_socket, length):
+    data = b''
+    while len(data) < length:
+        chunk = client_socket.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("Proxy closed the connection")
+        data = data + chunk
+    return data
+
+
+def test_identical_outstanding_reads_are_collapsed(emulator, proxy):
+    clients = [make_client(proxy) for client_number in range(CLIENTS)]
+    results = [None] * len(clients)
+    start_event = threading.Event()
+
+    def read(client_number):
+        start_event.wait()
+        results[client_number] = clients[client_number].read_holding_registers(100, 3)
+
+    requests_before = emulator.requests_count
+    threads = [threading.Thread(target=read, args=(client_number,)) for client_number in range(len(clients))]
+    for thread in threads:
+        thread.start()
+    start_event.set()
+    for thread in threads:
+        thread.join(10)
+    for client in clients:
+        client.disconnect()
+
+    assert results == [[100, 101, 102]] * len(clients)
+    assert emulator.requests_count - requests_before == 1
+
+
+def test_reads_are_answered_from_the_cache_for_cache_seconds(emulator, client):
+    client.read_holding_registers(200, 2)
+    requests_before = emulator.requests_count
+    assert client.read_holding_registers(200, 2) == [200, 201]
+    assert emulator.requests_count == requests_before
+    time.sleep(CACHE_SECONDS + 0.1)
+    assert client.read_holding_registers(200, 2) == [200, 201]
+    assert emulator.requests_count == requests_before + 1
+
+
+def test_reply_carries_client_serial_and_sequence_number(proxy):
+    # Серийный номер клиента отличается от номера стика (с одним инвертором принимается любой)
+    client_serial = STICK_LOGGER_SERIAL + 12345
+    sequence_number = 0x5A
+    modbus_request = modbus_rtu.read_holding_registers_request(1, 300, 2)
+    with socket.create_connection(('127.0.0.1', proxy.port), timeout=5) as client_socket:
+        client_socket.sendall(encode_v5_frame(client_serial, sequence_number, modbus_request))
+        header = receive(client_socket, V5_HEADER_LENGTH)
+        payload_length, control_code, reply_sequence_number, reply_serial = decode_v5_header(header)
+        frame = header + receive(client_socket, payload_length + V5_TRAILER_LENGTH)
+    modbus_response = frame[V5_HEADER_LENGTH + V5_RESPONSE_PAYLOAD_PREFIX_LENGTH:-V5_TRAILER_LENGTH]
+
+    assert control_code == V5_RESPONSE_CONTROL_CODE
+    assert reply_serial == client_serial
+    assert reply_sequence_number == sequence_number
+    assert modbus_rtu.parse_response(modbus_response, modbus_request) == [300, 301]
+
+
+def test_writes_are_rejected_without_allow_writes(emulator, deye_inverter, client):
+    register_id = deye_inverter.well_known_registers['battery_charge_limit']['id']
+    assert write_exception_code(client, register_id, [20]) == 0x01
+    assert register_id not in emulator.register_image
+
+
+def test_write_of_a_register_which_is_not_writable_is_rejected(emulator, writing_client):
+    assert write_exception_code(writing_client, 100, [1]) == 0x03
+    assert 100 not in emulator.register_image
+
+
+def test_write_of_a_value_above_max_is_rejected(emulator, deye_inverter, writing_client):
+    register_details = deye_inverter.well_known_registers['battery_charge_limit']
+    assert write_exception_code(writing_client, register_details['id'], [register_details['max'] + 1]) == 0x03
+    assert register_details['id'] not in emulator.register_image
+
+
+def test_write_of_several_registers_is_rejected(emulator, deye_inverter, writing_client):
+    register_id = deye_inverter.well_known_registers['battery_charge_limit']['id']
+    assert write_exception_code(writing_client, register_id, [20, 20]) == 0x03
+    assert register_id not in emulator.register_image
+
+
+def test_write_of_an_allowed_value_is_written(emulator, deye_inverter, writing_client):
+    register_id = deye_inverter.well_known_registers['battery_charge_limit']['id']
+    assert write_exception_code(writing_client, register_id, [20]) is None
+    assert emulator.register_image.get(register_id) == 20
+
+
+def test_write_which_does_not_read_back_is_a_slave_device_failure(emulator, deye_inverter, writing_client):
+    emulator.register_image = StuckRegisterImage()
+    register_id = deye_inverter.well_known_registers['battery_charge_limit']['id']
+    assert write_exception_code(writing_client, register_id, [20]) == 0x04